@@ -21,8 +21,7 @@ namespace PluginLit.Core.Editor
             catch (Exception e)
             {
                 Debug.Log(e);
-                if (Application.isBatchMode)
-                    EditorApplication.Exit(1);
+                context.Finish(1);
             }
         }
 
@@ -41,8 +40,7 @@ namespace PluginLit.Core.Editor
             catch (Exception e)
             {
                 Debug.Log(e);
-                if (Application.isBatchMode)
-                    EditorApplication.Exit(1);
+                context.Finish(1);
             }
         }
 
@@ -65,6 +65,11 @@ namespace PluginLit.Core.Editor
             return _current = new BuildProcessorContext().LoadFromCommand();
         }
 
+        public static BuildProcessorContext FromArgs(params string[] args)
+        {
+            return _current = new BuildProcessorContext().LoadFromArgs(args);
+        }
+
         public BuildTarget BuildTarget { get; internal set; }
         public BuildTargetGroup BuildTargetGroup { get; private set; }
         public BuildTaskType TaskType { get; internal set; }
@@ -86,6 +91,25 @@ namespace PluginLit.Core.Editor
             }
         }
 
+        /// <summary>
+        /// 由BuildWorker执行时为true，结束时不退出编辑器
+        /// </summary>
+        public bool WorkerMode;
+
+        public event Action<int> OnBuildFinished;
+
+        public void Finish(int code)
+        {
+            if (WorkerMode)
+            {
+                OnBuildFinished?.Invoke(code);
+                return;
+            }
+
+            if (Application.isBatchMode)
+                EditorApplication.Exit(code);
+        }
+
         public bool DebugMode;
         /// <summary>
         /// 是否需要符号表 android
@@ -195,6 +219,16 @@ namespace PluginLit.Core.Editor
             return this;
         }
 
+        private BuildProcessorContext LoadFromArgs(string[] args)
+        {
+            Reset();
+
+            DebugMode = false;
+
+            InitDataWithCommand(args);
+            return this;
+        }
+
         private void InitDataWithCommand(params string[] args)
         {
             CommandArgs = Global.GetCommandParams(args, "-");
@@ -27,8 +27,7 @@ namespace PluginLit.Core.Editor
 
             AssetDatabase.Refresh();
             
-            if (Application.isBatchMode)
-                EditorApplication.Exit(0);
+            context.Finish(0);
         }
     }
 }
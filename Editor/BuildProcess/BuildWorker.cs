@@ -0,0 +1,299 @@
+using System;
+using System.Collections.Generic;
+using System.Diagnostics;
+using System.IO;
+using System.Linq;
+using System.Text;
+using UnityEditor;
+using UnityEngine;
+using Debug = UnityEngine.Debug;
+
+namespace PluginLit.Core.Editor
+{
+    /// <summary>
+    /// 常驻的batchmode编辑器，从文件队列中读取PreBuild/Build任务执行，省去每次启动Unity的时间
+    /// workerPath/worker.json 状态，jobs/{id}.job.json 任务，jobs/{id}.result.json 结果
+    /// </summary>
+    [InitializeOnLoad]
+    public static class BuildWorker
+    {
+        private const string SessionPathKey = "PluginLit.BuildWorker.Path";
+        private const string SessionIdleKey = "PluginLit.BuildWorker.Idle";
+        private const string SessionJobKey = "PluginLit.BuildWorker.Job";
+        private const double PollInterval = 0.5;
+
+        private class WorkerJob
+        {
+            public string Id;
+            public string Method;
+            public string LogFile;
+            public DateTime StartTime;
+            public BuildProcessorContext Context;
+        }
+
+        private static string _workerPath;
+        private static string _jobsPath;
+        private static double _idleSeconds;
+        private static double _nextPollTime;
+        private static double _idleStartTime;
+        private static string _state;
+        private static WorkerJob _job;
+        private static StreamWriter _jobLog;
+        private static readonly object LogLock = new object();
+
+        static BuildWorker()
+        {
+            // 脚本重新编译后恢复
+            var path = SessionState.GetString(SessionPathKey, null);
+            if (string.IsNullOrEmpty(path))
+                return;
+
+            Start(path, SessionState.GetFloat(SessionIdleKey, 0));
+            var jobId = SessionState.GetString(SessionJobKey, null);
+            if (!string.IsNullOrEmpty(jobId))
+            {
+                SessionState.EraseString(SessionJobKey);
+                WriteResult(jobId, 1, "job interrupted by script reload", null, 0);
+            }
+        }
+
+        public static void Run()
+        {
+            if (!Application.isBatchMode)
+                throw new BuildException("Application is not in batch mode");
+
+            var args = Environment.GetCommandLineArgs().Skip(1).ToArray();
+            var commandArgs = Global.GetCommandParams(args, "-");
+            var path = commandArgs.TryGet("workerpath", null);
+            if (string.IsNullOrEmpty(path))
+                throw new BuildException("BuildWorker need -workerPath");
+
+            path = Path.GetFullPath(path);
+            var idleSeconds = float.Parse(commandArgs.TryGet("workeridle", "1800"));
+            SessionState.SetString(SessionPathKey, path);
+            SessionState.SetFloat(SessionIdleKey, idleSeconds);
+            Start(path, idleSeconds);
+        }
+
+        private static void Start(string path, double idleSeconds)
+        {
+            _workerPath = path;
+            _jobsPath = Path.Combine(path, "jobs");
+            _idleSeconds = idleSeconds;
+            _idleStartTime = EditorApplication.timeSinceStartup;
+            Directory.CreateDirectory(_jobsPath);
+
+            EditorApplication.update -= Update;
+            EditorApplication.update += Update;
+            Debug.Log($"BuildWorker started at {path}");
+            WriteState("idle");
+        }
+
+        private static void Stop(int code)
+        {
+            EditorApplication.update -= Update;
+            SessionState.EraseString(SessionPathKey);
+            Global.CheckAndRemoveFile(Path.Combine(_workerPath, "worker.json"));
+            Debug.Log("BuildWorker stopped");
+            EditorApplication.Exit(code);
+        }
+
+        private static void Update()
+        {
+            var now = EditorApplication.timeSinceStartup;
+            if (_job != null || now < _nextPollTime)
+                return;
+
+            _nextPollTime = now + PollInterval;
+            if (EditorApplication.isCompiling || EditorApplication.isUpdating)
+            {
+                WriteState("busy");
+                return;
+            }
+
+            var jobFile = Directory.GetFiles(_jobsPath, "*.job.json").OrderBy(f => f, StringComparer.Ordinal).FirstOrDefault();
+            if (jobFile == null)
+            {
+                WriteState("idle");
+                if (_idleSeconds > 0 && now - _idleStartTime > _idleSeconds)
+                {
+                    Debug.Log($"BuildWorker idle for {_idleSeconds}s");
+                    Stop(0);
+                }
+                return;
+            }
+
+            StartJob(jobFile);
+        }
+
+        private static void StartJob(string jobFile)
+        {
+            var id = Path.GetFileName(jobFile);
+            id = id.Substring(0, id.Length - ".job.json".Length);
+            Dictionary<string, object> data;
+            try
+            {
+                data = MiniJson.Deserialize(File.ReadAllText(jobFile)) as Dictionary<string, object>;
+            }
+            catch (IOException)
+            {
+                // 还在写入，下次再读
+                return;
+            }
+            finally
+            {
+                _nextPollTime = 0;
+            }
+
+            Global.CheckAndRemoveFile(jobFile);
+            if (data == null)
+            {
+                WriteResult(id, 1, "invalid job file", null, 0);
+                return;
+            }
+
+            var method = data.TryGet("method", null) as string;
+            if (method == "Stop")
+            {
+                WriteResult(id, 0, null, null, 0);
+                Stop(0);
+                return;
+            }
+
+            var args = (data.TryGet("args", null) as List<object> ?? new List<object>()).Select(arg => arg.ToString()).ToArray();
+            _job = new WorkerJob
+            {
+                Id = id,
+                Method = method,
+                LogFile = data.TryGet("logFile", null) as string ?? Path.Combine(_jobsPath, id + ".log"),
+                StartTime = DateTime.Now,
+            };
+            SessionState.SetString(SessionJobKey, id);
+            OpenJobLog(_job.LogFile);
+            WriteState("busy");
+            Debug.Log($"BuildWorker job {id} {method} begin >>>>>>>>>>>>>>>>>>> {string.Join(" ", args)}");
+
+            try
+            {
+                var context = BuildProcessorContext.FromArgs(args);
+                context.WorkerMode = true;
+                context.OnBuildFinished += code => FinishJob(code, null);
+                _job.Context = context;
+                switch (method)
+                {
+                    case "PreBuild":
+                        BuildHelper.PreBuildWithContext(context);
+                        break;
+                    case "Build":
+                        BuildHelper.BuildWithContext(context);
+                        break;
+                    default:
+                        throw new BuildException($"Unknown BuildWorker method {method}");
+                }
+            }
+            catch (Exception e)
+            {
+                Debug.LogException(e);
+                FinishJob(1, e.Message);
+            }
+        }
+
+        private static void FinishJob(int code, string error)
+        {
+            var job = _job;
+            if (job == null)
+                return;
+
+            _job = null;
+            var duration = (DateTime.Now - job.StartTime).TotalSeconds;
+            Debug.Log($"BuildWorker job {job.Id} {job.Method} ended <<<<<<<<<<<<<<<<<<< code: {code} used time: {(int) duration}s");
+            CloseJobLog();
+
+            object buildResult = null;
+            var buildPath = job.Context?.BuildPath;
+            if (!string.IsNullOrEmpty(buildPath))
+            {
+                var resultFile = Path.Combine(buildPath, "buildResult.json");
+                if (File.Exists(resultFile))
+                    buildResult = MiniJson.Deserialize(File.ReadAllText(resultFile));
+            }
+
+            SessionState.EraseString(SessionJobKey);
+            WriteResult(job.Id, code, error, buildResult, duration);
+            _idleStartTime = EditorApplication.timeSinceStartup;
+            WriteState("idle");
+        }
+
+        private static void OpenJobLog(string logFile)
+        {
+            var dir = Path.GetDirectoryName(logFile);
+            if (!string.IsNullOrEmpty(dir))
+                Directory.CreateDirectory(dir);
+
+            lock (LogLock)
+            {
+                _jobLog = new StreamWriter(logFile, false, new UTF8Encoding(false)) {AutoFlush = true};
+            }
+            Application.logMessageReceivedThreaded += OnLogMessage;
+        }
+
+        private static void CloseJobLog()
+        {
+            Application.logMessageReceivedThreaded -= OnLogMessage;
+            lock (LogLock)
+            {
+                _jobLog?.Dispose();
+                _jobLog = null;
+            }
+        }
+
+        private static void OnLogMessage(string condition, string stackTrace, LogType type)
+        {
+            lock (LogLock)
+            {
+                if (_jobLog == null)
+                    return;
+
+                _jobLog.WriteLine(condition);
+                if (type == LogType.Error || type == LogType.Exception || type == LogType.Assert)
+                    _jobLog.WriteLine(stackTrace);
+            }
+        }
+
+        private static void WriteState(string state)
+        {
+            if (state == _state)
+                return;
+
+            _state = state;
+            WriteJson(Path.Combine(_workerPath, "worker.json"), new Dictionary<string, object>
+            {
+                {"pid", Process.GetCurrentProcess().Id},
+                {"state", state},
+                {"target", EditorUserBuildSettings.activeBuildTarget.ToString()},
+                {"job", _job?.Id},
+                {"time", DateTime.Now.ToString("yyyy-MM-dd HH:mm:ss")},
+            });
+        }
+
+        private static void WriteResult(string id, int code, string error, object buildResult, double duration)
+        {
+            WriteJson(Path.Combine(_jobsPath, id + ".result.json"), new Dictionary<string, object>
+            {
+                {"id", id},
+                {"code", code},
+                {"error", error},
+                {"duration", duration},
+                {"buildResult", buildResult},
+            });
+        }
+
+        private static void WriteJson(string path, object data)
+        {
+            var tempFile = path + ".tmp";
+            File.WriteAllText(tempFile, MiniJson.Serialize(data));
+            Global.CheckAndRemoveFile(path);
+            File.Move(tempFile, path);
+        }
+    }
+}
@@ -2,14 +2,29 @@
 
 import os
 import sys
+import json
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-HEAD = b'#if FAIRYGUI_DRAGONBONES\n\n'
+DEFINE = "FAIRYGUI_DRAGONBONES"
+BOM = b'\xef\xbb\xbf'
 ENDING = b'\n#endif'
+EXTS = (".cs",)
+MANIFEST = ".changehelper.json"
 
 
-def read_file(filename):
+def get_head(define):
+    return b'#if ' + define.encode("utf-8") + b'\n\n'
+
+
+def read_file(filename, size=-1):
     with open(filename, "rb") as f:
-        return f.read()
+        return f.read(size)
 
 
 def save_file(filename, data):
@@ -17,29 +32,309 @@ def save_file(filename, data):
         f.write(data)
 
 
-def walk_dir(path, func):
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            func(os.path.join(root, f))
+def scan_entries(path, exts=EXTS, on_dir=None):
+    '''os.scandir遍历目录，每个文件只访问一次，on_dir在进入每个目录时回调'''
+    stack = [path]
+    while stack:
+        dirname = stack.pop()
+        if on_dir:
+            on_dir(dirname)
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(exts):
+                    yield entry
+
+
+def scan_files(path, exts=EXTS):
+    return (entry.path for entry in scan_entries(path, exts))
+
+
+def strip_head(content, head):
+    '''去掉BOM后如果以head(或CRLF形式)开头返回 (BOM, 去掉head后的内容)，否则body为None'''
+    bom = BOM if content.startswith(BOM) else b''
+    body = content[len(bom):]
+    for value in (head, head.replace(b'\n', b'\r\n')):
+        if body.startswith(value):
+            return bom, body[len(value):]
+    return bom, None
+
+
+def is_wrapped(filename, head):
+    '''只读取文件开头判断是否已包裹'''
+    prefix = read_file(filename, len(BOM) + len(head) * 2)
+    return strip_head(prefix, head)[1] is not None
+
+
+def wrap_file(filename, head, dry_run=False):
+    '''包裹#if，返回写入的字节数，已包裹返回0'''
+    if is_wrapped(filename, head):
+        return 0
+    content = read_file(filename)
+    bom = BOM if content.startswith(BOM) else b''
+    content = bom + head + content[len(bom):] + ENDING
+    if not dry_run:
+        save_file(filename, content)
+    return len(content)
+
+
+def unwrap_file(filename, head, dry_run=False):
+    '''去掉包裹的#if，返回写入的字节数，未包裹返回0'''
+    if not is_wrapped(filename, head):
+        return 0
+    bom, body = strip_head(read_file(filename), head)
+    stripped = body.rstrip(b'\r\n')
+    for ending in (b'\r' + ENDING, ENDING):
+        if stripped.endswith(ending):
+            body = stripped[:-len(ending)]
+            break
+    content = bom + body
+    if not dry_run:
+        save_file(filename, content)
+    return len(content)
+
+
+class Manifest(object):
+    '''记录已处理文件的 (size, mtime)，只重新处理新增或修改过的文件'''
+    path = None
+    key = None
+
+    def __init__(self, root, key, path=None):
+        self.root = root
+        self.key = key
+        self.path = path or os.path.join(root, MANIFEST)
+        self.files = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # 宏或模式变了之前的记录就没用了
+            if data.get("key") == key:
+                self.files = data.get("files", {})
+        except (IOError, ValueError):
+            pass
+
+    def get_name(self, filename):
+        return os.path.relpath(filename, self.root).replace("\\", "/")
+
+    def is_changed(self, filename, st=None):
+        try:
+            st = st or os.stat(filename)
+        except OSError:
+            return False
+        return self.files.get(self.get_name(filename)) != [st.st_size, st.st_mtime_ns]
+
+    def update(self, filename):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            # 事件之后文件已被删除
+            self.remove(filename)
+            return
+        self.files[self.get_name(filename)] = [st.st_size, st.st_mtime_ns]
+
+    def remove(self, filename):
+        self.files.pop(self.get_name(filename), None)
+
+    def retain(self, filenames):
+        names = set(self.get_name(filename) for filename in filenames)
+        self.files = {name: value for name, value in self.files.items() if name in names}
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": self.key, "files": self.files}, f, separators=(",", ":"))
+        os.replace(temp_path, self.path)
+
+
+def get_manifest_key(define, unwrap):
+    return "%s:%s" % ("unwrap" if unwrap else "wrap", define)
+
+
+def process_files(files, define=DEFINE, unwrap=False, dry_run=False, jobs=0, manifest=None):
+    '''并行处理文件列表，返回修改过的文件写入的字节数列表'''
+    if not files:
+        return []
+    head = get_head(define)
+    func = unwrap_file if unwrap else wrap_file
+
+    def process(filename):
+        try:
+            return func(filename, head, dry_run)
+        except FileNotFoundError:
+            return 0
+
+    with ThreadPoolExecutor(max_workers=jobs or min(32, (os.cpu_count() or 2) * 2)) as executor:
+        sizes = list(executor.map(process, files))
+    if manifest is not None and not dry_run:
+        for filename in files:
+            manifest.update(filename)
+    return [size for size in sizes if size]
+
+
+def change_files(path, define=DEFINE, unwrap=False, dry_run=False, jobs=0, manifest=None):
+    '''并行处理目录下的.cs文件，有manifest时只处理新增或修改过的文件
+    返回 (文件数, 检查数, 修改数, 写入字节数)'''
+    entries = list(scan_entries(path))
+    files = [entry.path for entry in entries]
+    if manifest is not None:
+        manifest.retain(files)
+        files = [entry.path for entry in entries if manifest.is_changed(entry.path, entry.stat())]
+    changed = process_files(files, define, unwrap, dry_run, jobs, manifest)
+    return len(entries), len(files), len(changed), sum(changed)
+
+
+# watch==============================
+# Linux上用inotify监听目录，其他平台退回到定时增量扫描
+
+class Inotify(object):
+    '''ctypes封装的inotify'''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: %s" % path)
+        self.watches[wd] = path
+
+    def add_tree(self, path):
+        '''监听整个目录树，返回其中已有的文件'''
+        return [entry.path for entry in scan_entries(path, on_dir=self.add_watch)]
+
+    def read_events(self, timeout=None):
+        '''返回 [(目录, mask, 文件名)]，超时返回空列表'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            else:
+                events.append((self.watches.get(wd), mask, name))
+        return events
+
+
+def print_result(result, unwrap=False, dry_run=False, duration=0):
+    total, checked, changed, size = result
+    print("%s%s %d/%d files (%d checked), %d bytes in %.2fs" % ("[dry-run] " if dry_run else ""
+                                                               , "unwrap" if unwrap else "wrap", changed, total, checked, size, duration))
+
+
+def wait_events(notify, path, debounce=0.2):
+    '''等到有文件写完，再收集到安静debounce秒为止，返回需要处理的文件，None表示要全量扫描'''
+    pending = set()
+    full = False
+    events = notify.read_events()
+    while events:
+        for dirname, mask, name in events:
+            if mask & notify.IN_Q_OVERFLOW:
+                full = True
+            elif dirname is None:
+                continue
+            elif mask & notify.IN_ISDIR:
+                if mask & (notify.IN_CREATE | notify.IN_MOVED_TO):
+                    pending.update(notify.add_tree(os.path.join(dirname, name)))
+            # 文件只在写完、移入移出或删除时处理，避免处理写了一半的文件
+            elif mask & (notify.IN_CLOSE_WRITE | notify.IN_MOVED_FROM | notify.IN_MOVED_TO | notify.IN_DELETE) \
+                    and name.lower().endswith(EXTS):
+                pending.add(os.path.join(dirname, name))
+        events = notify.read_events(debounce)
+    return None if full else pending
+
+
+def watch_files(path, define=DEFINE, unwrap=False, jobs=0, manifest=None, interval=1.0):
+    '''监听目录，新增或修改的.cs文件落地后立即处理'''
+    try:
+        notify = Inotify()
+        notify.add_tree(path)
+        print("watching %s (inotify)" % path)
+    except (OSError, AttributeError) as e:
+        notify = None
+        print("watching %s (polling every %.1fs): %s" % (path, interval, e))
+
+    try:
+        while True:
+            files = None
+            if notify is None:
+                time.sleep(interval)
+            else:
+                files = wait_events(notify, path)
+
+            start = time.time()
+            if files is None:
+                result = change_files(path, define, unwrap, False, jobs, manifest)
+            else:
+                for filename in files:
+                    if not os.path.isfile(filename):
+                        manifest.remove(filename)
+                files = [filename for filename in sorted(files) if manifest.is_changed(filename)]
+                changed = process_files(files, define, unwrap, False, jobs, manifest)
+                result = (len(manifest.files), len(files), len(changed), sum(changed))
+            manifest.save()
+            if result[2]:
+                print_result(result, unwrap, False, time.time() - start)
+    finally:
+        if notify is not None:
+            notify.close()
 
-        for d in dirs:
-            walk_dir(os.path.join(root, d), func)
 
+def main(argv=None):
+    '''argv为命令行参数列表，也兼容直接传入目录'''
+    if isinstance(argv, str):
+        argv = [argv]
+    parser = argparse.ArgumentParser(description="给目录下的.cs文件包裹(或去掉) #if 宏")
+    parser.add_argument("path", nargs="?", default=".")
+    parser.add_argument("--define", default=DEFINE, help="宏名称，默认为%s" % DEFINE)
+    parser.add_argument("--unwrap", action="store_true", help="去掉已包裹的#if")
+    parser.add_argument("--dry-run", action="store_true", help="只统计不写入")
+    parser.add_argument("--jobs", type=int, default=0, help="线程数")
+    parser.add_argument("--incremental", action="store_true", help="用manifest记录已处理的文件，只处理新增或修改过的文件")
+    parser.add_argument("--manifest", default=None, help="manifest路径，默认为目录下的%s" % MANIFEST)
+    parser.add_argument("--watch", action="store_true", help="处理完后继续监听目录，隐含--incremental")
+    parser.add_argument("--interval", type=float, default=1.0, help="不支持inotify时的轮询间隔")
+    args = parser.parse_args(argv)
 
-def change_content(file):
-    if file.lower().endswith(".cs"):
-        content = read_file(file)
-        if not content.startswith(HEAD):
-            content = HEAD + content + ENDING
-            save_file(file, content)
+    manifest = None
+    if args.incremental or args.watch:
+        manifest = Manifest(args.path, get_manifest_key(args.define, args.unwrap), args.manifest)
 
+    start = time.time()
+    result = change_files(args.path, args.define, args.unwrap, args.dry_run, args.jobs, manifest)
+    print_result(result, args.unwrap, args.dry_run, time.time() - start)
+    if manifest is not None and not args.dry_run:
+        manifest.save()
 
-def main(path):
-    walk_dir(path, change_content)
+    if args.watch and not args.dry_run:
+        try:
+            watch_files(args.path, args.define, args.unwrap, args.jobs, manifest, args.interval)
+        except KeyboardInterrupt:
+            manifest.save()
 
 
 if __name__ == "__main__":
-    path = "."
-    if len(sys.argv) >= 2:
-        path = sys.argv[1]
-    main(path)
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+
+POLL_INTERVAL = 0.1
+
+
+def get_arg(args, name, default=None):
+    '''与Unity一样按名称取参数，忽略大小写'''
+    name = name.lower()
+    for i in range(len(args) - 1):
+        if args[i].lower() == name:
+            return args[i + 1]
+    return default
+
+
+def write_json(filename, data):
+    with open(filename + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(filename + ".tmp", filename)
+
+
+def read_job(filename):
+    '''读取并删除任务文件，读取失败返回None'''
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    os.remove(filename)
+    return job
+
+
+def write_state(state_file, state, target, job=None):
+    write_json(state_file, {"pid": os.getpid(), "state": state, "target": target, "job": job, "time": time.time()})
+
+
+def run_job(jobs_path, job, target):
+    '''模拟BuildWorker执行任务：写日志，args中有-path时写buildResult.json，有-fail时返回失败'''
+    start = time.time()
+    method = job["method"]
+    args = job.get("args", [])
+    build_result = None
+    with open(job.get("logFile") or os.path.join(jobs_path, job["id"] + ".log"), "w", encoding="utf-8") as f:
+        f.write("Task %s begin >>>\n" % method)
+        f.write("args: %s\n" % " ".join(args))
+        out_path = get_arg(args, "-path")
+        if out_path:
+            build_result = {"method": method, "target": target, "stub": True}
+            os.makedirs(out_path, exist_ok=True)
+            write_json(os.path.join(out_path, "buildResult.json"), build_result)
+        f.write("Task %s ended <<<\n" % method)
+    code = 1 if "-fail" in args else 0
+    write_json(os.path.join(jobs_path, job["id"] + ".result.json"), {
+        "id": job["id"],
+        "code": code,
+        "error": None,
+        "duration": time.time() - start,
+        "buildResult": build_result,
+    })
+
+
+def main(argv=None):
+    '''实现BuildWorker.cs的文件协议，用于在没有Unity的环境中检查fabfile的UnityWorker'''
+    argv = sys.argv[1:] if argv is None else argv
+    worker_path = get_arg(argv, "-workerPath")
+    if not worker_path:
+        print("usage: UnityWorkerStub.py -workerPath <path> [-workerIdle <seconds>] [-logFile <file>]")
+        return 1
+    idle = float(get_arg(argv, "-workerIdle", "1800"))
+    target = get_arg(argv, "-buildTarget", "stub")
+    jobs_path = os.path.join(worker_path, "jobs")
+    state_file = os.path.join(worker_path, "worker.json")
+    os.makedirs(jobs_path, exist_ok=True)
+    log_file = get_arg(argv, "-logFile")
+    if log_file:
+        with open(log_file, "w", encoding="utf-8") as f:
+            f.write("unity worker stub %d started\n" % os.getpid())
+
+    write_state(state_file, "idle", target)
+    last_time = time.time()
+    try:
+        while True:
+            names = sorted(name for name in os.listdir(jobs_path) if name.endswith(".job.json"))
+            if not names:
+                if idle > 0 and time.time() - last_time > idle:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            job = read_job(os.path.join(jobs_path, names[0]))
+            if job is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            if job["method"] == "Stop":
+                write_json(os.path.join(jobs_path, job["id"] + ".result.json"), {"id": job["id"], "code": 0})
+                break
+            write_state(state_file, "busy", target, job["id"])
+            run_job(jobs_path, job, target)
+            write_state(state_file, "idle", target)
+            last_time = time.time()
+    finally:
+        if os.path.exists(state_file):
+            os.remove(state_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -10,13 +10,15 @@ import os
 import sys
 import json
 import logging
+import threading
 import hashlib
-import zipfile
 import shutil
-import git
-import plistlib
 import datetime
+import time
+import contextlib
+import fnmatch
 import re
+import struct
 
 from invoke import task
 from invoke.exceptions import Exit
@@ -33,21 +35,241 @@ def dump_now(text):
     print(text, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
+# build timing==============================
+# 构建阶段计时，输出 buildTiming.json 与 Chrome trace 文件 buildTrace.json(chrome://tracing 或 Perfetto 打开)
+
+class BuildTimer(object):
+    name = ""
+    start_time = 0.0
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self.spans = []
+        self.meta = dict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        begin = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "fail"
+            raise
+        finally:
+            duration = time.perf_counter() - begin
+            record = {
+                "name": name,
+                "start": round(begin - self.start_counter, 6),
+                "duration": round(duration, 6),
+                "thread": threading.current_thread().name,
+                "status": status,
+            }
+            if args:
+                record["args"] = args
+            with self._lock:
+                self.spans.append(record)
+            print("[timing] %s %s %.1fs" % (name, status, duration))
+
+    def report(self):
+        summary = dict()
+        for record in self.spans:
+            summary[record["name"]] = round(summary.get(record["name"], 0) + record["duration"], 6)
+        return {
+            "name": self.name,
+            "startTime": datetime.datetime.fromtimestamp(self.start_time).strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": round(time.perf_counter() - self.start_counter, 6),
+            "meta": self.meta,
+            "summary": summary,
+            "phases": sorted(self.spans, key=lambda r: r["start"]),
+        }
+
+    def trace(self):
+        threads = dict()
+        events = []
+        for record in sorted(self.spans, key=lambda r: r["start"]):
+            tid = threads.setdefault(record["thread"], len(threads) + 1)
+            events.append({
+                "name": record["name"],
+                "cat": "build",
+                "ph": "X",
+                "ts": int(record["start"] * 1000000),
+                "dur": int(record["duration"] * 1000000),
+                "pid": 1,
+                "tid": tid,
+                "args": dict(record.get("args", {}), status=record["status"]),
+            })
+        for thread, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}})
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        '''在path目录下写入 buildTiming.json 和 buildTrace.json'''
+        if not path or not os.path.isdir(path):
+            return
+        with open(os.path.join(path, "buildTiming.json"), 'w', encoding='UTF-8') as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+        with open(os.path.join(path, "buildTrace.json"), 'w', encoding='UTF-8') as f:
+            json.dump(self.trace(), f)
+
+
+_build_timer = BuildTimer("fabric")
+# 并行构建(buildMatrix)时每个线程各自的计时器、日志目录与Unity日志列表，未设置时使用全局值
+_build_local = threading.local()
+
+
+def get_build_timer():
+    return getattr(_build_local, "timer", None) or _build_timer
+
+
+def begin_build_timer(name, **meta):
+    global _build_timer
+    _build_timer = BuildTimer(name)
+    _build_timer.meta.update(meta)
+    return _build_timer
+
+
+def get_build_local():
+    return dict(vars(_build_local))
+
+
+def get_log_files():
+    '''当前构建的Unity日志，FAILURE(printLog=True)时输出最后一个的摘要'''
+    log_files = getattr(_build_local, "log_files", None)
+    return LogFiles if log_files is None else log_files
+
+
+def bind_build_local(func, local=None):
+    '''让func在其他线程中执行时沿用当前线程的计时器与日志目录'''
+    local = get_build_local() if local is None else local
+
+    def wrapper(*args, **kwargs):
+        vars(_build_local).update(local)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            vars(_build_local).clear()
+    return wrapper
+
+
+@contextlib.contextmanager
+def timed(name, **args):
+    '''记录当前构建的一个阶段，可作为with语句或函数装饰器使用'''
+    with get_build_timer().span(name, **args):
+        yield
+
+
 def SUCESS(tip):
     raise Exit(code=0, message="SUCCESS:%s" % tip)
 
 
 def FAILURE(err, code=1, printLog=False):
-    if printLog and len(LogFiles) > 0:
-        file = LogFiles.pop()
+    log_files = get_log_files()
+    if printLog and len(log_files) > 0:
+        file = log_files.pop()
         if os.path.exists(file):
-            print('start print log file:: ', file)
-            with open(file, 'r', encoding='UTF-8') as f:
-                print("\n".join(f.readlines()))
-            print('ended print log file:: ', file)
+            print_unity_log_summary(file)
     raise Exit(code=code, message="FAILURE:%s" % err)
 
 
+# unity log analyzer==============================
+# 通过mmap查找关键字提取错误及上下文，不读取整个日志
+
+# (分类, 关键字, 是否从日志末尾向前查找)
+UNITY_LOG_NEEDLES = [
+    ("compiler", b"error CS", False),
+    ("compiler", b"Scripts have compiler errors", False),
+    ("build", b"Error building Player", False),
+    ("build", b"Build completed with a result of 'Failed'", False),
+    ("build", b"BuildFailedException", True),
+    ("build", b"CommandInvokationFailure", True),
+    ("build", b"Gradle build failed", True),
+    ("exception", b"Exception: ", True),
+    ("abort", b"Aborting batchmode", True),
+]
+
+
+def get_log_line_range(mm, start, end, before=0, after=0):
+    line_start = mm.rfind(b"\n", 0, start) + 1
+    for _ in range(before):
+        if line_start <= 0:
+            break
+        line_start = mm.rfind(b"\n", 0, line_start - 1) + 1
+    line_end = mm.find(b"\n", end)
+    line_end = len(mm) if line_end < 0 else line_end
+    for _ in range(after):
+        if line_end >= len(mm):
+            break
+        next_end = mm.find(b"\n", line_end + 1)
+        line_end = len(mm) if next_end < 0 else next_end
+    return line_start, line_end
+
+
+def analyze_unity_log(log_file, context=3, max_matches=10, tail_lines=15, max_line=2000):
+    '''分析Unity日志，返回编译错误、异常、构建失败等信息及其上下文'''
+    import mmap
+    summary = {"file": log_file, "size": 0, "matches": [], "counts": dict(), "tail": ""}
+    if not os.path.exists(log_file):
+        return summary
+    summary["size"] = os.path.getsize(log_file)
+    if summary["size"] <= 0:
+        return summary
+
+    def decode(data):
+        return data[:max_line * (context * 2 + 1)].decode('UTF-8', errors='replace').rstrip()
+
+    with open(log_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        seen_lines = set()
+        for category, needle, reverse in UNITY_LOG_NEEDLES:
+            found = 0
+            pos = len(mm) if reverse else 0
+            while found < max_matches:
+                pos = mm.rfind(needle, 0, pos) if reverse else mm.find(needle, pos)
+                if pos < 0:
+                    break
+                line_start, line_end = get_log_line_range(mm, pos, pos + len(needle))
+                if not reverse:
+                    pos = line_end
+                else:
+                    pos = line_start
+                line = mm[line_start:min(line_end, line_start + max_line)]
+                if line in seen_lines:
+                    continue
+                seen_lines.add(line)
+                found += 1
+                summary["counts"][category] = summary["counts"].get(category, 0) + 1
+                ctx_start, ctx_end = get_log_line_range(mm, line_start, line_start, context, context)
+                summary["matches"].append({
+                    "category": category,
+                    "offset": line_start,
+                    "line": decode(line),
+                    "context": decode(mm[ctx_start:ctx_end]),
+                })
+        tail_start, _ = get_log_line_range(mm, len(mm), len(mm), tail_lines, 0)
+        summary["tail"] = decode(mm[tail_start:])
+    summary["matches"].sort(key=lambda m: m["offset"])
+    return summary
+
+
+def print_unity_log_summary(log_file, context=3, max_matches=10):
+    start = time.perf_counter()
+    summary = analyze_unity_log(log_file, context, max_matches)
+    print('======== unity log summary:: %s (%d bytes, %.2fs)' % (log_file, summary["size"], time.perf_counter() - start))
+    for category, count in summary["counts"].items():
+        print('  %s: %d' % (category, count))
+    for match in summary["matches"]:
+        print('-------- [%s] at offset %d' % (match["category"], match["offset"]))
+        print(match["context"])
+    print('-------- log tail')
+    print(summary["tail"])
+    print('======== full log:: %s' % log_file)
+    return summary
+
+
 def get_unity_dict(filename):
     result = dict()
     with open(filename, 'r', encoding='UTF-8') as f:
@@ -71,47 +293,64 @@ def is_win_platform():
 # start init global params
 WORK_PATH = os.getcwd()
 PROTJECT_PATH = WORK_PATH
-UNITY_HUB = os.environ.get("UNITY_HUB", None)
-TUANJIE_HUB = os.environ.get("TUANJIE_HUB", None)
-UNITY_PATH = os.environ.get("UNITY_PATH", None)
-log.info('PROTJECT_PATH="%s"' % (PROTJECT_PATH))
-log.info('UNITY_HUB="%s"' % (UNITY_HUB))
-log.info('TUANJIE_HUB="%s"' % (TUANJIE_HUB))
-log.info('UNITY_PATH="%s"' % (UNITY_PATH))
-
-unity_version = get_unity_dict(os.path.join(PROTJECT_PATH, "ProjectSettings", "ProjectVersion.txt"))
-log.info('unity_version="%s"' % (unity_version))
-version_string = unity_version.get("m_EditorVersion", "unknow")
-if re.search(r"t\d+$", version_string) and TUANJIE_HUB:
-    path = os.path.join(TUANJIE_HUB, version_string)
-    if os.path.exists(path):
-        if is_win_platform():
-            UNITY_PATH = os.path.join(path, "Tuanjie.exe")
-            if not os.path.exists(UNITY_PATH):
-                UNITY_PATH = os.path.join(path, "Editor", "Tuanjie.exe")
-        else:
-            UNITY_PATH = os.path.join(path, "Tuanjie.app", "Contents", "MacOS", "Tuanjie")
-        log.info("Set UNITY_PATH to hub version " + UNITY_PATH)
-    else:
-        log.info("Cannot find file with %s" % (path))
-elif UNITY_HUB:
-    path = os.path.join(UNITY_HUB, version_string)
-    if os.path.exists(path):
+
+
+class UnityToolchain(object):
+    """编辑器路径等环境参数，第一次使用时才解析，之后在进程内缓存"""
+    unity_hub = None
+    tuanjie_hub = None
+    unity_path = None
+    unity_version = None
+    version_string = "unknow"
+
+    def resolve(self):
+        self.unity_hub = os.environ.get("UNITY_HUB", None)
+        self.tuanjie_hub = os.environ.get("TUANJIE_HUB", None)
+        self.unity_path = os.environ.get("UNITY_PATH", None)
+        log.info('PROTJECT_PATH="%s"' % (PROTJECT_PATH))
+        log.info('UNITY_HUB="%s"' % (self.unity_hub))
+        log.info('TUANJIE_HUB="%s"' % (self.tuanjie_hub))
+        log.info('UNITY_PATH="%s"' % (self.unity_path))
+
+        version_file = os.path.join(PROTJECT_PATH, "ProjectSettings", "ProjectVersion.txt")
+        self.unity_version = get_unity_dict(version_file) if os.path.exists(version_file) else dict()
+        log.info('unity_version="%s"' % (self.unity_version))
+        self.version_string = self.unity_version.get("m_EditorVersion", "unknow")
+        if re.search(r"t\d+$", self.version_string) and self.tuanjie_hub:
+            self.resolve_hub_path(self.tuanjie_hub, "Tuanjie")
+        elif self.unity_hub:
+            self.resolve_hub_path(self.unity_hub, "Unity")
+        return self
+
+    def resolve_hub_path(self, hub, name):
+        path = os.path.join(hub, self.version_string)
+        if not os.path.exists(path):
+            log.info("Cannot find file with %s" % (path))
+            return
         if is_win_platform():
-            UNITY_PATH = os.path.join(path, "Unity.exe")
-            if not os.path.exists(UNITY_PATH):
-                UNITY_PATH = os.path.join(path, "Editor", "Unity.exe")
+            self.unity_path = os.path.join(path, name + ".exe")
+            if not os.path.exists(self.unity_path):
+                self.unity_path = os.path.join(path, "Editor", name + ".exe")
         else:
-            UNITY_PATH = os.path.join(path, "Unity.app", "Contents", "MacOS", "Unity")
-        log.info("Set UNITY_PATH to hub version " + UNITY_PATH)
-    else:
-        log.info("Cannot find file with %s" % (path))
+            self.unity_path = os.path.join(path, name + ".app", "Contents", "MacOS", name)
+        log.info("Set UNITY_PATH to hub version " + self.unity_path)
+
+
+_toolchain = None
 
-if not UNITY_PATH or not os.path.exists(UNITY_PATH):
-    FAILURE("请先设置正确的UNITY_PATH或UNITY_HUB目录")
 
-if is_win_platform():
-    UNITY_PATH = '"%s"' % UNITY_PATH
+def get_toolchain():
+    global _toolchain
+    if _toolchain is None:
+        _toolchain = UnityToolchain().resolve()
+    return _toolchain
+
+
+def get_unity_path():
+    unity_path = get_toolchain().unity_path
+    if not unity_path or not os.path.exists(unity_path):
+        FAILURE("请先设置正确的UNITY_PATH或UNITY_HUB目录")
+    return unity_path
 
 def check_path(path):
     if os.path.exists(path):
@@ -125,9 +364,126 @@ def check_path(path):
         return FAILURE('cannot create path::' + path)
 
 
-def execall(cmd):
+def execall(cmd, cwd=None, log_name=None, timeout=None):
     print('execall::: ', cmd)
-    return os.system(cmd)
+    return run_process(cmd, cwd=cwd, log_name=log_name, timeout=timeout).returncode
+
+
+# process runner==============================
+# 统一的进程执行：argv列表，输出同时写入控制台和日志文件，返回真实退出码，支持超时
+
+STEP_TIMEOUTS = {
+    "unity": 4 * 3600,
+    "gradle": 2 * 3600,
+    "pod": 3600,
+    "xcodebuild": 3 * 3600,
+    "java": 3600,
+    "symbols": 3600,
+}
+
+# 不为空时外部命令的输出会额外写入该目录下的日志文件
+ProcessLogPath = None
+
+
+def get_process_log_path():
+    return vars(_build_local).get("log_path", ProcessLogPath)
+
+
+def get_step_timeout(step):
+    '''步骤超时秒数，可通过环境变量 PLUGINLIT_TIMEOUT_<STEP> 覆盖，0表示不限制'''
+    value = os.environ.get("PLUGINLIT_TIMEOUT_%s" % step.upper(), None)
+    if value is not None:
+        return float(value) or None
+    return STEP_TIMEOUTS.get(step, None)
+
+
+class ProcessResult(object):
+    args = None
+    returncode = -1
+    timed_out = False
+    duration = 0.0
+    log_file = None
+
+    def __init__(self, args):
+        from collections import deque
+        self.args = args
+        self.tail = deque(maxlen=50)
+
+    def ok(self):
+        return self.returncode == 0
+
+    def __str__(self):
+        if self.timed_out:
+            return "timeout after %.0fs" % self.duration
+        return "exit code %d after %.0fs" % (self.returncode, self.duration)
+
+
+def kill_process_tree(proc):
+    import subprocess
+    if is_win_platform():
+        subprocess.call(["taskkill", "/T", "/F", "/PID", str(proc.pid)])
+        return
+    import signal
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+def run_process(args, cwd=None, log_name=None, timeout=None, env=None, echo=True, on_line=None):
+    '''执行外部命令，args为argv列表(字符串时通过shell执行)，log_name为ProcessLogPath下的日志文件名，
+    on_line为每行输出的回调，超时会结束整个进程树'''
+    import subprocess
+    result = ProcessResult(args)
+    log_path = get_process_log_path()
+    if log_name and log_path:
+        check_path(log_path)
+        result.log_file = os.path.join(log_path, log_name)
+    shell = isinstance(args, str)
+    kwargs = dict()
+    if not is_win_platform():
+        kwargs["start_new_session"] = True
+    start = time.time()
+    proc = subprocess.Popen(args, cwd=cwd, env=env, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    log_fp = open(result.log_file, 'a', encoding='UTF-8') if result.log_file else None
+
+    def pump():
+        for raw in iter(proc.stdout.readline, b""):
+            line = raw.decode('UTF-8', errors='replace').rstrip("\r\n")
+            result.tail.append(line)
+            if echo:
+                print(line, flush=True)
+            if log_fp:
+                log_fp.write(line + "\n")
+            if on_line:
+                on_line(line)
+
+    reader = threading.Thread(target=pump, daemon=True)
+    reader.start()
+    try:
+        result.returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        result.timed_out = True
+        kill_process_tree(proc)
+        result.returncode = proc.wait()
+    finally:
+        reader.join(10)
+        proc.stdout.close()
+        if log_fp:
+            log_fp.close()
+    result.duration = time.time() - start
+    if result.timed_out or result.returncode != 0:
+        print("process %s: %s" % (args[0] if not shell else args, result))
+    return result
+
+
+def run_step(step, args, cwd=None, log_name=None, **kwargs):
+    '''以步骤配置的超时执行命令，失败或超时立即FAILURE'''
+    print('run %s::: %s' % (step, args if isinstance(args, str) else " ".join(args)))
+    result = run_process(args, cwd=cwd, log_name=log_name, timeout=get_step_timeout(step), **kwargs)
+    if not result.ok():
+        FAILURE("%s fail with %s" % (step, result))
+    return result
 
 
 def rm_dir(dir):
@@ -145,13 +501,336 @@ def rm_file(file):
         os.remove(file)
 
 
+def get_cache_path(*names):
+    '''构建缓存目录，默认为 Build/.cache，可通过环境变量 PLUGINLIT_CACHE 指定'''
+    root = os.environ.get("PLUGINLIT_CACHE", None) or os.path.join(PROTJECT_PATH, "Build", ".cache")
+    return os.path.join(root, *names)
+
+
+class FileHasher(object):
+    '''文件摘要服务：分块读取，按(路径, inode, 大小, 修改时间)缓存到磁盘，可用线程池批量计算
+    磁盘缓存按(算法, 摘要长度)区分，有新记录时才保存，保存时去掉已失效的记录，超过max_entries时淘汰最久未使用的'''
+    algorithm = "md5"
+    digest_length = 6
+    chunk_size = 1024 * 1024
+    workers = 0
+    cache_path = None
+    max_entries = int(os.environ.get("PLUGINLIT_HASH_CACHE_MAX", 200000))
+
+    def __init__(self, algorithm="md5", digest_length=6, cache_path=None, workers=0):
+        self.algorithm = algorithm
+        self.digest_length = digest_length
+        self.cache_path = cache_path
+        self.workers = workers or min(8, os.cpu_count() or 2)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._cache = load_json_manifest(cache_path).get(self.get_cache_key(), dict()) if cache_path else dict()
+
+    def get_cache_key(self):
+        # blake2b的摘要长度不同结果也不同
+        return "%s:%d" % (self.algorithm, self.digest_length)
+
+    def new_digest(self):
+        if self.algorithm == "blake2b":
+            return hashlib.blake2b(digest_size=max(1, min(64, (self.digest_length + 1) // 2)))
+        return hashlib.new(self.algorithm)
+
+    def digest(self, path):
+        '''完整的十六进制摘要'''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        record = self._cache.get(path)
+        if record and record[:3] == key:
+            with self._lock:
+                # 移到末尾，保存时按插入顺序淘汰，只调整顺序不需要保存
+                self._cache[path] = self._cache.pop(path, record)
+            return record[3]
+
+        digest = self.new_digest()
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                digest.update(view[:size])
+        value = digest.hexdigest()
+        with self._lock:
+            self._cache[path] = key + [value]
+            self._dirty = True
+        return value
+
+    def short_digest(self, path):
+        '''截取digest_length长度的摘要，用于文件重命名'''
+        return self.digest(path)[0:self.digest_length]
+
+    def digest_files(self, paths):
+        '''并行计算一批文件的摘要，返回 {路径: 完整摘要}'''
+        paths = list(paths)
+        if len(paths) <= 1 or self.workers <= 1:
+            return dict((path, self.digest(path)) for path in paths)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(paths, executor.map(self.digest, paths)))
+
+    def save(self):
+        if not self.cache_path or not self._dirty:
+            return
+        with self._lock:
+            self.prune()
+            data = load_json_manifest(self.cache_path)
+            data[self.get_cache_key()] = self._cache
+            save_json_manifest(self.cache_path, data)
+            self._dirty = False
+
+    def prune(self):
+        '''去掉文件已删除或已修改的记录，并只保留最近使用的max_entries条'''
+        cache = dict()
+        for path, record in self._cache.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if record[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+                cache[path] = record
+        if len(cache) > self.max_entries:
+            cache = dict(list(cache.items())[-self.max_entries:])
+        self._cache = cache
+
+
+_file_hasher = None
+
+
+def get_file_hasher():
+    '''默认的md5摘要服务，缓存位于 Build/.cache/hashes.json'''
+    global _file_hasher
+    if _file_hasher is None:
+        _file_hasher = FileHasher(cache_path=get_cache_path("hashes.json"))
+    return _file_hasher
+
+
 def file_md5(path):
-    with open(path, 'rb') as f:
-        sha = hashlib.md5(f.read()).hexdigest()
-        return sha[0:6]
+    return get_file_hasher().short_digest(path)
+
+
+# directory cache==============================
+# 进程间文件锁与按key保存目录的LRU缓存
+
+class FileLock(object):
+    '''基于flock(windows为msvcrt.locking)的进程间排他锁'''
+    fd = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def acquire(self, blocking=True):
+        check_path(os.path.dirname(self.path))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if is_win_platform():
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            if blocking:
+                raise
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        if is_win_platform():
+            import msvcrt
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def get_dir_size(path):
+    size = 0
+    for _, entry in scan_files(path):
+        try:
+            size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return size
+
+
+class DirectoryCache(object):
+    '''按key保存目录的LRU缓存：使用中的条目加锁，同一key被其他进程占用时使用副本目录，
+    总大小超过max_bytes时淘汰最久未使用且未被占用的条目'''
+    # 同一key最多的目录数
+    slots = 4
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(root, "index.json")
+
+    def get_entry_path(self, name):
+        return os.path.join(self.root, name)
+
+    def get_entry_lock(self, name):
+        return FileLock(os.path.join(self.root, name + ".lock"))
+
+    def get_index_lock(self):
+        return FileLock(os.path.join(self.root, "index.lock"))
+
+    def update_index(self, name, **values):
+        with self.get_index_lock():
+            index = load_json_manifest(self.index_file)
+            record = index.setdefault(name, dict())
+            record.update(values)
+            record["lastUsed"] = time.time()
+            save_json_manifest(self.index_file, index)
+
+    def is_cached(self, name):
+        record = load_json_manifest(self.index_file).get(name, None)
+        return record is not None and record.get("size", 0) > 0 and os.path.isdir(self.get_entry_path(name))
+
+    @contextlib.contextmanager
+    def use(self, key, create=True, **meta):
+        '''占用key对应的目录，返回(目录, 是否已有缓存内容)
+        create为假时只占用已有缓存内容的目录，没有时返回(None, False)且不在索引中登记'''
+        names = [key if slot == 0 else "%s.%d" % (key, slot) for slot in range(self.slots)]
+        if not create:
+            names = [name for name in names if self.is_cached(name)]
+            if not names:
+                yield None, False
+                return
+        lock = None
+        for name in names:
+            lock = self.get_entry_lock(name)
+            if lock.acquire(blocking=False):
+                break
+        else:
+            name = names[0]
+            lock = self.get_entry_lock(name)
+            print("wait for cache entry", name)
+            lock.acquire()
+        path = self.get_entry_path(name)
+        if not create and not self.is_cached(name):
+            # 等待期间条目被淘汰了
+            lock.release()
+            yield None, False
+            return
+        try:
+            warm = self.is_cached(name)
+            if not warm:
+                # 中断构建留下的不完整目录
+                rm_dir(path)
+            check_path(path)
+            self.update_index(name, key=key, **meta)
+            yield path, warm
+        finally:
+            self.update_index(name, size=get_dir_size(path))
+            lock.release()
+            self.evict()
+
+    def evict(self):
+        '''淘汰最久未使用的条目直到总大小不超过max_bytes，返回淘汰的条目'''
+        removed = []
+        with self.get_index_lock():
+            index = load_json_manifest(self.index_file)
+            # 空的条目(如损坏后清空的)没有缓存内容，未被占用时直接删除记录
+            for name, record in list(index.items()):
+                if record.get("size", 0) > 0:
+                    continue
+                lock = self.get_entry_lock(name)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    rm_dir(self.get_entry_path(name))
+                finally:
+                    lock.release()
+                del index[name]
+                removed.append(name)
+            total = sum(record.get("size", 0) for record in index.values())
+            for name, record in sorted(index.items(), key=lambda item: item[1].get("lastUsed", 0)):
+                if total <= self.max_bytes:
+                    break
+                lock = self.get_entry_lock(name)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    rm_dir(self.get_entry_path(name))
+                finally:
+                    lock.release()
+                total -= record.get("size", 0)
+                del index[name]
+                removed.append(name)
+            if removed:
+                save_json_manifest(self.index_file, index)
+        for name in removed:
+            print("evict cache entry", name)
+        return removed
+
+
+def get_md5_file_name(name, sha):
+    name_list = name.split('.')
+    index_max = len(name_list) - 1
+    return '%s_%s.%s' % ('.'.join(name_list[0:index_max]), sha, name_list[index_max])
+
+
+def link_or_copy_file(src, dst, link="hard"):
+    '''link为hard时创建硬链接，为reflink时尝试写时复制克隆，失败或为空时复制文件'''
+    try:
+        if link == "hard":
+            os.link(src, dst)
+            return
+        if link == "reflink":
+            reflink_file(src, dst)
+            return
+    except OSError:
+        rm_file(dst)
+    shutil.copy2(src, dst)
+
+
+def copy_tree(src, dst, link=None):
+    '''复制目录并保留符号链接，link同link_or_copy_file，macOS上reflink时整个目录一次克隆'''
+    rm_dir(dst)
+    if link == "reflink" and sys.platform == "darwin":
+        import subprocess
+        if subprocess.call(["cp", "-cR", src, dst]) == 0:
+            return
+        rm_dir(dst)
+    shutil.copytree(src, dst, symlinks=True, copy_function=lambda a, b: link_or_copy_file(a, b, link))
 
 
-def copy_file(src, dst, md5=False):
+def reflink_file(src, dst):
+    if sys.platform == "darwin":
+        import subprocess
+        if subprocess.call(["cp", "-c", src, dst]) != 0:
+            raise OSError("clonefile fail: " + src)
+        return
+    if os.name != "posix":
+        # Windows没有fcntl，由调用方退回到复制
+        raise OSError("reflink is not supported on " + sys.platform)
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as r, open(dst, 'wb') as w:
+        fcntl.ioctl(w.fileno(), FICLONE, r.fileno())
+
+
+def copy_file(src, dst, md5=False, hasher=None):
     '''拷贝文件至目标文件，返回目标文件的全目录'''
     if not os.path.exists(src):
         return
@@ -160,77 +839,320 @@ def copy_file(src, dst, md5=False):
     dstdir, dstname = os.path.split(dst)
     check_path(dstdir)
     if md5:
-        sha = file_md5(src)
-        name_list = dstname.split('.')
-        index_max = len(name_list) - 1
-        new_name = '%s_%s.%s' % ('.'.join(name_list[0:index_max]), sha, name_list[index_max])
-        dst = os.path.join(dstdir, new_name)
+        hasher = hasher or get_file_hasher()
+        dst = os.path.join(dstdir, get_md5_file_name(dstname, hasher.short_digest(src)))
     shutil.copy(src, dst)
     return dst
 
 
+# tree walking==============================
+# 统一的os.scandir遍历，用DirEntry缓存的类型信息，不再对每个条目额外stat；支持include/exclude通配、跳过名称和线程池分发
+
+WALK_SKIP_NAMES = {'.DS_Store'}
+
+
+class WalkStats(object):
+    '''一次遍历的统计'''
+    dirs = 0
+    files = 0
+    skipped = 0
+
+    def __init__(self):
+        self.start = time.time()
+
+    def __str__(self):
+        return "walked %d dirs, %d files, skipped %d in %.2fs" % (self.dirs, self.files, self.skipped, time.time() - self.start)
+
+
+def match_patterns(rel, name, patterns):
+    '''通配符同时匹配相对路径和文件名'''
+    return any(fnmatch.fnmatchcase(rel, pattern) or fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def walk_tree(path, include=None, exclude=None, skip_names=None, exclude_paths=None, dirs=False, sort=False
+              , stats=None, rel_path=""):
+    '''遍历目录，返回(相对路径, DirEntry)
+    include只筛选文件，exclude、skip_names(名称)和exclude_paths(完整路径)对文件和目录都生效，被排除的目录不再进入；
+    dirs为真时目录也会返回且先于其内容，sort为真时按名称排序，stats为WalkStats'''
+    include = tuple(include or ())
+    exclude = tuple(exclude or ())
+    skip_names = skip_names or ()
+    exclude_paths = exclude_paths or ()
+    if stats:
+        stats.dirs += 1
+    # 先读完当前目录再进入子目录，深层目录不会同时占用多个句柄
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name) if sort else list(it)
+    for entry in entries:
+        rel = entry.name if not rel_path else rel_path + "/" + entry.name
+        if entry.name in skip_names or entry.path in exclude_paths or (exclude and match_patterns(rel, entry.name, exclude)):
+            if stats:
+                stats.skipped += 1
+            continue
+        if entry.is_dir():
+            if dirs:
+                yield rel, entry
+            yield from walk_tree(entry.path, include, exclude, skip_names, exclude_paths, dirs, sort, stats, rel)
+        elif not include or match_patterns(rel, entry.name, include):
+            if stats:
+                stats.files += 1
+            yield rel, entry
+        elif stats:
+            stats.skipped += 1
+
+
+def walk_parallel(func, path, jobs=0, **kwargs):
+    '''遍历目录，在线程池中对每个文件的(相对路径, DirEntry)执行func，按遍历顺序返回结果，kwargs同walk_tree；
+    dirs为真时目录在当前线程中执行func，保证先于目录中的内容完成'''
+    from concurrent.futures import ThreadPoolExecutor, Future
+    with ThreadPoolExecutor(max_workers=jobs or min(8, os.cpu_count() or 2)) as executor:
+        futures = []
+        for rel, entry in walk_tree(path, **kwargs):
+            if entry.is_dir():
+                future = Future()
+                future.set_result(func(rel, entry))
+            else:
+                future = executor.submit(func, rel, entry)
+            futures.append(future)
+        return [future.result() for future in futures]
+
+
 def clear_ds_store(path):
     if os.path.isfile(path):
         if path.endswith('.DS_Store'):
             rm_file(path)
     else:
-        for name in os.listdir(path):
-            sub_path = os.path.join(path, name)
-            if name == '.DS_Store':
-                rm_file(sub_path)
-            elif os.path.isdir(sub_path):
-                clear_ds_store(sub_path)
+        for _, entry in list(walk_tree(path, include=WALK_SKIP_NAMES)):
+            rm_file(entry.path)
+
+
+class CopyResult(object):
+    '''copy_path的结果统计，file_map为 源文件->目标文件'''
+    copied = 0
+    skipped = 0
+    deleted = 0
+    copied_bytes = 0
+    skipped_bytes = 0
+    deleted_bytes = 0
 
+    def __init__(self, file_map=None):
+        self.file_map = file_map if file_map is not None else dict()
 
-def copy_path(src, dst, merge=False, md5=False, file_map=dict(), exclude_paths=set(), skip_files=set()):
-    '''拷贝文件夹至目标文件夹中，如果merge为真则不会移除目录文件夹中多余的文件'''
-    skip_files.add('.DS_Store')
+    def __str__(self):
+        return "copied %d files (%d bytes), skipped %d files (%d bytes), deleted %d files (%d bytes)" % (
+            self.copied, self.copied_bytes, self.skipped, self.skipped_bytes, self.deleted, self.deleted_bytes)
+
+
+def copy_path(src, dst, merge=False, md5=False, file_map=None, exclude_paths=None, skip_files=None
+              , incremental=False, manifest_path=None, hash_check=False, link=None, hasher=None, keep_paths=None):
+    '''拷贝文件夹至目标文件夹中，如果merge为真则不会移除目录文件夹中多余的文件
+    incremental为真时对比清单(manifest_path，默认为 dst.manifest.json)只拷贝有变化的文件、只删除多余的文件，
+    hash_check为真时大小相同但修改时间变化的文件再比较内容摘要，link可选 hard/reflink，hasher为摘要服务，
+    keep_paths为增量同步时目标目录中不删除的路径'''
+    result = CopyResult(file_map)
+    exclude_paths = set(exclude_paths or ())
+    skip_files = set(skip_files or ())
+    skip_files.update(WALK_SKIP_NAMES)
     if not os.path.exists(src):
         print('not find path ', src)
-        return
+        return result
     check_path(dst)
-    for name in os.listdir(src):
-        from_path = os.path.join(src, name)
-        to_path = os.path.join(dst, name)
-        if os.path.isdir(from_path):
-            if exclude_paths.__contains__(from_path):
-                continue
+    hasher = hasher or get_file_hasher()
+    if md5:
+        hasher.digest_files(entry.path for _, entry in scan_files(src, "", exclude_paths, skip_files))
+    if incremental:
+        sync_path(src, dst, result, merge, md5, exclude_paths, skip_files, manifest_path, hash_check, link, hasher, keep_paths)
+    else:
+        copy_path_full(src, dst, result, merge, md5, exclude_paths, skip_files, hasher)
+    hasher.save()
+    return result
+
+
+def copy_path_full(src, dst, result, merge, md5, exclude_paths, skip_files, hasher):
+    check_path(dst)
+    for rel, entry in walk_tree(src, skip_names=skip_files, exclude_paths=exclude_paths, dirs=True):
+        to_path = os.path.join(dst, rel)
+        if entry.is_dir():
             if not merge:
                 rm_dir(to_path)
-            copy_path(from_path, to_path, merge, md5, file_map, exclude_paths, skip_files)
+            check_path(to_path)
         else:
-            if exclude_paths.__contains__(from_path):
+            result.file_map[entry.path] = copy_file(entry.path, to_path, md5, hasher)
+            result.copied += 1
+            result.copied_bytes += entry.stat().st_size
+
+
+def scan_files(path, rel_path="", exclude_paths=(), skip_files=()):
+    '''遍历目录下的文件，返回(相对路径, DirEntry)'''
+    return walk_tree(path, skip_names=skip_files, exclude_paths=exclude_paths, rel_path=rel_path)
+
+
+def load_json_manifest(path):
+    if not path or not os.path.exists(path):
+        return dict()
+    try:
+        return parseJsonFile(path) or dict()
+    except Exception as err:
+        print("ignore broken manifest", path, err)
+        return dict()
+
+
+def save_json_manifest(path, data):
+    check_path(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='UTF-8') as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def sync_path(src, dst, result, merge, md5, exclude_paths, skip_files, manifest_path, hash_check, link, hasher, keep_paths=None):
+    if manifest_path is None:
+        manifest_path = dst.rstrip("/\\") + ".manifest.json"
+    old_files = load_json_manifest(manifest_path).get("files", dict())
+    new_files = dict()
+    for rel, entry in scan_files(src, "", exclude_paths, skip_files):
+        st = entry.stat()
+        record = old_files.get(rel)
+        dst_file = os.path.join(dst, record["dst"]) if record else None
+        unchanged = False
+        if record and os.path.exists(dst_file) and os.path.getsize(dst_file) == st.st_size \
+                and record["size"] == st.st_size:
+            if record["mtime"] == st.st_mtime_ns:
+                unchanged = True
+            elif (hash_check or md5) and record.get("hash"):
+                digest = hasher.digest(entry.path)
+                unchanged = digest == record["hash"]
+                record = dict(record, hash=digest)
+        if unchanged:
+            record = dict(record, mtime=st.st_mtime_ns)
+            result.skipped += 1
+            result.skipped_bytes += st.st_size
+        else:
+            digest = hasher.digest(entry.path) if (hash_check or md5) else None
+            rel_dst = rel
+            if md5:
+                head, name = os.path.split(rel)
+                rel_dst = os.path.join(head, get_md5_file_name(name, digest[0:hasher.digest_length])).replace("\\", "/")
+            dst_file = os.path.join(dst, rel_dst)
+            check_path(os.path.dirname(dst_file))
+            rm_file(dst_file)
+            link_or_copy_file(entry.path, dst_file, link)
+            record = {"size": st.st_size, "mtime": st.st_mtime_ns, "dst": rel_dst}
+            if digest:
+                record["hash"] = digest
+            result.copied += 1
+            result.copied_bytes += st.st_size
+        new_files[rel] = record
+        result.file_map[entry.path] = dst_file
+
+    if not merge:
+        keep = set(os.path.normpath(record["dst"]) for record in new_files.values())
+        for rel, entry in list(scan_files(dst, "", set(keep_paths or ()))):
+            if os.path.normpath(rel) in keep:
                 continue
-            if skip_files.__contains__(name):
+            result.deleted += 1
+            result.deleted_bytes += entry.stat().st_size
+            os.remove(entry.path)
+        remove_empty_dirs(dst)
+
+    save_json_manifest(manifest_path, {"src": src, "files": new_files})
+
+
+def remove_empty_dirs(path, remove_root=False):
+    empty = True
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False) and remove_empty_dirs(entry.path, True):
                 continue
-            file_map[from_path] = copy_file(from_path, to_path, md5)
+            empty = False
+    if empty and remove_root:
+        os.rmdir(path)
+    return empty
+
+
+# template rendering==============================
+# {{key}}占位符编译为一个正则，每个文件只扫描一次；大文件分块流式处理，块之间保留可能被截断的占位符；开头含NUL的视为二进制直接拷贝
+
+TEMPLATE_CHUNK_SIZE = 1024 * 1024
+TEMPLATE_SNIFF_SIZE = 8000
+
+
+class TemplateRenderer(object):
+    '''用params替换{{key}}，params中没有的占位符原样保留'''
+    chunk_size = TEMPLATE_CHUNK_SIZE
+    pattern = None
+    max_length = 0
+
+    def __init__(self, params=None):
+        self.values = dict((("{{%s}}" % key).encode('UTF-8'), str(value).encode('UTF-8'))
+                           for key, value in (params or dict()).items())
+        if self.values:
+            keys = sorted(self.values, key=len, reverse=True)
+            self.pattern = re.compile(b"|".join(re.escape(key) for key in keys))
+            self.max_length = len(keys[0])
+
+    def render_bytes(self, data, final=True):
+        '''替换data中的占位符，返回 (输出, 尾部)，final为假时尾部可能是被截断的占位符，需要拼到下一块前面'''
+        if self.pattern is None:
+            return data, b""
+        limit = len(data) if final else max(0, len(data) - self.max_length + 1)
+        output = []
+        pos = 0
+        for match in self.pattern.finditer(data):
+            if match.start() >= limit:
+                break
+            output.append(data[pos:match.start()])
+            output.append(self.values[match.group(0)])
+            pos = match.end()
+        if pos < limit:
+            output.append(data[pos:limit])
+            pos = limit
+        return b"".join(output), data[pos:]
+
+    def render(self, text):
+        if self.pattern is None or "{{" not in text:
+            return text
+        return self.render_bytes(text.encode('UTF-8'))[0].decode('UTF-8')
+
+    def render_file(self, src, dst):
+        '''渲染src到dst，返回是否按文本处理'''
+        with open(src, 'rb') as r:
+            chunk = r.read(self.chunk_size)
+            if self.pattern is None or b"\0" in chunk[:TEMPLATE_SNIFF_SIZE]:
+                r.close()
+                shutil.copyfile(src, dst)
+                shutil.copymode(src, dst)
+                return False
+            with open(dst, 'wb') as w:
+                tail = b""
+                while chunk:
+                    next_chunk = r.read(self.chunk_size)
+                    output, tail = self.render_bytes(tail + chunk, not next_chunk)
+                    w.write(output)
+                    chunk = next_chunk
+        shutil.copymode(src, dst)
+        return True
 
 
-def copy_path_ex(src, dst, params, merge=False):
-    '''拷贝文件夹至目标文件夹中，根据params修改文件名和文件内容，如果merge为真则不会移除目录文件夹中多余的文件'''
+def copy_path_ex(src, dst, params, merge=False, jobs=0):
+    '''拷贝文件夹至目标文件夹中，根据params修改文件名和文件内容，如果merge为真则不会移除目录文件夹中多余的文件，返回WalkStats'''
     if not os.path.exists(src):
         return
-    for name in os.listdir(src):
-        from_path = os.path.join(src, name)
-        to_path = os.path.join(dst, name)
-        if os.path.isdir(from_path):
-            if not os.path.exists(to_path):
-                os.mkdir(to_path)
-            else:
-                if not merge:
-                    rm_dir(to_path)
-            copy_path_ex(from_path, to_path, params, merge)
-        else:
-            with open(from_path, 'r', encoding='UTF-8') as f:
-                try:
-                    content = f.read()
-                    if not content:
-                        copy_file(from_path, to_path)
-                    else:
-                        with open(to_path, 'w', encoding='UTF-8') as w:
-                            w.write(content)
-                except Exception as identifier:
-                    copy_file(from_path, to_path)
+    renderer = params if isinstance(params, TemplateRenderer) else TemplateRenderer(params)
+    stats = WalkStats()
+    check_path(dst)
+
+    def render(rel, entry):
+        to_path = os.path.join(dst, renderer.render(rel))
+        if not entry.is_dir():
+            return renderer.render_file(entry.path, to_path)
+        # 目录在遍历线程中创建，其中的文件之后才会渲染
+        if not merge:
+            rm_dir(to_path)
+        check_path(to_path)
+
+    walk_parallel(render, src, jobs, dirs=True, stats=stats)
+    return stats
 
 
 def parseJsonFile(path):
@@ -250,12 +1172,124 @@ def resaveJsonFile(path):
 
 
 def transformJsonDir(path):
-    for name in os.listdir(path):
-        sub_path = os.path.join(path, name)
-        if os.path.isdir(sub_path):
-            transformJsonDir(sub_path)
+    compact_json_dir(path)
+
+
+# json compaction==============================
+# 按扩展名筛选，进程池中解析压缩，内容变化时才原子写回；manifest记录处理后的(大小, 修改时间)，未改动的文件直接跳过
+
+JSON_EXTS = (".json",)
+JSON_PROCESS_MIN_FILES = 64
+
+
+class JsonCompactResult(object):
+    '''compact_json_dir的结果统计，failures为 [(路径, 错误)]'''
+    total = 0
+    skipped = 0
+    compacted = 0
+    unchanged = 0
+    saved_bytes = 0
+
+    def __init__(self):
+        self.failures = []
+
+    def __str__(self):
+        return "%d files, compacted %d (saved %d bytes), unchanged %d, skipped %d, failed %d" % (
+            self.total, self.compacted, self.saved_bytes, self.unchanged, self.skipped, len(self.failures))
+
+
+def compact_json_file(path, ensure_ascii=True):
+    '''压缩单个JSON文件，返回 (原大小, 新大小, 是否写入, 错误)，内容不变时不写入'''
+    size = 0
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        size = len(content)
+        data = json.loads(content.decode('utf-8-sig'))
+        output = json.dumps(data, separators=(",", ":"), ensure_ascii=ensure_ascii).encode('UTF-8')
+        if output != content:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(output)
+            os.replace(tmp_path, path)
+        return size, len(output), output != content, None
+    except Exception as err:
+        return size, size, False, "%s: %s" % (type(err).__name__, err)
+
+
+def map_files(func, paths, jobs=0):
+    '''CPU密集的批量文件处理，文件较多时用进程池，进程池不可用时退回线程池'''
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    jobs = jobs or os.cpu_count() or 2
+    if jobs > 1 and len(paths) >= JSON_PROCESS_MIN_FILES:
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                return list(executor.map(func, paths, chunksize=max(1, len(paths) // (jobs * 4))))
+        except (OSError, ImportError, AttributeError, TypeError, BrokenProcessPool) as err:
+            print("process pool unavailable, fallback to threads:", err)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, paths))
+
+
+def compact_json_dir(path, exts=JSON_EXTS, jobs=0, manifest_path=None, force=False, ensure_ascii=True):
+    '''压缩目录下的JSON文件，返回JsonCompactResult'''
+    import functools
+    start = time.time()
+    path = os.path.abspath(path)
+    if manifest_path is None:
+        manifest_path = get_cache_path("json", hashlib.md5(path.encode('UTF-8')).hexdigest() + ".json")
+    manifest = load_json_manifest(manifest_path)
+    old_files = manifest.get("files", dict()) if not force and manifest.get("ascii") == ensure_ascii else dict()
+
+    result = JsonCompactResult()
+    new_files = dict()
+    paths = []
+    for rel, entry in walk_tree(path, skip_names=WALK_SKIP_NAMES):
+        if not entry.name.lower().endswith(exts):
+            continue
+        result.total += 1
+        st = entry.stat()
+        record = [st.st_size, st.st_mtime_ns]
+        if old_files.get(rel) == record:
+            result.skipped += 1
+            new_files[rel] = record
         else:
-            resaveJsonFile(sub_path)
+            paths.append(rel)
+
+    outputs = map_files(functools.partial(compact_json_file, ensure_ascii=ensure_ascii),
+                        [os.path.join(path, rel) for rel in paths], jobs) if paths else []
+    for rel, (size, new_size, written, error) in zip(paths, outputs):
+        if error:
+            result.failures.append((rel, error))
+            continue
+        if written:
+            result.compacted += 1
+            result.saved_bytes += size - new_size
+        else:
+            result.unchanged += 1
+        st = os.stat(os.path.join(path, rel))
+        new_files[rel] = [st.st_size, st.st_mtime_ns]
+
+    save_json_manifest(manifest_path, dict(ascii=ensure_ascii, files=new_files))
+    print("[json] %s: %s in %.2fs" % (path, result, time.time() - start))
+    for rel, error in result.failures:
+        print("[json] parse failed %s: %s" % (rel, error))
+    return result
+
+
+@task(help={
+    'path': "JSON文件所在目录",
+    'exts': "处理的扩展名，多个以逗号','隔开，默认为.json",
+    'jobs': "并行数量，默认为CPU核数",
+    'force': "忽略manifest，重新处理所有文件",
+})
+def compactJson(context, path, exts=".json", jobs=0, force=False):
+    '''压缩目录下的JSON文件'''
+    exts = tuple(ext.strip().lower() for ext in exts.split(",") if ext.strip())
+    result = compact_json_dir(path, exts, int(jobs), force=force)
+    if result.failures:
+        FAILURE("%d json files failed to parse" % len(result.failures))
 
 
 def encodeObjectParam(data):
@@ -284,22 +1318,210 @@ def copy_file_with_alter(src_path, dst_path, alter_func, params):
 
 
 def get_all_path(path, result):
-    for name in os.listdir(path):
-        sub_path = os.path.join(path, name)
-        if os.path.isdir(sub_path):
-            get_all_path(sub_path, result)
-        else:
-            result.append(sub_path)
+    result.extend(entry.path for _, entry in walk_tree(path))
 
 
-def zip_file(zip_path, zip_file):
-    all_files = []
-    get_all_path(zip_path, all_files)
-    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as f:
-        for path in all_files:
-            print('append zip file :: ', path)
-            f.write(path, os.path.relpath(path, zip_path))
-        f.close()
+# zip packaging==============================
+# 条目在线程池中压缩，按遍历顺序写入；已压缩格式直接存储；大文件在写入线程中流式处理
+
+ZIP_STORE_EXTS = {
+    ".png", ".jpg", ".jpeg", ".webp", ".ktx", ".astc", ".mp3", ".mp4", ".ogg", ".wav", ".m4a",
+    ".so", ".a", ".bundle", ".unity3d", ".ab", ".apk", ".aab", ".aar", ".ipa", ".jar",
+    ".zip", ".gz", ".xz", ".bz2", ".7z", ".br", ".unityweb",
+}
+ZIP_STREAM_THRESHOLD = 64 * 1024 * 1024
+# 线程池中已提交、还未写入的文件总大小上限，限制内存占用
+ZIP_PENDING_BYTES = 256 * 1024 * 1024
+ZIP_CHUNK_SIZE = 1024 * 1024
+ZIP64_LIMIT = 0x7FFFFFFF
+ZIP_FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+class ZipEntry(object):
+    name = ""
+    path = ""
+    size = 0
+    date_time = ZIP_FIXED_DATE
+    external_attr = 0
+    method = ZIP_DEFLATED
+    crc = 0
+    compress_size = 0
+    header_offset = 0
+    zip64 = False
+
+
+def walk_zip_entries(root, exclude_paths=None):
+    '''按名称排序流式遍历目录，返回(相对路径, DirEntry)'''
+    return walk_tree(root, exclude_paths=exclude_paths, sort=True)
+
+
+def deflate_file(path, level):
+    '''在工作线程中压缩整个文件，返回(压缩方式, crc, 数据)'''
+    import zlib
+    with open(path, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) >= len(data):
+        return ZIP_STORED, crc, data
+    return ZIP_DEFLATED, crc, compressed
+
+
+class ZipStreamWriter(object):
+    '''只写的zip输出，支持zip64，数据由调用方提供(预压缩或流式写入)'''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.entries = []
+
+    @staticmethod
+    def dos_time(date_time):
+        year, month, day, hour, minute, second = date_time[:6]
+        if year < 1980:
+            year, month, day, hour, minute, second = ZIP_FIXED_DATE
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    @staticmethod
+    def encode_name(name):
+        try:
+            return name.encode("ascii"), 0
+        except UnicodeEncodeError:
+            return name.encode("utf-8"), 0x800
+
+    def local_header(self, entry):
+        name, flags = self.encode_name(entry.name)
+        dos_time, dos_date = self.dos_time(entry.date_time)
+        if entry.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, entry.size, entry.compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = b""
+            sizes = (entry.compress_size, entry.size)
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if entry.zip64 else 20, flags, entry.method
+                           , dos_time, dos_date, entry.crc, sizes[0], sizes[1], len(name), len(extra)) + name + extra
+
+    def write_entry(self, entry, data):
+        entry.header_offset = self.fp.tell()
+        entry.compress_size = len(data)
+        entry.zip64 = entry.size > ZIP64_LIMIT or entry.compress_size > ZIP64_LIMIT
+        self.fp.write(self.local_header(entry))
+        self.fp.write(data)
+        self.entries.append(entry)
+
+    def write_entry_stream(self, entry, level):
+        '''流式写入大文件，写完后回填头部的crc与大小'''
+        import zlib
+        entry.header_offset = self.fp.tell()
+        entry.zip64 = entry.size > ZIP64_LIMIT // 2
+        self.fp.write(self.local_header(entry))
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if entry.method == ZIP_DEFLATED else None
+        crc = 0
+        compress_size = 0
+        with open(entry.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                compress_size += len(chunk)
+                self.fp.write(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            self.fp.write(chunk)
+        entry.crc = crc
+        entry.compress_size = compress_size
+        end = self.fp.tell()
+        self.fp.seek(entry.header_offset)
+        self.fp.write(self.local_header(entry))
+        self.fp.seek(end)
+        self.entries.append(entry)
+
+    def close(self):
+        cd_offset = self.fp.tell()
+        for entry in self.entries:
+            name, flags = self.encode_name(entry.name)
+            dos_time, dos_date = self.dos_time(entry.date_time)
+            zip64 = entry.zip64 or entry.header_offset > ZIP64_LIMIT
+            if zip64:
+                extra = struct.pack("<HHQQQ", 1, 24, entry.size, entry.compress_size, entry.header_offset)
+                values = (0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF)
+            else:
+                extra = b""
+                values = (entry.compress_size, entry.size, entry.header_offset)
+            self.fp.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | 45, 45 if zip64 else 20, flags
+                                      , entry.method, dos_time, dos_date, entry.crc, values[0], values[1]
+                                      , len(name), len(extra), 0, 0, 0, entry.external_attr, values[2]))
+            self.fp.write(name)
+            self.fp.write(extra)
+        cd_end = self.fp.tell()
+        cd_size = cd_end - cd_offset
+        count = len(self.entries)
+        if count > 0xFFFF or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            self.fp.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self.fp.write(struct.pack("<IIQI", 0x07064b50, 0, cd_end, 1))
+            count = min(count, 0xFFFF)
+            cd_size = min(cd_size, 0xFFFFFFFF)
+            cd_offset = min(cd_offset, 0xFFFFFFFF)
+        self.fp.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+@timed("zip")
+def zip_file(zip_path, zip_file, workers=0, reproducible=False, level=6, store_exts=None):
+    '''将目录打包为zip，workers为压缩线程数(默认CPU核数)，reproducible为真时使用固定的时间与权限'''
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    store_exts = ZIP_STORE_EXTS if store_exts is None else store_exts
+    workers = workers or os.cpu_count() or 2
+    total_size = 0
+    pending_bytes = 0
+    # 输出文件在打包目录中时不能把自己打进去
+    exclude_paths = {os.path.abspath(zip_file)}
+    with open(zip_file, 'wb') as fp, ThreadPoolExecutor(max_workers=workers) as executor:
+        writer = ZipStreamWriter(fp)
+        pending = deque()
+
+        def flush_one():
+            nonlocal pending_bytes
+            entry, future = pending.popleft()
+            if future is None:
+                writer.write_entry_stream(entry, level)
+            else:
+                entry.method, entry.crc, data = future.result()
+                writer.write_entry(entry, data)
+                pending_bytes -= entry.size
+
+        for rel, dir_entry in walk_zip_entries(os.path.abspath(zip_path), exclude_paths):
+            st = dir_entry.stat()
+            entry = ZipEntry()
+            entry.name = rel
+            entry.path = dir_entry.path
+            entry.size = st.st_size
+            total_size += st.st_size
+            if reproducible:
+                entry.date_time = ZIP_FIXED_DATE
+                entry.external_attr = (0o100755 if st.st_mode & 0o111 else 0o100644) << 16
+            else:
+                entry.date_time = time.localtime(st.st_mtime)[:6]
+                entry.external_attr = (st.st_mode & 0xFFFF) << 16
+            if os.path.splitext(rel)[1].lower() in store_exts:
+                entry.method = ZIP_STORED
+                pending.append((entry, None))
+            elif entry.size >= ZIP_STREAM_THRESHOLD:
+                pending.append((entry, None))
+            else:
+                pending.append((entry, executor.submit(deflate_file, entry.path, level)))
+                pending_bytes += entry.size
+            while len(pending) > workers * 2 or pending_bytes > ZIP_PENDING_BYTES:
+                flush_one()
+        while pending:
+            flush_one()
+        writer.close()
+    print('zip %d files (%d bytes) into %s (%d bytes)' % (len(writer.entries), total_size, zip_file, os.path.getsize(zip_file)))
+    return zip_file
+
 
 class ArchiveInfo(object):
     """<?xml version="1.0" encoding="UTF-8"?>
@@ -340,6 +1562,7 @@ class ArchiveInfo(object):
     scheme = ""
 
     def from_archive_path(self, archive_path):
+        import plistlib
         info_path = os.path.join(archive_path, "Info.plist")
         if not os.path.exists(info_path):
             return
@@ -379,6 +1602,8 @@ class BuildConfig(object):
     version_name = ""
     version_code = 0
     build_num = 0
+    # 渠道，用作DerivedData缓存的key
+    channel = ""
 
     name_ipa = ""
 
@@ -462,6 +1687,44 @@ class BuildConfig(object):
         return "\n".join(values)
 
 
+# xcode derived data cache==============================
+# DerivedData按渠道、工程名、scheme、configuration缓存在 get_cache_path("DerivedData") 下，重复构建可以增量编译
+
+# 可通过环境变量替换xcodebuild
+XCODEBUILD = os.environ.get("PLUGINLIT_XCODEBUILD", "xcodebuild")
+# 为假时使用 build/tmp/<build_num>，可通过环境变量 PLUGINLIT_DERIVED_DATA_CACHE=0 关闭
+UseDerivedDataCache = os.environ.get("PLUGINLIT_DERIVED_DATA_CACHE", "1") != "0"
+DERIVED_DATA_MAX_BYTES = int(float(os.environ.get("PLUGINLIT_DERIVED_DATA_MAX_GB", 30)) * 1024 ** 3)
+
+
+def get_derived_data_cache():
+    return DirectoryCache(get_cache_path("DerivedData"), DERIVED_DATA_MAX_BYTES)
+
+
+def get_derived_data_key(channel, project_path, scheme, configuration):
+    '''不使用工程的绝对路径，PLUGINLIT_WORKSPACE=0时每次导出到不同的build_<N>也能命中'''
+    digest = hashlib.sha1(("ios|%s|%s|%s|%s" % (channel, os.path.basename(os.path.normpath(project_path))
+                                                 , scheme, configuration)).encode('UTF-8'))
+    return "%s-%s-%s" % (re.sub(r"[^\w.-]", "_", scheme or "app"), configuration, digest.hexdigest()[:12])
+
+
+@contextlib.contextmanager
+def use_derived_data(build_config):
+    '''占用一个DerivedData目录，输出冷/热状态'''
+    if not UseDerivedDataCache:
+        yield build_config.get_derived_data_path()
+        return
+    project_path = build_config.path_project_ios
+    key = get_derived_data_key(build_config.channel or build_config.bundle_id, project_path, build_config.scheme
+                               , build_config.configuration)
+    with get_derived_data_cache().use(key, channel=build_config.channel, project=os.path.abspath(project_path), scheme=build_config.scheme
+                                      , configuration=build_config.configuration) as (path, warm):
+        state = "warm" if warm else "cold"
+        print("[derived data] %s %s" % (state, path))
+        get_build_timer().meta["derivedData"] = state
+        yield path
+
+
 class BuildToolIOS(object):
     build_config = None
     quiet = False
@@ -472,6 +1735,7 @@ class BuildToolIOS(object):
         self.quiet = quiet
         self.dry = dry
 
+    @timed("ios.archive")
     def ios_archive(self):
         code_sign_identity = self.build_config.cert
         provisioning_profile = self.build_config.profile
@@ -479,48 +1743,48 @@ class BuildToolIOS(object):
         project_path = self.build_config.path_project_ios
         scheme = self.build_config.scheme
         archive_path = self.build_config.generate_system_archive_path()
-        derived_data_path = self.build_config.get_derived_data_path()
         configuration = self.build_config.configuration
 
-        if project_path.endswith(".xcworkspace"):
-            cmds = [
-                "xcodebuild",
-                "archive",
-                "-workspace", project_path,
-                "-scheme", scheme,
-                "-archivePath", archive_path,
-                "-configuration", configuration,
-                "-derivedDataPath", derived_data_path,
-                "-allowProvisioningUpdates",
-            ]
-        else:
-            cmds = [
-                "xcodebuild",
-                "archive",
-                "-project", project_path,
-                "-scheme", scheme,
-                "-archivePath", archive_path,
-                "-configuration", configuration,
-                "-derivedDataPath", derived_data_path,
-                "-allowProvisioningUpdates",
-            ]
-
-        if code_sign_identity and provisioning_profile:
-            # cmds.append("CODE_SIGN_IDENTITY='{code_sign_identity}'".format(**locals()))
-            cmds.append("PROVISIONING_PROFILE_APP={provisioning_profile}".format(**locals()))
-            # cmds.append("CODE_SIGN_STYLE=Manual")
-
-        cmd = " ".join(cmds)
-        print(cmd)
-        self.run_print_result(cmd)
+        with use_derived_data(self.build_config) as derived_data_path:
+            if project_path.endswith(".xcworkspace"):
+                cmds = [
+                    XCODEBUILD,
+                    "archive",
+                    "-workspace", project_path,
+                    "-scheme", scheme,
+                    "-archivePath", archive_path,
+                    "-configuration", configuration,
+                    "-derivedDataPath", derived_data_path,
+                    "-allowProvisioningUpdates",
+                ]
+            else:
+                cmds = [
+                    XCODEBUILD,
+                    "archive",
+                    "-project", project_path,
+                    "-scheme", scheme,
+                    "-archivePath", archive_path,
+                    "-configuration", configuration,
+                    "-derivedDataPath", derived_data_path,
+                    "-allowProvisioningUpdates",
+                ]
+
+            if code_sign_identity and provisioning_profile:
+                # cmds.append("CODE_SIGN_IDENTITY='{code_sign_identity}'".format(**locals()))
+                cmds.append("PROVISIONING_PROFILE_APP={provisioning_profile}".format(**locals()))
+                # cmds.append("CODE_SIGN_STYLE=Manual")
+
+            self.run_print_result(cmds)
         return archive_path
 
+    @timed("ios.archive_export")
     def ios_archive_export(self, archive_path, archive_info, export_path, method):
         """
         导出 archive
         :return path_ipa
         """
 
+        import plistlib
         archive_path = archive_path or ""
         export_path = export_path or ""
 
@@ -531,16 +1795,14 @@ class BuildToolIOS(object):
         export_plist_path = self.create_export_plist(method)
 
         cmds = [
-            "xcodebuild",
+            XCODEBUILD,
             "-exportArchive",
             "-archivePath", archive_path,
             "-exportPath", export_path,
             "-exportOptionsPlist", export_plist_path,
             "-allowProvisioningUpdates",
         ]
-        cmd = " ".join(cmds)
-        print(cmd)
-        self.run_print_result(cmd)
+        self.run_print_result(cmds)
         result_plist = os.path.join(export_path, 'DistributionSummary.plist')
         if not os.path.exists(result_plist):
             return os.path.join(export_path, scheme + ".ipa")
@@ -556,6 +1818,7 @@ class BuildToolIOS(object):
         return os.path.join(export_path, ipa_name)
 
     def create_export_plist(self, method):
+        import plistlib
         plist_path = self.build_config.get_export_plist_path()
         plist_file = os.path.join(plist_path, 'export.plist')
         plist_dict = {
@@ -608,7 +1871,7 @@ class BuildToolIOS(object):
         print('use scheme: %s' % self.scheme)
         print('use configuration: %s' % self.configuration)
         cmds = [
-            'xcodebuild',
+            XCODEBUILD,
             'archive',
             "-scheme", self.scheme,
             "-configuration", self.configuration,
@@ -641,22 +1904,12 @@ class BuildToolIOS(object):
         pipe = self.run_cmd(cmd)
         return pipe.read()
 
-    def run_print_result(self, cmd):
-        print("run:" + cmd)
-        pipe = self.run_cmd(cmd)
+    def run_print_result(self, cmds):
+        print("run:" + " ".join(cmds))
+        if self.dry:
+            return None
+        return run_step("xcodebuild", cmds, log_name="xcodebuildLog")
 
-        if not self.dry:
-            while pipe and True:
-                try:
-                    line = pipe.readline()
-                    if line:
-                        print(line)
-                    else:
-                        break
-                except Exception as e:
-                    print(str(e))
-                    pass
-                    
 # common ended==============================
 
 # buildTarget Allows the selection of an active build target before loading a project. Possible options are:
@@ -686,11 +1939,9 @@ BUILD_TARGETS = {
 }
 
 
-def call_unity_func(build_target, func_name, quit, log_name, channel=None
-                    , channelId=None, out_path=None, version_name=None
-                    , build_number=None, patch_file=None, debug=False, product=False,gitcommit=None):
-    buf = [
-        UNITY_PATH
+def get_unity_args(build_target):
+    return [
+        get_unity_path()
         , "-batchmode"
         , "-nographics"
         , "-projectPath"
@@ -698,15 +1949,12 @@ def call_unity_func(build_target, func_name, quit, log_name, channel=None
         , "-buildTarget"
         , build_target
     ]
-    if quit:
-        buf.append("-quit")
-    if func_name is not None:
-        buf.append("-executeMethod")
-        buf.append(func_name)
-    if log_name is not None:
-        buf.append("-logFile")
-        buf.append(log_name)
-        LogFiles.append(log_name)
+
+
+def get_unity_build_args(channel=None, channelId=None, out_path=None, version_name=None
+                         , build_number=None, patch_file=None, debug=False, product=False, gitcommit=None):
+    '''BuildProcessorContext读取的构建参数'''
+    buf = []
     if channel is not None:
         buf.append("-channel")
         buf.append(channel)
@@ -734,57 +1982,679 @@ def call_unity_func(build_target, func_name, quit, log_name, channel=None
         buf.append("-debug")
     if product:
         buf.append("-product")
+    return buf
+
+
+def call_unity_func(build_target, func_name, quit, log_name, **kwargs):
+    if UseUnityWorker and func_name in UNITY_WORKER_METHODS:
+        return get_unity_worker(build_target).call(UNITY_WORKER_METHODS[func_name], get_unity_build_args(**kwargs), log_name)
+    # 常驻的Unity会锁住工程
+    stop_unity_workers()
+
+    buf = get_unity_args(build_target)
+    if quit:
+        buf.append("-quit")
+    if func_name is not None:
+        buf.append("-executeMethod")
+        buf.append(func_name)
+    if log_name is not None:
+        buf.append("-logFile")
+        buf.append(log_name)
+        get_log_files().append(log_name)
+    buf.extend(get_unity_build_args(**kwargs))
+
+    print('call unity::: ', " ".join(buf))
+    follower = None
+    if log_name is not None:
+        rm_file(log_name)
+        follower = UnityLogFollower(log_name, func_name or "unity")
+        follower.start()
+    try:
+        return run_process(buf, timeout=get_step_timeout("unity")).returncode
+    finally:
+        if follower:
+            follower.stop()
+
+# unity worker==============================
+# 常驻的Unity进程(BuildWorker.cs)，通过文件队列提交PreBuild/Build任务
+# workerPath/worker.json 状态，jobs/{id}.job.json 任务，jobs/{id}.log 日志，jobs/{id}.result.json 结果
+
+# 为真时PreBuild/Build提交给常驻Unity执行
+UseUnityWorker = os.environ.get("PLUGINLIT_UNITY_WORKER", "") not in ("", "0")
+
+UNITY_WORKER_METHODS = {
+    "PluginLit.Core.Editor.BuildHelper.PreBuild": "PreBuild",
+    "PluginLit.Core.Editor.BuildHelper.Build": "Build",
+}
+UNITY_WORKER_FUNC = "PluginLit.Core.Editor.BuildWorker.Run"
+# 空闲多久后Unity自动退出
+UNITY_WORKER_IDLE = int(os.environ.get("PLUGINLIT_WORKER_IDLE", 1800))
+# 等待Unity启动完成的时间
+UNITY_WORKER_START_TIMEOUT = int(os.environ.get("PLUGINLIT_WORKER_START_TIMEOUT", 1800))
+# 替代Unity的worker启动命令，例如 python Scripts/UnityWorkerStub.py，为空时启动Unity
+UNITY_WORKER_COMMAND = os.environ.get("PLUGINLIT_WORKER_COMMAND", None)
+
+_unity_workers = {}
+
+
+def is_pid_alive(pid):
+    if not pid:
+        return False
+    if is_win_platform():
+        import subprocess
+        output = subprocess.run(["tasklist", "/FI", "PID eq %d" % pid, "/NH"], stdout=subprocess.PIPE).stdout
+        return str(pid).encode() in output
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class WorkerResult(object):
+    code = 1
+    error = None
+    duration = 0
+    build_result = None
+
+    def __init__(self, data):
+        self.code = data.get("code", 1)
+        self.error = data.get("error", None)
+        self.duration = data.get("duration", 0)
+        self.build_result = data.get("buildResult", None)
+
+
+class UnityWorker(object):
+    '''一个工程与BuildTarget对应一个常驻Unity'''
+    process = None
+    poll_interval = 0.2
+
+    def __init__(self, build_target, worker_path=None):
+        self.build_target = build_target
+        self.worker_path = worker_path or os.path.join(PROTJECT_PATH, "Build", ".worker", build_target)
+        self.jobs_path = os.path.join(self.worker_path, "jobs")
+        self.state_file = os.path.join(self.worker_path, "worker.json")
+        self.log_file = os.path.join(self.worker_path, "worker.log")
+
+    def read_state(self):
+        try:
+            with open(self.state_file, 'r', encoding='UTF-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get_pid(self):
+        if self.process is not None:
+            return self.process.pid if self.process.poll() is None else None
+        state = self.read_state()
+        if state and is_pid_alive(state.get("pid", 0)):
+            return state["pid"]
+        return None
+
+    def is_alive(self):
+        return self.get_pid() is not None
+
+    def start(self):
+        '''启动Unity并等待进入空闲状态'''
+        import subprocess
+        if self.is_alive():
+            return
+        check_path(self.jobs_path)
+        rm_file(self.state_file)
+        if UNITY_WORKER_COMMAND:
+            import shlex
+            args = shlex.split(UNITY_WORKER_COMMAND, posix=not is_win_platform())
+            args.extend(["-buildTarget", self.build_target])
+        else:
+            args = get_unity_args(self.build_target)
+            args.extend(["-executeMethod", UNITY_WORKER_FUNC])
+        args.extend(["-workerPath", self.worker_path
+                     , "-workerIdle", str(UNITY_WORKER_IDLE)
+                     , "-logFile", self.log_file])
+        print('start unity worker::: ', " ".join(args))
+        self.process = subprocess.Popen(args, cwd=WORK_PATH, stdin=subprocess.DEVNULL
+                                        , stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                                        , start_new_session=True)
+        follower = UnityLogFollower(self.log_file, "worker")
+        follower.start()
+        start_time = time.time()
+        try:
+            while True:
+                if self.process.poll() is not None:
+                    print_unity_log_summary(self.log_file)
+                    return FAILURE("Unity worker exit with code %s" % self.process.returncode)
+                state = self.read_state()
+                if state and state.get("state") == "idle":
+                    break
+                if time.time() - start_time > UNITY_WORKER_START_TIMEOUT:
+                    self.kill()
+                    return FAILURE("Unity worker start timeout")
+                time.sleep(self.poll_interval)
+        finally:
+            follower.stop()
+        print("unity worker ready in %.1fs" % (time.time() - start_time))
+
+    def submit(self, method, args=None, log_name=None):
+        '''写入任务文件，返回任务id'''
+        check_path(self.jobs_path)
+        import uuid
+        job_id = "%s-%s-%s" % (time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8], method)
+        job = {"id": job_id, "method": method, "args": args or []}
+        if log_name is not None:
+            job["logFile"] = os.path.abspath(log_name)
+        job_file = os.path.join(self.jobs_path, job_id + ".job.json")
+        with open(job_file + ".tmp", 'w', encoding='UTF-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(job_file + ".tmp", job_file)
+        return job_id
+
+    def wait(self, job_id, log_name=None, timeout=None):
+        '''等待任务结束，同时输出任务日志'''
+        result_file = os.path.join(self.jobs_path, job_id + ".result.json")
+        job_log = log_name or os.path.join(self.jobs_path, job_id + ".log")
+        follower = UnityLogFollower(job_log, job_id) if log_name else None
+        if follower:
+            follower.start()
+        start_time = time.time()
+        offset = 0
+        try:
+            while True:
+                if log_name is None:
+                    offset = self.echo_log(job_log, offset)
+                if os.path.exists(result_file):
+                    if log_name is None:
+                        self.echo_log(job_log, offset)
+                    with open(result_file, 'r', encoding='UTF-8') as f:
+                        result = WorkerResult(json.load(f))
+                    rm_file(result_file)
+                    if log_name is None:
+                        rm_file(job_log)
+                    return result
+                if not self.is_alive():
+                    return WorkerResult({"error": "unity worker exited"})
+                if timeout and time.time() - start_time > timeout:
+                    self.kill()
+                    return WorkerResult({"error": "timeout after %ss" % timeout})
+                time.sleep(self.poll_interval)
+        finally:
+            if follower:
+                follower.stop()
+
+    def echo_log(self, log_file, offset):
+        if not os.path.exists(log_file):
+            return offset
+        with open(log_file, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end > 0:
+            sys.stdout.write(data[:end].decode('UTF-8', errors='replace'))
+            sys.stdout.flush()
+        return offset + end
+
+    def call(self, method, args=None, log_name=None):
+        '''与call_unity_func相同，返回退出码'''
+        self.start()
+        if log_name is not None:
+            rm_file(log_name)
+            get_log_files().append(log_name)
+        print('call unity worker::: ', method, " ".join(args or []))
+        result = self.wait(self.submit(method, args, log_name), log_name, timeout=get_step_timeout("unity"))
+        if result.error:
+            print("unity worker job %s fail: %s" % (method, result.error))
+        else:
+            print("unity worker job %s code %s in %.1fs" % (method, result.code, result.duration))
+        return result.code
+
+    def stop(self, timeout=60):
+        '''通知Unity退出，超时后强制结束'''
+        pid = self.get_pid()
+        if pid is None:
+            return
+        result = self.wait(self.submit("Stop"), timeout=timeout)
+        if result.error:
+            self.kill()
+        elif self.process is not None:
+            self.process.wait(timeout)
+        self.process = None
+
+    def kill(self):
+        import subprocess
+        pid = self.get_pid()
+        if self.process is not None:
+            kill_process_tree(self.process)
+        elif pid is not None and is_win_platform():
+            subprocess.call(["taskkill", "/T", "/F", "/PID", str(pid)])
+        elif pid is not None:
+            import signal
+            try:
+                os.killpg(os.getpgid(pid), signal.SIGKILL)
+            except OSError:
+                pass
+        rm_file(self.state_file)
+        self.process = None
+
+
+def get_unity_worker(build_target):
+    '''同一工程只能打开一个Unity，切换BuildTarget时先关闭其他worker'''
+    for target, worker in list(_unity_workers.items()):
+        if target != build_target:
+            worker.stop()
+            del _unity_workers[target]
+    if build_target not in _unity_workers:
+        stop_unity_workers([target for target in BUILD_TARGETS.values() if target != build_target])
+        _unity_workers[build_target] = UnityWorker(build_target)
+    return _unity_workers[build_target]
+
+
+def stop_unity_workers(targets=None):
+    '''关闭常驻的Unity，包括之前的fab进程启动的'''
+    for target in targets or BUILD_TARGETS.values():
+        worker = _unity_workers.pop(target, None) or UnityWorker(target)
+        worker.stop()
+
+
+@task(help={
+    'platform': "平台 android/ios/webgl，为空时关闭所有worker",
+})
+def stopUnityWorker(context, platform=None):
+    '''关闭常驻的Unity'''
+    stop_unity_workers(None if platform is None else [BUILD_TARGETS[platform.lower()]])
+
+
+@task(help={
+    'command': "worker启动命令，默认为PLUGINLIT_WORKER_COMMAND或Scripts/UnityWorkerStub.py",
+})
+def checkUnityWorker(context, command=None):
+    '''用替身进程检查常驻Unity的任务提交、等待与结果协议'''
+    global UNITY_WORKER_COMMAND
+    stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), "UnityWorkerStub.py")
+    command = command or UNITY_WORKER_COMMAND or '"%s" "%s"' % (sys.executable, stub)
+    saved, UNITY_WORKER_COMMAND = UNITY_WORKER_COMMAND, command
+    worker = UnityWorker("Stub", os.path.join(PROTJECT_PATH, "Build", ".worker", "stub"))
+    try:
+        worker.start()
+        out_path = os.path.join(worker.worker_path, "out")
+        rm_dir(out_path)
+        result = worker.wait(worker.submit("PreBuild", ["-path", out_path]), timeout=60)
+        if result.code != 0 or result.error or not result.build_result:
+            return FAILURE("unity worker PreBuild fail: code %s, error %s" % (result.code, result.error))
+        if not os.path.isfile(os.path.join(out_path, "buildResult.json")):
+            return FAILURE("unity worker PreBuild did not write buildResult.json")
+        result = worker.wait(worker.submit("Build", ["-fail"]), timeout=60)
+        if result.code == 0:
+            return FAILURE("unity worker Build should fail")
+        if worker.call("Build", ["-path", out_path]) != 0:
+            return FAILURE("unity worker call fail")
+    finally:
+        worker.stop()
+        UNITY_WORKER_COMMAND = saved
+    if worker.is_alive():
+        return FAILURE("unity worker still alive after stop")
+    SUCESS("unity worker protocol ok")
+
+
+# prebuild cache==============================
+# PreBuild只同步渠道配置、宏与版本号(Build会再同步一次)，工程状态与参数和上次PreBuild之后一致时跳过启动
+
+# 为真时总是执行PreBuild
+ForcePrebuild = False
+
+# 不影响PreBuild结果的参数，Build时会重新同步
+PREBUILD_IGNORE_ARGS = {"out_path", "version_name", "build_number", "gitcommit"}
+PREBUILD_INPUT_PATHS = ["ProjectSettings", os.path.join("Packages", "manifest.json"), os.path.join("Packages", "packages-lock.json")]
+# Unity读取的目录，其中被git忽略的文件也计入工程状态
+WORKTREE_IGNORED_INPUTS = ["Assets", "Packages", "ProjectSettings"]
+
+
+def git_output(args, cwd=None):
+    '''执行git命令返回标准输出，失败时返回None'''
+    import subprocess
+    try:
+        return subprocess.run(["git"] + args, cwd=cwd or PROTJECT_PATH, stdout=subprocess.PIPE
+                              , stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_git_status(status):
+    '''解析 git status --porcelain -z 的输出，返回[(状态, 路径, 原路径)]，重命名与复制之外原路径为None'''
+    items = status.split(b"\0")
+    entries = []
+    index = 0
+    while index < len(items):
+        item = items[index]
+        index += 1
+        if len(item) < 4:
+            continue
+        code = item[:2].decode('ascii', errors='replace')
+        orig_path = None
+        # 重命名与复制后面还有一项原路径
+        if "R" in code or "C" in code:
+            orig_path = items[index].decode('UTF-8', errors='replace') if index < len(items) else None
+            index += 1
+        entries.append((code, item[3:].decode('UTF-8', errors='replace'), orig_path))
+    return entries
+
+
+def update_file_stat(digest, rel):
+    path = os.path.join(PROTJECT_PATH, rel)
+    if os.path.isfile(path):
+        st = os.stat(path)
+        digest.update(("%d:%d" % (st.st_size, st.st_mtime_ns)).encode())
+
+
+def get_worktree_fingerprint(exclude_dirs=("Build",)):
+    '''git tree、未提交改动与WORKTREE_IGNORED_INPUTS中被忽略的文件(路径、大小、修改时间)的摘要，不是git仓库时返回None'''
+    tree = git_output(["rev-parse", "HEAD^{tree}"])
+    args = ["status", "--porcelain", "-z", "--untracked-files=all", "--", "."]
+    args.extend(":(exclude)%s" % name for name in exclude_dirs)
+    status = git_output(args)
+    if tree is None or status is None:
+        return None
+    digest = hashlib.sha1(tree.strip())
+    for code, rel, orig_path in parse_git_status(status):
+        digest.update(("%s %s <- %s\n" % (code, rel, orig_path)).encode('UTF-8'))
+        update_file_stat(digest, rel)
+    inputs = [name for name in WORKTREE_IGNORED_INPUTS if os.path.exists(os.path.join(PROTJECT_PATH, name))]
+    ignored = git_output(["ls-files", "-z", "--others", "--ignored", "--exclude-standard", "--"] + inputs) if inputs else b""
+    for rel in sorted(ignored.split(b"\0") if ignored else []):
+        if rel:
+            rel = rel.decode('UTF-8', errors='replace')
+            digest.update(("!! %s\n" % rel).encode('UTF-8'))
+            update_file_stat(digest, rel)
+    return digest.hexdigest()
+
+
+def get_paths_fingerprint(paths, hasher=None):
+    '''工程内文件或目录的内容摘要'''
+    hasher = hasher or get_file_hasher()
+    files = []
+    for path in paths:
+        full_path = os.path.join(PROTJECT_PATH, path)
+        if os.path.isdir(full_path):
+            files.extend(entry.path for _, entry in scan_files(full_path))
+        elif os.path.isfile(full_path):
+            files.append(full_path)
+    files.sort()
+    digests = hasher.digest_files(files)
+    hasher.save()
+    digest = hashlib.sha1()
+    for path in files:
+        digest.update(("%s=%s\n" % (os.path.relpath(path, PROTJECT_PATH), digests[path])).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+def get_prebuild_fingerprint(build_target, kwargs):
+    worktree = get_worktree_fingerprint()
+    if worktree is None:
+        return None
+    args = dict((k, v) for k, v in kwargs.items() if k not in PREBUILD_IGNORE_ARGS)
+    data = {
+        "target": build_target,
+        "unity": get_toolchain().version_string,
+        "args": args,
+        "worktree": worktree,
+        "inputs": get_paths_fingerprint(PREBUILD_INPUT_PATHS),
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('UTF-8')).hexdigest()
+
+
+def get_prebuild_cache_file(build_target):
+    return get_cache_path("prebuild", "%s.json" % build_target)
+
+
+def is_prebuild_cached(build_target, kwargs):
+    cache_file = get_prebuild_cache_file(build_target)
+    record = load_json_manifest(cache_file)
+    if not record.get("key"):
+        return False
+    return record["key"] == get_prebuild_fingerprint(build_target, kwargs)
+
+
+def save_prebuild_cache(build_target, kwargs):
+    '''记录PreBuild成功之后的工程状态，下次状态与参数一致时可跳过PreBuild'''
+    key = get_prebuild_fingerprint(build_target, kwargs)
+    if key is None:
+        return
+    save_json_manifest(get_prebuild_cache_file(build_target), {
+        "key": key,
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "args": dict((k, v) for k, v in kwargs.items() if k not in PREBUILD_IGNORE_ARGS),
+    })
 
-    cmd = " ".join(buf)
-    return execall(cmd)
 
 def build_unity(platform, log_path, **kwargs):
     build_target = BUILD_TARGETS.get(platform.lower(), None)
     if build_target is None:
         return FAILURE("暂不支持该平台(%s)导出" % platform)
-    if call_unity_func(build_target
-            , "PluginLit.Core.Editor.BuildHelper.PreBuild"
-            , True
-            , os.path.join(log_path, "prebuildLog") if log_path else None
-            , **kwargs):
-        return FAILURE("Unity prebuild fail!", printLog=True)
-    if call_unity_func(build_target
-            , "PluginLit.Core.Editor.BuildHelper.Build"
-            , False
-            , os.path.join(log_path, "buildLog") if log_path else None
-            , **kwargs):
+    with timed("unity.prebuild", target=build_target):
+        prebuild_status = "forced" if ForcePrebuild else "miss"
+        if not ForcePrebuild and is_prebuild_cached(build_target, kwargs):
+            prebuild_status = "hit"
+        print("prebuild cache %s for %s" % (prebuild_status, build_target))
+        get_build_timer().meta["prebuildCache"] = prebuild_status
+        if prebuild_status != "hit":
+            # PreBuild中途失败或被中断时工程状态未知，成功后才重新记录
+            rm_file(get_prebuild_cache_file(build_target))
+            code = call_unity_func(build_target
+                    , "PluginLit.Core.Editor.BuildHelper.PreBuild"
+                    , True
+                    , os.path.join(log_path, "prebuildLog") if log_path else None
+                    , **kwargs)
+            if code:
+                return FAILURE("Unity prebuild fail!", printLog=True)
+            save_prebuild_cache(build_target, kwargs)
+    with timed("unity.build", target=build_target):
+        code = call_unity_func(build_target
+                , "PluginLit.Core.Editor.BuildHelper.Build"
+                , False
+                , os.path.join(log_path, "buildLog") if log_path else None
+                , **kwargs)
+    if code:
         return FAILURE("Unity build fail!", printLog=True)
+    update_build_result(kwargs.get("out_path", None), prebuildCache=prebuild_status)
+
+
+# gradle profile==============================
+# gradle执行参数(daemon、并行、构建缓存等)，构建缓存目录在各次build_<N>之间共享
+
+class GradleProfile(object):
+    name = "plain"
+    # None时不传参数，使用工程gradle.properties中的设置
+    daemon = None
+    parallel = None
+    build_cache = None
+    configuration_cache = None
+    offline = False
+    # 如"4g"，覆盖org.gradle.jvmargs
+    jvm_heap = None
+    max_workers = 0
+    # 本地构建缓存目录，为空时使用 get_cache_path("gradle-build-cache")
+    build_cache_path = None
+    # GRADLE_USER_HOME，为空时使用环境变量 PLUGINLIT_GRADLE_USER_HOME 或gradle默认目录
+    user_home = None
+
+    def __init__(self, name, **options):
+        self.name = name
+        for key, value in options.items():
+            if not hasattr(self, key):
+                FAILURE("unknown gradle profile option %s" % key)
+            setattr(self, key, value)
+
+    @staticmethod
+    def get_switch(name, value):
+        if value is None:
+            return []
+        return ["--%s" % name if value else "--no-%s" % name]
+
+    def get_init_script(self):
+        '''把本地构建缓存指向共享目录的init脚本'''
+        cache_path = os.path.abspath(self.build_cache_path or get_cache_path("gradle-build-cache"))
+        script_file = get_cache_path("gradle-init", "build-cache.gradle")
+        content = ("settingsEvaluated { settings ->\n"
+                   "    settings.buildCache {\n"
+                   "        local {\n"
+                   "            enabled = true\n"
+                   "            directory = new File(%s)\n"
+                   "        }\n"
+                   "    }\n"
+                   "}\n" % json.dumps(cache_path.replace("\\", "/")))
+        current = None
+        if os.path.exists(script_file):
+            with open(script_file, 'r', encoding='UTF-8') as f:
+                current = f.read()
+        if current != content:
+            check_path(os.path.dirname(script_file))
+            with open(script_file, 'w', encoding='UTF-8') as f:
+                f.write(content)
+        return script_file
+
+    def get_args(self):
+        args = ["--console=plain"]
+        args.extend(self.get_switch("daemon", self.daemon))
+        args.extend(self.get_switch("parallel", self.parallel))
+        args.extend(self.get_switch("build-cache", self.build_cache))
+        args.extend(self.get_switch("configuration-cache", self.configuration_cache))
+        if self.build_cache:
+            args.extend(["--init-script", self.get_init_script()])
+        if self.offline:
+            args.append("--offline")
+        if self.max_workers:
+            args.append("--max-workers=%d" % self.max_workers)
+        if self.jvm_heap:
+            args.append("-Dorg.gradle.jvmargs=-Xmx%s -Dfile.encoding=UTF-8" % self.jvm_heap)
+        return args
+
+    def get_env(self):
+        user_home = self.user_home or os.environ.get("PLUGINLIT_GRADLE_USER_HOME", None)
+        if not user_home:
+            return None
+        env = dict(os.environ)
+        env["GRADLE_USER_HOME"] = os.path.abspath(user_home)
+        return env
+
+
+GRADLE_PROFILES = {
+    # 与工程自身配置一致，不传任何参数
+    "plain": GradleProfile("plain"),
+    # 开启daemon、并行与共享构建缓存，需要显式指定
+    "cache": GradleProfile("cache", daemon=True, parallel=True, build_cache=True),
+    # CI上不保留daemon
+    "ci": GradleProfile("ci", daemon=False, parallel=True, build_cache=True),
+    "fast": GradleProfile("fast", daemon=True, parallel=True, build_cache=True, configuration_cache=True),
+    "offline": GradleProfile("offline", daemon=True, parallel=True, build_cache=True, offline=True),
+}
 
+# 当前使用的profile名称，可通过环境变量 PLUGINLIT_GRADLE_PROFILE 指定，默认不改变工程自身的gradle配置
+GradleProfileName = os.environ.get("PLUGINLIT_GRADLE_PROFILE", "plain")
+
+
+def get_gradle_profile(name=None):
+    name = name or GradleProfileName
+    profile = GRADLE_PROFILES.get(name, None)
+    if profile is None:
+        return FAILURE("unknown gradle profile %s, available: %s" % (name, ", ".join(sorted(GRADLE_PROFILES))))
+    heap = os.environ.get("PLUGINLIT_GRADLE_HEAP", None)
+    if heap:
+        options = dict(vars(profile), jvm_heap=heap)
+        profile = GradleProfile(options.pop("name"), **options)
+    return profile
+
+
+class GradleTaskStats(object):
+    '''从--console=plain输出中统计任务结果'''
+    TASK_PATTERN = re.compile(r"^> Task (\S+)(?: (UP-TO-DATE|FROM-CACHE|NO-SOURCE|SKIPPED))?\s*$")
+    SUMMARY_PATTERN = re.compile(r"^(\d+) actionable tasks?: (.*)$")
+
+    def __init__(self):
+        self.outcomes = dict()
+        self.executed_tasks = []
+        self.summary = dict()
+
+    def on_line(self, line):
+        match = self.TASK_PATTERN.match(line)
+        if match:
+            outcome = match.group(2) or "EXECUTED"
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if outcome == "EXECUTED":
+                self.executed_tasks.append(match.group(1))
+            return
+        match = self.SUMMARY_PATTERN.match(line)
+        if match:
+            self.summary["actionable"] = int(match.group(1))
+            for part in match.group(2).split(","):
+                count, _, kind = part.strip().partition(" ")
+                if count.isdigit():
+                    self.summary[kind.strip()] = int(count)
+
+    def to_dict(self):
+        actionable = self.summary.get("actionable", 0)
+        reused = self.summary.get("from cache", 0) + self.summary.get("up-to-date", 0)
+        return {
+            "actionable": actionable,
+            "executed": self.summary.get("executed", 0),
+            "fromCache": self.summary.get("from cache", 0),
+            "upToDate": self.summary.get("up-to-date", 0),
+            "hitRate": round(reused / actionable, 4) if actionable else None,
+            "outcomes": self.outcomes,
+        }
+
+    def report(self, name):
+        data = self.to_dict()
+        if data["actionable"]:
+            print("[gradle] %s: %d actionable, %d executed, %d from cache, %d up-to-date, hit rate %.1f%%"
+                  % (name, data["actionable"], data["executed"], data["fromCache"], data["upToDate"], data["hitRate"] * 100))
+        if self.executed_tasks:
+            print("[gradle] executed: %s%s" % (", ".join(self.executed_tasks[:10])
+                                               , " ..." if len(self.executed_tasks) > 10 else ""))
+        return data
+
+
+def get_gradlew(android_project_path):
+    return os.path.join(android_project_path, "gradlew.bat" if is_win_platform() else "gradlew")
+
+
+def run_gradle(android_project_path, tasks, properties=None, log_name="gradleLog", profile=None):
+    '''按profile执行gradle任务，输出任务缓存命中情况'''
+    profile = profile or get_gradle_profile()
+    cmd = [get_gradlew(android_project_path)]
+    cmd.extend(tasks)
+    cmd.extend(profile.get_args())
+    if properties:
+        for key, value in properties.items():
+            cmd.append("-P%s=%s" % (key, value))
+    stats = GradleTaskStats()
+    print("gradle profile %s" % profile.name)
+    result = run_step("gradle", cmd, cwd=android_project_path, log_name=log_name
+                      , env=profile.get_env(), on_line=stats.on_line)
+    data = stats.report(log_name)
+    data.update(name=log_name, profile=profile.name, duration=round(result.duration, 3))
+    get_build_timer().meta.setdefault("gradle", []).append(data)
+    return result
 
+
+@timed("gradle.aab")
 def generateAab(android_project_path, debug):
-    gradlew = "./gradlew"
-    if is_win_platform():
-        gradlew = '"./gradlew.bat"'
-    cmd = [
-        gradlew,
-        "bundleDebug" if debug else "bundleRelease"
-    ]
-    execall('cd "%s" && %s' % (android_project_path, " ".join(cmd)))
+    run_gradle(android_project_path, ["bundleDebug" if debug else "bundleRelease"])
     mode = "debug" if debug else "release"
     aab_name = "launcher-%s.aab" % mode
     build_aab_file = os.path.join(android_project_path, "launcher", "build", "outputs", "bundle", mode, aab_name)
     return build_aab_file
     
     
-def buildAndroidProject(android_project_path, debug):
-    gradlew = "./gradlew"
-    if is_win_platform():
-        gradlew = '"./gradlew.bat"'
-    cmd = [
-        gradlew,
-        "assembleDebug" if debug else "assembleRelease"
-    ]
-    execall('cd "%s" && %s' % (android_project_path, " ".join(cmd)))
+def buildAndroidProject(android_project_path, debug, properties=None, log_name="gradleLog"):
+    return run_gradle(android_project_path, ["assembleDebug" if debug else "assembleRelease"], properties, log_name)
     
     
 def isUnityEngine(android_project_path):
     return os.path.exists(os.path.join(android_project_path, "unityLibrary"))
     
+@timed("gradle.aar")
 def generateLib(android_project_path, debug):
     buildAndroidProject(android_project_path, debug)
     mode = "debug" if debug else "release"
@@ -794,27 +2664,581 @@ def generateLib(android_project_path, debug):
     return os.path.join(lib_path, lib_name), lib_name
     
 
-def generateApk(android_project_path, debug):
-    buildAndroidProject(android_project_path, debug)
+def generateApk(android_project_path, debug, properties=None, log_name="gradleLog"):
+    with timed("gradle.apk", **(properties or {})):
+        buildAndroidProject(android_project_path, debug, properties, log_name)
     mode = "debug" if debug else "release"
     apk_name = "launcher-%s.apk" % mode
     build_apk_file = os.path.join(android_project_path, "launcher", "build", "outputs", "apk", mode, apk_name)
     return build_apk_file
 
+
+# gradle channel fan-out==============================
+# 每个渠道在导出工程的硬链接副本中独立执行gradle，构建产物目录不参与链接
+
+# gradle的构建目录，只在工程根目录与各模块的顶层跳过，java包或assets中同名的目录照常克隆
+CLONE_SKIP_NAMES = {"build", ".gradle", ".cxx"}
+CLONE_SKIP_DEPTH = 1
+CLONE_COPY_EXTS = (".gradle", ".properties", ".kts", ".pro", ".txt", ".xml", ".json")
+
+
+def clone_project_tree(src, dst, skip_names=CLONE_SKIP_NAMES, depth=0):
+    '''以硬链接方式克隆工程目录，gradle可能改写的配置类文件直接复制，depth为src相对工程根目录的层数'''
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as it:
+        for entry in it:
+            if entry.name in WALK_SKIP_NAMES or (depth <= CLONE_SKIP_DEPTH and entry.name in skip_names):
+                continue
+            to_path = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                clone_project_tree(entry.path, to_path, skip_names, depth + 1)
+            elif entry.is_symlink():
+                os.symlink(os.readlink(entry.path), to_path)
+            elif entry.name.endswith(CLONE_COPY_EXTS):
+                shutil.copy2(entry.path, to_path)
+            else:
+                link_or_copy_file(entry.path, to_path)
+
+
+def get_gradle_jobs(jobs, count):
+    jobs = int(jobs or 0)
+    if jobs <= 0:
+        jobs = max(1, (os.cpu_count() or 2) // 2)
+    return max(1, min(jobs, count))
+
+
+def build_channel_apks_parallel(android_project_path, clones_path, channelIds, debug, jobs=0):
+    '''从同一个导出工程并行为每个渠道执行gradle构建，返回 {channelId: apk路径}'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    def build_channel(channelId):
+        clone_path = os.path.join(clones_path, channelId)
+        rm_dir(clone_path)
+        clone_project_tree(android_project_path, clone_path)
+        dump_now("start gradle for channel %s" % channelId)
+        apk_file = generateApk(clone_path, debug, {"channelId": channelId}, "gradleLog_%s" % channelId)
+        dump_now("gradle for channel %s completed" % channelId)
+        return apk_file
+
+    jobs = get_gradle_jobs(jobs, len(channelIds))
+    print("build %d channels with %d gradle workers" % (len(channelIds), jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        apk_files = list(executor.map(bind_build_local(build_channel), channelIds))
+    return dict(zip(channelIds, apk_files))
+
+
+# apk channel stamping==============================
+# 渠道号写入 APK Signing Block(ID 与 Walle 一致)，未签名 v2 的包写入 zip comment
+
+ZIP_EOCD_SIG = b"PK\x05\x06"
+ZIP_EOCD_SIZE = 22
+APK_SIG_BLOCK_MAGIC = b"APK Sig Block 42"
+APK_SIG_PADDING_ID = 0x42726577
+APK_CHANNEL_BLOCK_ID = 0x71777777
+APK_CHANNEL_COMMENT_MAGIC = b"PLCH"
+APK_COPY_BUFFER = 1024 * 1024
+
+
+class ApkLayout(object):
+    file_size = 0
+    cd_offset = 0
+    cd_size = 0
+    eocd_offset = 0
+    eocd = b""
+    comment = b""
+    block_offset = -1
+    block_pairs = None
+
+    def has_signing_block(self):
+        return self.block_offset >= 0
+
+
+def find_zip_eocd(f, file_size):
+    '''从文件末尾查找EOCD，返回(偏移, EOCD, 注释)'''
+    tail_size = min(file_size, ZIP_EOCD_SIZE + 0xFFFF)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+    pos = tail.rfind(ZIP_EOCD_SIG)
+    while pos >= 0:
+        comment_len = struct.unpack("<H", tail[pos + 20:pos + 22])[0]
+        if pos + ZIP_EOCD_SIZE + comment_len == len(tail):
+            break
+        pos = tail.rfind(ZIP_EOCD_SIG, 0, pos)
+    if pos < 0:
+        raise ValueError("not a zip file")
+    return file_size - tail_size + pos, tail[pos:pos + ZIP_EOCD_SIZE], tail[pos + ZIP_EOCD_SIZE:]
+
+
+def read_apk_layout(f):
+    '''读取APK的EOCD、中央目录与签名块位置'''
+    layout = ApkLayout()
+    f.seek(0, os.SEEK_END)
+    layout.file_size = f.tell()
+    layout.eocd_offset, layout.eocd, layout.comment = find_zip_eocd(f, layout.file_size)
+    layout.cd_size, layout.cd_offset = struct.unpack("<II", layout.eocd[12:20])
+    if layout.cd_offset == 0xFFFFFFFF or layout.cd_size == 0xFFFFFFFF:
+        raise ValueError("zip64 apk is not supported")
+    if layout.cd_offset < 32:
+        return layout
+
+    f.seek(layout.cd_offset - 24)
+    footer = f.read(24)
+    if footer[8:] != APK_SIG_BLOCK_MAGIC:
+        return layout
+    block_size = struct.unpack("<Q", footer[:8])[0]
+    block_offset = layout.cd_offset - block_size - 8
+    if block_offset < 0:
+        raise ValueError("invalid apk signing block size")
+    f.seek(block_offset)
+    if struct.unpack("<Q", f.read(8))[0] != block_size:
+        raise ValueError("apk signing block size mismatch")
+
+    pairs = []
+    data = f.read(block_size - 24)
+    index = 0
+    while index + 12 <= len(data):
+        length, pair_id = struct.unpack("<QI", data[index:index + 12])
+        pairs.append((pair_id, data[index + 12:index + 8 + length]))
+        index += 8 + length
+    layout.block_offset = block_offset
+    layout.block_pairs = pairs
+    return layout
+
+
+def build_apk_signing_block(pairs, padding):
+    '''重新生成签名块，原包带有4096对齐填充时保持对齐'''
+    body = b"".join(struct.pack("<QI", len(value) + 4, pair_id) + value for pair_id, value in pairs)
+    total = 8 + len(body) + 8 + 16
+    if padding and total % 4096 != 0:
+        pad = 4096 - total % 4096
+        if pad < 12:
+            pad += 4096
+        body += struct.pack("<QI", pad - 8, APK_SIG_PADDING_ID) + b"\x00" * (pad - 12)
+    size = len(body) + 8 + 16
+    return struct.pack("<Q", size) + body + struct.pack("<Q", size) + APK_SIG_BLOCK_MAGIC
+
+
+def copy_file_range(src, dst, length):
+    while length > 0:
+        buf = src.read(min(APK_COPY_BUFFER, length))
+        if not buf:
+            raise IOError("unexpected end of file")
+        dst.write(buf)
+        length -= len(buf)
+
+
+def write_apk_channel(src_apk, dst_apk, channel_id, extras=None):
+    '''复制APK并写入渠道信息，zip条目按原字节流拷贝不重新压缩'''
+    payload = dict(extras or {})
+    payload["channel"] = channel_id
+    value = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+    tmp_apk = dst_apk + ".tmp"
+    with open(src_apk, "rb") as r:
+        layout = read_apk_layout(r)
+        with open(tmp_apk, "wb") as w:
+            r.seek(0)
+            if layout.has_signing_block():
+                pairs = [p for p in layout.block_pairs if p[0] not in (APK_CHANNEL_BLOCK_ID, APK_SIG_PADDING_ID)]
+                padding = len(pairs) != len(layout.block_pairs)
+                pairs.append((APK_CHANNEL_BLOCK_ID, value))
+                block = build_apk_signing_block(pairs, padding)
+                copy_file_range(r, w, layout.block_offset)
+                w.write(block)
+                r.seek(layout.cd_offset)
+                copy_file_range(r, w, layout.cd_size)
+                cd_offset = layout.block_offset + len(block)
+                comment = layout.comment
+            else:
+                copy_file_range(r, w, layout.cd_offset + layout.cd_size)
+                cd_offset = layout.cd_offset
+                comment = APK_CHANNEL_COMMENT_MAGIC + value
+                if len(comment) > 0xFFFF:
+                    raise ValueError("channel info is too large")
+            eocd = layout.eocd[:16] + struct.pack("<IH", cd_offset, len(comment))
+            w.write(eocd)
+            w.write(comment)
+    os.replace(tmp_apk, dst_apk)
+    return dst_apk
+
+
+def read_apk_channel_info(apk_file):
+    '''读取APK中写入的渠道信息，没有时返回None'''
+    with open(apk_file, "rb") as f:
+        layout = read_apk_layout(f)
+    value = None
+    if layout.has_signing_block():
+        for pair_id, pair_value in layout.block_pairs:
+            if pair_id == APK_CHANNEL_BLOCK_ID:
+                value = pair_value
+    if value is None and layout.comment.startswith(APK_CHANNEL_COMMENT_MAGIC):
+        value = layout.comment[len(APK_CHANNEL_COMMENT_MAGIC):]
+    if value is None:
+        return None
+    return json.loads(value.decode("utf-8"))
+
+
+def read_apk_channel(apk_file):
+    info = read_apk_channel_info(apk_file)
+    if info is None:
+        return None
+    return info.get("channel", None)
+
+
+def check_apk_name_template(apk_name_template, channelIds):
+    '''多个渠道号时文件名模版必须包含{{channelId}}，否则所有渠道会写到同一个文件'''
+    if len(channelIds) > 1 and "{{channelId}}" not in (apk_name_template or ""):
+        FAILURE("apk_name_template需要包含{{channelId}}才能输出%d个渠道的APK: %s" % (len(channelIds), apk_name_template))
+
+
+@timed("android.stamp_channels")
+def stamp_apk_channels(apk_file, apks_path, apk_name_template, channel, channelIds, version_name, build_number):
+    '''将一个构建好的APK按渠道号批量写入，返回 {channelId: apk路径}'''
+    check_apk_name_template(apk_name_template, channelIds)
+    check_path(apks_path)
+    result = dict()
+    for channelId in channelIds:
+        apk_name = replace_string(apk_name_template, platform="android", channel=channel, channelId=channelId, version_name=version_name, build_number=build_number)
+        target_apk_file = os.path.join(apks_path, apk_name)
+        rm_file(target_apk_file)
+        write_apk_channel(apk_file, target_apk_file, channelId, {"buildChannel": channel})
+        result[channelId] = target_apk_file
+    return result
+
+
+def verify_apk_channels(apk_files):
+    '''检查 {channelId: apk路径} 中的每个APK是否写入了对应的渠道号，返回错误列表'''
+    errors = []
+    for channelId, apk_file in apk_files.items():
+        try:
+            stamped = read_apk_channel(apk_file)
+        except Exception as err:
+            stamped = None
+            print("read apk channel fail", apk_file, err)
+        if stamped != channelId:
+            errors.append("%s: expect %s but got %s" % (apk_file, channelId, stamped))
+    return errors
+
+
+# size report==============================
+# 只读取APK/AAB/IPA的zip中央目录(不解压)，按分类、目录、扩展名统计压缩前后的大小，
+# 与缓存中同平台渠道上一次的报告对比，增长超过预算的条目会被标记
+
+SIZE_REPORT_EXTS = (".apk", ".aab", ".ipa")
+SIZE_REPORT_FILE = "sizeReport.json"
+SIZE_BUDGET_BYTES = int(float(os.environ.get("PLUGINLIT_SIZE_BUDGET_KB", 256)) * 1024)
+SIZE_REPORT_TOP = 10
+ZIP64_EOCD_LOCATOR_SIG = b"PK\x06\x07"
+ZIP64_EOCD_SIG = b"PK\x06\x06"
+ZIP_CENTRAL_SIG = b"PK\x01\x02"
+# 按顺序匹配去掉AAB模块名、IPA的Payload/*.app前缀后的路径
+SIZE_CATEGORIES = [
+    ("unityData", re.compile(r"^(assets/bin/Data|Data)/")),
+    ("native", re.compile(r"^(lib|Frameworks)/|\.(so|dylib)$")),
+    ("dex", re.compile(r"^(dex/)?classes\d*\.dex$")),
+    ("resources", re.compile(r"^res/|^resources\.(arsc|pb)$|\.(nib|car|storyboardc|lproj)(/|$)")),
+    ("assets", re.compile(r"^assets/")),
+    ("meta", re.compile(r"^(META-INF|BUNDLE-METADATA|_CodeSignature|manifest|root)/")),
+]
+
+
+def iter_zip_entries(path):
+    '''流式读取zip中央目录，返回(名称, 压缩大小, 原始大小)，支持zip64'''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        eocd_offset, eocd, _ = find_zip_eocd(f, file_size)
+        count, cd_size, cd_offset = struct.unpack("<HII", eocd[10:20])
+        if count == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            f.seek(eocd_offset - 20)
+            locator = f.read(20)
+            if locator[:4] != ZIP64_EOCD_LOCATOR_SIG:
+                raise ValueError("missing zip64 end of central directory locator")
+            f.seek(struct.unpack("<Q", locator[8:16])[0])
+            record = f.read(56)
+            if record[:4] != ZIP64_EOCD_SIG:
+                raise ValueError("invalid zip64 end of central directory")
+            count, cd_size, cd_offset = struct.unpack("<QQQ", record[32:56])
+        f.seek(cd_offset)
+        for _ in range(count):
+            header = f.read(46)
+            if header[:4] != ZIP_CENTRAL_SIG:
+                raise ValueError("invalid central directory entry in %s" % path)
+            compressed, uncompressed = struct.unpack("<II", header[20:28])
+            name_len, extra_len, comment_len = struct.unpack("<HHH", header[28:34])
+            name = f.read(name_len).decode('UTF-8', 'replace')
+            extra = f.read(extra_len)
+            f.seek(comment_len, os.SEEK_CUR)
+            if compressed == 0xFFFFFFFF or uncompressed == 0xFFFFFFFF:
+                uncompressed, compressed = read_zip64_sizes(extra, uncompressed, compressed)
+            if not name.endswith("/"):
+                yield name, compressed, uncompressed
+
+
+def read_zip64_sizes(extra, uncompressed, compressed):
+    '''从zip64扩展字段中读取为0xFFFFFFFF的大小'''
+    index = 0
+    while index + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[index:index + 4])
+        if header_id == 0x0001:
+            values = extra[index + 4:index + 4 + size]
+            offset = 0
+            if uncompressed == 0xFFFFFFFF:
+                uncompressed = struct.unpack("<Q", values[offset:offset + 8])[0]
+                offset += 8
+            if compressed == 0xFFFFFFFF:
+                compressed = struct.unpack("<Q", values[offset:offset + 8])[0]
+            break
+        index += 4 + size
+    return uncompressed, compressed
+
+
+def get_size_entry_path(kind, name):
+    '''去掉AAB的模块名和IPA的Payload/*.app前缀'''
+    parts = name.split("/")
+    if kind == "ipa" and len(parts) > 2 and parts[0] == "Payload" and parts[1].endswith(".app"):
+        return "/".join(parts[2:])
+    if kind == "aab" and len(parts) > 1 and parts[0] not in ("META-INF", "BUNDLE-METADATA"):
+        return "/".join(parts[1:])
+    return name
+
+
+def get_size_category(path):
+    for category, pattern in SIZE_CATEGORIES:
+        if pattern.search(path):
+            return category
+    return "other"
+
+
+def analyze_archive(path):
+    '''统计安装包中各分类、目录(前两级)、扩展名压缩前后的大小'''
+    kind = os.path.splitext(path)[1].lower().lstrip(".")
+    report = {"file": os.path.basename(path), "kind": kind, "size": os.path.getsize(path), "entries": 0
+        , "compressed": 0, "uncompressed": 0, "categories": dict(), "dirs": dict(), "exts": dict()}
+
+    def add(group, key, compressed, uncompressed):
+        item = report[group].setdefault(key, {"count": 0, "compressed": 0, "uncompressed": 0})
+        item["count"] += 1
+        item["compressed"] += compressed
+        item["uncompressed"] += uncompressed
+
+    for name, compressed, uncompressed in iter_zip_entries(path):
+        entry_path = get_size_entry_path(kind, name)
+        parts = entry_path.split("/")
+        report["entries"] += 1
+        report["compressed"] += compressed
+        report["uncompressed"] += uncompressed
+        add("categories", get_size_category(entry_path), compressed, uncompressed)
+        add("dirs", "/".join(parts[:min(2, len(parts) - 1)]) or "/", compressed, uncompressed)
+        add("exts", os.path.splitext(parts[-1])[1].lower() or "(none)", compressed, uncompressed)
+    return report
+
+
+def diff_size_reports(old, new, budget=SIZE_BUDGET_BYTES):
+    '''按分类、目录、扩展名对比压缩后的大小，返回变化的条目，增长超过budget的标记over'''
+    changes = []
+    groups = [("total", {"total": {"compressed": old["size"]}}, {"total": {"compressed": new["size"]}})]
+    groups.extend((group, old.get(group, dict()), new.get(group, dict())) for group in ["categories", "dirs", "exts"])
+    for group, old_items, new_items in groups:
+        for key in sorted(set(old_items) | set(new_items)):
+            old_size = old_items.get(key, dict()).get("compressed", 0)
+            new_size = new_items.get(key, dict()).get("compressed", 0)
+            if old_size != new_size:
+                delta = new_size - old_size
+                changes.append({"group": group, "name": key, "old": old_size, "new": new_size, "delta": delta
+                    , "over": delta > budget})
+    return changes
+
+
+def get_size_baseline_path(platform, channel, kind):
+    return get_cache_path("size", "%s_%s_%s.json" % (platform or "unknown", channel or "default", kind))
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB"]:
+        if abs(size) < 1024:
+            return "%.1f%s" % (size, unit) if unit != "B" else "%d%s" % (size, unit)
+        size /= 1024.0
+    return "%.2fGB" % size
+
+
+def print_size_report(report):
+    print("[size] %s %s, %d entries, compressed %s, uncompressed %s" % (report["file"], format_size(report["size"])
+        , report["entries"], format_size(report["compressed"]), format_size(report["uncompressed"])))
+    changes = dict((change["name"], change["delta"]) for change in report.get("changes", []) if change["group"] == "categories")
+    for name, item in sorted(report["categories"].items(), key=lambda item: -item[1]["compressed"]):
+        delta = changes.get(name, 0)
+        print(("    %-12s %10s %10s %s" % (name, format_size(item["compressed"]), format_size(item["uncompressed"])
+            , ("+" if delta > 0 else "") + format_size(delta) if delta else "")).rstrip())
+    dirs = sorted(report["dirs"].items(), key=lambda item: -item[1]["compressed"])[:SIZE_REPORT_TOP]
+    print("    top dirs: " + ", ".join("%s %s" % (name, format_size(item["compressed"])) for name, item in dirs))
+    for change in report.get("changes", []):
+        if change["over"]:
+            name = change["name"] if change["group"] == "total" else "%s %s" % (change["group"], change["name"])
+            print("    [over budget] %s grew %s (%s -> %s)" % (name, format_size(change["delta"])
+                , format_size(change["old"]), format_size(change["new"])))
+
+
+def write_size_report(build_path, platform=None, channel=None, budget=SIZE_BUDGET_BYTES):
+    '''分析构建目录的产物目录中的安装包，与上一次的报告对比后写入sizeReport.json，并更新对比基准
+    只查找产物目录，PLUGINLIT_WORKSPACE=0时导出的工程中gradle的中间产物不计入'''
+    archives = []
+    for name in get_artifact_dirs(build_path):
+        archives.extend(entry.path for _, entry in walk_tree(os.path.join(build_path, name)
+                                                             , include=["*" + ext for ext in SIZE_REPORT_EXTS], sort=True))
+    if not archives:
+        return None
+    reports = []
+    baselines = dict()
+    for archive in archives:
+        report = analyze_archive(archive)
+        baseline_path = get_size_baseline_path(platform, channel, report["kind"])
+        baseline = load_json_manifest(baseline_path)
+        report["baseline"] = baseline.get("file", None)
+        report["changes"] = diff_size_reports(baseline, report, budget) if baseline else []
+        print_size_report(report)
+        reports.append(report)
+        baselines.setdefault(baseline_path, report)
+    for baseline_path, report in baselines.items():
+        save_json_manifest(baseline_path, dict((key, value) for key, value in report.items() if key not in ("changes", "baseline")))
+    over = sum(1 for report in reports for change in report["changes"] if change["over"])
+    with open(os.path.join(build_path, SIZE_REPORT_FILE), 'w', encoding='UTF-8') as f:
+        json.dump({"budget": budget, "overBudget": over, "archives": reports}, f, indent=2, ensure_ascii=False)
+    return {"file": SIZE_REPORT_FILE, "archives": len(reports), "overBudget": over}
+
+
+@task(help={
+    'archive': "APK/AAB/IPA文件",
+    'platform': "平台，用于查找对比基准",
+    'channel': "渠道，用于查找对比基准",
+    'budget': "单个条目允许增长的KB数，默认为256或环境变量PLUGINLIT_SIZE_BUDGET_KB",
+    'save': "把本次结果保存为新的对比基准",
+})
+def sizeReport(context, archive, platform=None, channel=None, budget=None, save=False):
+    '''输出安装包的大小分布，并与上一次的报告对比'''
+    budget = int(float(budget) * 1024) if budget else SIZE_BUDGET_BYTES
+    report = analyze_archive(archive)
+    baseline_path = get_size_baseline_path(platform, channel, report["kind"])
+    baseline = load_json_manifest(baseline_path)
+    report["changes"] = diff_size_reports(baseline, report, budget) if baseline else []
+    print_size_report(report)
+    if save:
+        save_json_manifest(baseline_path, dict((key, value) for key, value in report.items() if key != "changes"))
+    over = [change for change in report["changes"] if change["over"]]
+    if over:
+        return FAILURE("%d entries grew over budget %s" % (len(over), format_size(budget)))
+
+
+# pod cache==============================
+# 以Podfile、pod版本和集成前的project.pbxproj为key缓存pod install的结果(Pods、Podfile.lock、xcworkspace、集成后的project.pbxproj)
+# Podfile.lock是解析依赖的产物，随缓存恢复而不作为key
+
+# 可通过环境变量替换pod
+POD = os.environ.get("PLUGINLIT_POD", "pod")
+# 为假时每次执行pod install，可通过环境变量 PLUGINLIT_POD_CACHE=0 关闭
+UsePodCache = os.environ.get("PLUGINLIT_POD_CACHE", "1") != "0"
+POD_CACHE_MAX_BYTES = int(float(os.environ.get("PLUGINLIT_POD_CACHE_MAX_GB", 5)) * 1024 ** 3)
+POD_OUTPUT_PATHS = ["Pods", "Podfile.lock", "Unity-iPhone.xcworkspace", os.path.join("Unity-iPhone.xcodeproj", "project.pbxproj")]
+# 出现以下输出时说明本地spec仓库过旧，需要 --repo-update
+POD_REPO_ERRORS = [
+    "Unable to find a specification",
+    "could not find compatible versions",
+    "None of your spec sources contain a spec",
+    "is not available",
+]
+
+_pod_version = None
+
+
+def get_pod_version():
+    import subprocess
+    global _pod_version
+    if _pod_version is None:
+        try:
+            _pod_version = subprocess.run([POD, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                                          , check=True).stdout.decode('UTF-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            _pod_version = ""
+    return _pod_version
+
+
+def get_pod_cache_key(project_path):
+    digest = hashlib.sha1(get_pod_version().encode('UTF-8'))
+    for name in ["Podfile", os.path.join("Unity-iPhone.xcodeproj", "project.pbxproj")]:
+        path = os.path.join(project_path, name)
+        digest.update(name.encode('UTF-8'))
+        if os.path.exists(path):
+            digest.update(get_file_hasher().digest(path).encode('UTF-8'))
+    return "pods-" + digest.hexdigest()[:16]
+
+
+def get_pod_cache():
+    return DirectoryCache(get_cache_path("Pods"), POD_CACHE_MAX_BYTES)
+
+
+def copy_pod_outputs(src, dst, link=None):
+    '''在工程目录和缓存目录之间复制pod install的产物'''
+    for name in POD_OUTPUT_PATHS:
+        from_path = os.path.join(src, name)
+        to_path = os.path.join(dst, name)
+        if not os.path.exists(from_path):
+            continue
+        if os.path.isdir(from_path):
+            copy_tree(from_path, to_path, link)
+        else:
+            check_path(os.path.dirname(to_path))
+            rm_file(to_path)
+            link_or_copy_file(from_path, to_path, link)
+
+
+def run_pod_install(project_path):
+    '''先不更新spec仓库执行pod install，依赖无法解析时再带 --repo-update 重试'''
+    print("run pod::: %s install" % POD)
+    result = run_process([POD, "install"], cwd=project_path, log_name="podLog", timeout=get_step_timeout("pod"))
+    if result.ok():
+        return result
+    output = "\n".join(result.tail)
+    if result.timed_out or not any(error in output for error in POD_REPO_ERRORS):
+        return FAILURE("pod fail with %s" % result)
+    print("pod cannot resolve dependencies, retry with --repo-update")
+    return run_step("pod", [POD, "install", "--repo-update"], cwd=project_path, log_name="podLog")
+
+
+@timed("ios.pod_install")
 def podInstall(project_path:str)->str:
     pod_file = os.path.join(project_path, "Podfile")
     if not os.path.exists(pod_file):
         return os.path.join(project_path, "Unity-iPhone.xcodeproj")
 
-    execall("cd %s && pod install --repo-update" % project_path)
+    if not UsePodCache:
+        run_step("pod", [POD, "install", "--repo-update"], cwd=project_path, log_name="podLog")
+        return os.path.join(project_path, "Unity-iPhone.xcworkspace")
+
+    key = get_pod_cache_key(project_path)
+    cache = get_pod_cache()
+    with cache.use(key, podVersion=get_pod_version()) as (cache_path, warm):
+        name = os.path.basename(cache_path)
+        start = time.time()
+        if warm:
+            copy_pod_outputs(cache_path, project_path, "reflink")
+            saved = load_json_manifest(cache.index_file).get(name, dict()).get("installSeconds", 0)
+            print("[pod] hit %s, restored in %.1fs, saved about %.0fs" % (key, time.time() - start, saved))
+        else:
+            run_pod_install(project_path)
+            install_seconds = time.time() - start
+            copy_pod_outputs(project_path, cache_path, "reflink")
+            cache.update_index(name, installSeconds=round(install_seconds, 1))
+            print("[pod] miss %s, install took %.1fs" % (key, install_seconds))
+        get_build_timer().meta["podCache"] = "hit" if warm else "miss"
     return os.path.join(project_path, "Unity-iPhone.xcworkspace")
 
 
-def generateIpa(ios_project_path:str, version_name:str, build_number:str, debug:bool, buildType="adHoc"):
+def generateIpa(ios_project_path:str, version_name:str, build_number:str, debug:bool, buildType="adHoc", channel=None):
     project = podInstall(ios_project_path)
     configuration = "debug" if debug else "release"
     build_config = BuildConfig()
     build_config.set_config(project, buildType, configuration, version_name, build_number, build_number)
+    build_config.channel = channel or ""
     build_tool = BuildToolIOS(build_config, True, False)
     archive_path = build_tool.ios_archive()
 
@@ -826,14 +3250,89 @@ def generateIpa(ios_project_path:str, version_name:str, build_number:str, debug:
     return ipa_path
 
 
+def clean_ios_build_paths(ios_project_path, build_number):
+    '''删除一次构建在工程build目录下的导出目录与临时目录，工作目录保留build时不会逐次累积'''
+    build_path = os.path.join(ios_project_path, "build")
+    rm_dir(os.path.join(build_path, str(build_number)))
+    rm_dir(os.path.join(build_path, "tmp", str(build_number)))
+
+
+# build workspace==============================
+# Unity导出到build_<N>下，再增量同步到固定的 Build/<platform>/workspace/<channel>，
+# 只改写变化的文件并保留gradle/xcode的构建目录，重复构建可以增量编译
+
+# 为假时直接使用Unity导出的目录，可通过环境变量 PLUGINLIT_WORKSPACE=0 关闭
+UseStableWorkspace = os.environ.get("PLUGINLIT_WORKSPACE", "1") != "0"
+# 为真时先清空工作目录
+FreshWorkspace = False
+# h5导出的就是最终产物，仍随build_<N>输出
+WORKSPACE_PLATFORMS = ("android", "ios")
+# 同步时保留的构建产物(相对工作目录的glob)
+WORKSPACE_KEEP_PATTERNS = ["build", ".gradle", ".cxx", "*/build", "*/.gradle", "*/.cxx"
+    , "Pods", "Podfile.lock", "*.xcworkspace"]
+
+
+def get_workspace_path(platform, channel):
+    return os.path.join(PROTJECT_PATH, "Build", platform, "workspace", channel)
+
+
+def get_workspace_lock(platform, channel):
+    '''同一渠道的工作目录从导出到产物收集完成只能被一个构建使用，包括其他fab进程，不使用工作目录时不加锁'''
+    if not UseStableWorkspace or platform not in WORKSPACE_PLATFORMS:
+        return contextlib.nullcontext()
+    return FileLock(get_workspace_path(platform, channel) + ".lock")
+
+
+def get_workspace_keep_paths(workspace_path):
+    import glob
+    keep_paths = set()
+    for pattern in WORKSPACE_KEEP_PATTERNS:
+        keep_paths.update(glob.glob(os.path.join(glob.escape(workspace_path), pattern)))
+    return keep_paths
+
+
+def rebase_path_values(value, src, dst):
+    '''把value中位于src下的路径替换到dst下'''
+    if isinstance(value, dict):
+        return dict((k, rebase_path_values(v, src, dst)) for k, v in value.items())
+    if isinstance(value, list):
+        return [rebase_path_values(v, src, dst) for v in value]
+    if isinstance(value, str) and (value == src or value.startswith(src + "/") or value.startswith(src + os.sep)):
+        return dst + value[len(src):]
+    return value
+
+
+def sync_workspace(platform, channel, temp_path):
+    '''把导出的工程同步到固定工作目录并删除导出目录，buildResult.json中的路径改为工作目录，返回工作目录'''
+    build_result = get_build_result(temp_path) or dict()
+    export_path = build_result.get("projectPath", None)
+    if not export_path or not os.path.isdir(export_path):
+        return None
+    export_path = os.path.normpath(export_path)
+    workspace_path = get_workspace_path(platform, channel)
+    if FreshWorkspace:
+        rm_dir(workspace_path)
+        rm_file(workspace_path + ".manifest.json")
+    with timed("workspace.sync", platform=platform, channel=channel):
+        result = copy_path(export_path, workspace_path, incremental=True, hash_check=True, link="hard"
+                           , keep_paths=get_workspace_keep_paths(workspace_path))
+        rm_dir(export_path)
+    print("workspace %s: %d changed, %d unchanged, %d removed" % (workspace_path, result.copied, result.skipped, result.deleted))
+    update_build_result(temp_path, **rebase_path_values(build_result, export_path, workspace_path))
+    return workspace_path
+
+
 def export_project(platform, channel, channelId, version_name, build_number, temp_path
     , debug, cache_log, product, gitcommit):
     check_path(temp_path)
     platform = platform.lower()
     try:
-        build_unity(platform, temp_path if cache_log else None, version_name=version_name
-                    , build_number=build_number, out_path=temp_path
-                    , channel=channel, debug=debug, product=product, channelId=channelId,gitcommit=gitcommit)
+        with timed("unity.export", platform=platform):
+            build_unity(platform, temp_path if cache_log else None, version_name=version_name
+                        , build_number=build_number, out_path=temp_path
+                        , channel=channel, debug=debug, product=product, channelId=channelId,gitcommit=gitcommit)
+        if UseStableWorkspace and platform in WORKSPACE_PLATFORMS:
+            sync_workspace(platform, channel, temp_path)
     except Exit as e:
         return FAILURE(e.message)
     except Exception as err:
@@ -850,6 +3349,7 @@ def get_patch_tag(platform, version_name, root):
     "root": "上传至的根目录(环境标识)",
 })
 def addPatchTag(context, platform, version_name, commit_id, root):
+    import git
     repo = git.Repo(PROTJECT_PATH)
     try:
         repo.tree(commit_id)
@@ -862,20 +3362,187 @@ def addPatchTag(context, platform, version_name, commit_id, root):
     repo.create_tag(tag_name, commit_id)
 
 
+def move_build_output(temp_path, out_path):
+    '''将构建目录移动到输出目录，返回移动后的目录'''
+    target = os.path.join(out_path, os.path.basename(temp_path)) if os.path.isdir(out_path) else out_path
+    with timed("move.output"):
+        shutil.move(temp_path, out_path)
+    return target
+
+
+def finish_build(temp_path, out_path, post=None, close=True):
+    '''移动构建目录并在buildResult.json旁写入耗时报告，有构建后阶段时由其完成，
+    close为假时不等待符号上传，由调用者之后调用post.close()'''
+    if post is not None:
+        target = post.finish(out_path)
+        if close:
+            post.close()
+        return target
+    target = move_build_output(temp_path, out_path)
+    get_build_timer().write(target)
+    return target
+
+
+@task(help={
+    "log_file": "Unity日志文件",
+    "lines": "每条错误前后输出的行数",
+})
+def analyzeUnityLog(context, log_file, lines=3):
+    print_unity_log_summary(log_file, int(lines))
+
+
+# unity log follower==============================
+# Unity运行时跟踪 -logFile 输出，识别阶段并定期输出进度，事件同时以JSON行写入 <log>.events.jsonl
+
+UNITY_PHASE_PATTERNS = [
+    ("task", re.compile(r"Task (\w+) (begin|ended) [<>]+")),
+    ("import", re.compile(r"Start importing (.+?) using Guid")),
+    ("compile", re.compile(r"script compilation|bee_backend|Compiling assembly|CompileScripts|Requested script compilation")),
+    ("reload", re.compile(r"Begin MonoManager ReloadAssembly|Reloading assemblies")),
+    ("player", re.compile(r"Building Player|BuildPlayer|Compiling shader|Postprocessing|Build Finished|Build completed with a result")),
+    ("refresh", re.compile(r"Refresh completed|Asset Pipeline Refresh|AssetDatabase\.Refresh")),
+]
+
+
+class UnityLogFollower(threading.Thread):
+    '''跟踪Unity日志文件，输出阶段、导入速度与卡住提示'''
+    name_tag = "unity"
+    interval = 10.0
+    stall_seconds = 120.0
+
+    def __init__(self, log_file, name_tag="unity", interval=None, stall_seconds=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.log_file = log_file
+        self.name_tag = name_tag.split(".")[-1]
+        self.interval = float(interval or os.environ.get("PLUGINLIT_PROGRESS_INTERVAL", self.interval))
+        self.stall_seconds = float(stall_seconds or os.environ.get("PLUGINLIT_STALL_SECONDS", self.stall_seconds))
+        self.events_file = log_file + ".events.jsonl"
+        # 同一个日志文件的上一次运行留下的事件
+        rm_file(self.events_file)
+        self.print_json = bool(os.environ.get("CI", None))
+        self._stop_event = threading.Event()
+        self.phase = "startup"
+        self.step = None
+        self.lines = 0
+        self.assets = 0
+        self.start_time = time.time()
+        self.last_line_time = self.start_time
+        self.last_report_time = self.start_time
+        self.last_report_assets = 0
+        self.last_stall_time = 0.0
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(5)
+        self.emit("end")
+
+    def emit(self, event, **extra):
+        now = time.time()
+        rate = (self.assets - self.last_report_assets) / max(0.001, now - self.last_report_time)
+        record = {
+            "event": event,
+            "name": self.name_tag,
+            "time": round(now, 3),
+            "elapsed": round(now - self.start_time, 1),
+            "phase": self.phase,
+            "step": self.step,
+            "lines": self.lines,
+            "assets": self.assets,
+            "assetsPerSecond": round(rate, 1),
+            "idle": round(now - self.last_line_time, 1),
+        }
+        record.update(extra)
+        print("[%s] %s phase=%s%s elapsed=%.0fs lines=%d assets=%d (%.1f/s) idle=%.0fs" % (
+            self.name_tag, event, self.phase, " step=" + self.step if self.step else "", record["elapsed"]
+            , self.lines, self.assets, rate, record["idle"]), flush=True)
+        line = json.dumps(record, ensure_ascii=False)
+        if self.print_json:
+            print("##unity-progress " + line, flush=True)
+        try:
+            with open(self.events_file, 'a', encoding='UTF-8') as f:
+                f.write(line + "\n")
+        except OSError:
+            pass
+        if event == "progress":
+            self.last_report_time = now
+            self.last_report_assets = self.assets
+
+    def classify(self, line):
+        for phase, pattern in UNITY_PHASE_PATTERNS:
+            match = pattern.search(line)
+            if not match:
+                continue
+            if phase == "task":
+                self.step = match.group(1) if match.group(2) == "begin" else None
+                self.emit("step", stepState=match.group(2), task=match.group(1))
+                return
+            if phase == "import":
+                self.assets += 1
+            if phase != self.phase:
+                self.phase = phase
+                self.emit("phase")
+            return
+
+    def tick(self):
+        now = time.time()
+        if now - self.last_line_time >= self.stall_seconds and now - self.last_stall_time >= self.stall_seconds:
+            self.last_stall_time = now
+            self.emit("stall")
+        elif now - self.last_report_time >= self.interval:
+            self.emit("progress")
+
+    def run(self):
+        while not self._stop_event.is_set() and not os.path.exists(self.log_file):
+            self._stop_event.wait(0.5)
+            self.tick()
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, 'r', encoding='UTF-8', errors='replace') as f:
+            pending = ""
+            while True:
+                data = f.read(65536)
+                if data:
+                    self.last_line_time = time.time()
+                    lines = (pending + data).split("\n")
+                    pending = lines.pop()
+                    for line in lines:
+                        self.lines += 1
+                        self.classify(line)
+                    self.tick()
+                    continue
+                if self._stop_event.is_set():
+                    break
+                self._stop_event.wait(0.5)
+                self.tick()
+
+
 def get_build_result(build_path):
     result_json = os.path.join(build_path, "buildResult.json")
     return parseJsonFile(result_json)
 
 
+def update_build_result(build_path, **values):
+    '''向buildResult.json中追加字段'''
+    if not build_path:
+        return
+    result_json = os.path.join(build_path, "buildResult.json")
+    if not os.path.exists(result_json):
+        return
+    build_result = parseJsonFile(result_json) or dict()
+    build_result.update(values)
+    with open(result_json, 'w', encoding='UTF-8') as f:
+        json.dump(build_result, f, ensure_ascii=False)
+
+
 def replace_string(str, **kwargs):
-    for key, value in kwargs.items():
-        str = str.replace("{{%s}}" % key, value)
-    return str
+    return TemplateRenderer(kwargs).render(str)
 
 
-def build_single_aab(aab_path, apk_name_template, channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit):
+def build_single_aab(aab_path, apk_name_template, channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit
+    , export=True):
     dump_now("start build all apks")
-    export_project("android", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
+    if export:
+        export_project("android", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
     dump_now("export android project")
     build_result = get_build_result(temp_path)
     android_project_path = build_result.get("projectPath", None)
@@ -891,33 +3558,88 @@ def build_single_aab(aab_path, apk_name_template, channel, channelId, version_na
     target_aab_file = os.path.join(aab_path, aab_name)
     check_path(aab_path)
     rm_file(target_aab_file)
-    shutil.move(aab_file_name, target_aab_file)
+    with timed("move.aab"):
+        shutil.move(aab_file_name, target_aab_file)
     
 
 def build_all_apks(apks_path, apk_name_template, channel, channelIds, version_name, build_number, temp_path
-    , debug, cache_log, product, gitcommit):
+    , debug, cache_log, product, gitcommit, gradle_fan_out=False, gradle_jobs=0, export=True):
     channelId_list = channelIds.split(',')
     channelId = channelId_list[0]
+    check_apk_name_template(apk_name_template, channelId_list)
     dump_now("start build all apks")
-    export_project("android", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
+    if export:
+        export_project("android", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
     dump_now("export android project")
     build_result = get_build_result(temp_path)
     android_project_path = build_result.get("projectPath", None)
     if android_project_path is None:
         print("buld_result >>>>>>> ", str(build_result))
         return FAILURE("Cannot get android project path")
+    if gradle_fan_out:
+        return build_all_apks_fan_out(android_project_path, build_result, apks_path, apk_name_template, channel, channelId_list
+                                      , version_name, build_number, temp_path, debug, gradle_jobs)
     apk_file_name = generateApk(android_project_path, debug)
     dump_now("generate first apk")
     if not os.path.exists(apk_file_name):
         return FAILURE("找不到构建的安卓APK" + apk_file_name)
-    apk_name = replace_string(apk_name_template, platform="android", channel=channel, channelId=channelId, version_name=version_name, build_number=build_number)
-    target_apk_file = os.path.join(apks_path, apk_name)
+    apk_files = stamp_apk_channels(apk_file_name, apks_path, apk_name_template, channel, channelId_list, version_name, build_number)
+    dump_now("stamp %d channel apks" % len(apk_files))
+    errors = verify_apk_channels(apk_files)
+    if len(errors) > 0:
+        return FAILURE("渠道号写入校验失败:\n" + "\n".join(errors))
+    rm_file(apk_file_name)
+    return build_result
+
+
+def build_all_apks_fan_out(android_project_path, build_result, apks_path, apk_name_template, channel, channelId_list
+                           , version_name, build_number, temp_path, debug, gradle_jobs):
+    clones_path = os.path.join(temp_path, "channels")
+    apk_files = build_channel_apks_parallel(android_project_path, clones_path, channelId_list, debug, gradle_jobs)
+    dump_now("generate %d channel apks" % len(apk_files))
     check_path(apks_path)
-    rm_file(target_apk_file)
-    shutil.move(apk_file_name, target_apk_file)
+    for channelId, apk_file_name in apk_files.items():
+        if not os.path.exists(apk_file_name):
+            return FAILURE("找不到构建的安卓APK" + apk_file_name)
+        apk_name = replace_string(apk_name_template, platform="android", channel=channel, channelId=channelId, version_name=version_name, build_number=build_number)
+        target_apk_file = os.path.join(apks_path, apk_name)
+        rm_file(target_apk_file)
+        with timed("move.apk", channelId=channelId):
+            shutil.move(apk_file_name, target_apk_file)
+    rm_dir(clones_path)
     return build_result
 
 
+@task(help={
+    "apks_path": "渠道APK所在目录",
+    "channelIds": "期望的渠道ID，多渠道ID以逗号','隔开，为空时只检查是否写入渠道号",
+})
+def verifyApkChannels(context, apks_path, channelIds=None):
+    apk_files = [os.path.join(apks_path, name) for name in sorted(os.listdir(apks_path)) if name.endswith(".apk")]
+    if len(apk_files) <= 0:
+        return FAILURE("找不到APK文件:" + apks_path)
+    errors = []
+    stamped = set()
+    for apk_file in apk_files:
+        try:
+            channelId = read_apk_channel(apk_file)
+        except Exception as err:
+            channelId = None
+            print("read apk channel fail", apk_file, err)
+        print("%s => %s" % (os.path.basename(apk_file), channelId))
+        if channelId is None:
+            errors.append("%s: cannot find channel" % apk_file)
+        else:
+            stamped.add(channelId)
+    if channelIds:
+        for channelId in channelIds.split(','):
+            if channelId not in stamped:
+                errors.append("missing apk for channelId %s" % channelId)
+    if len(errors) > 0:
+        return FAILURE("\n".join(errors))
+    return SUCESS("%d apks verified" % len(apk_files))
+
+
 def build_unity_lib(target_lib_path, channel, version_name, build_number, temp_path, debug, cache_log, product, gitcommit):
     dump_now("start build all apks")
     export_project("android", channel, "10000", version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
@@ -932,31 +3654,39 @@ def build_unity_lib(target_lib_path, channel, version_name, build_number, temp_p
     if not os.path.exists(lib_file_path):
         return FAILURE("找不到构建的AAR" + lib_file_path)
     check_path(target_lib_path)
-    copy_file(lib_file_path, os.path.join(target_lib_path, lib_file_name))
+    with timed("copy.aar"):
+        copy_file(lib_file_path, os.path.join(target_lib_path, lib_file_name))
     return build_result
 
 
 def build_ios_installer(installer_path, channel, channelId, version_name, build_number, temp_path
-    , debug, cache_log, product, gitcommit, iosBuildType="adHoc"):
+    , debug, cache_log, product, gitcommit, iosBuildType="adHoc", export=True):
     dump_now("start build ios installer")
-    export_project("ios", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
+    if export:
+        export_project("ios", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
     dump_now("export ios project completed")
     build_result = get_build_result(temp_path)
     ios_project_path = build_result.get("projectPath", None)
     if ios_project_path is None:
         return FAILURE("Cannot get ios project path")
-    ipa_file_name = generateIpa(ios_project_path, version_name, build_number, debug, iosBuildType)
-    dump_now("generated ipa")
-    if not os.path.exists(ipa_file_name):
-        return FAILURE("找不到构建的IPA:" + ipa_file_name)
-    copy_file(ipa_file_name, os.path.join(installer_path, "app.ipa"))
+    try:
+        ipa_file_name = generateIpa(ios_project_path, version_name, build_number, debug, iosBuildType, channel)
+        dump_now("generated ipa")
+        if not os.path.exists(ipa_file_name):
+            return FAILURE("找不到构建的IPA:" + ipa_file_name)
+        with timed("copy.ipa"):
+            copy_file(ipa_file_name, os.path.join(installer_path, "app.ipa"))
+    finally:
+        # IPA已拷贝到构建目录，导出目录(含IPA)与tmp只属于这一次构建
+        clean_ios_build_paths(ios_project_path, build_number)
     return build_result
 
 
 def build_h5_web(channel, channelId, version_name, build_number, temp_path
-                        , debug, cache_log, product, gitcommit):
+                        , debug, cache_log, product, gitcommit, export=True):
     dump_now("start build h5 web")
-    export_project("h5", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
+    if export:
+        export_project("h5", channel, channelId, version_name, build_number, temp_path, debug, cache_log, product, gitcommit)
     dump_now("export h5 project completed")
     build_result = get_build_result(temp_path)
     h5_project_path = build_result.get("projectPath", None)
@@ -965,7 +3695,7 @@ def build_h5_web(channel, channelId, version_name, build_number, temp_path
     return build_result
 
 
-def upload_bugly_symbols(build_result:dict):
+def upload_bugly_symbols(build_result:dict, input_symbol=None):
     if build_result is None:
         return
     bundleId = build_result.get("bundleId", None)
@@ -986,7 +3716,7 @@ def upload_bugly_symbols(build_result:dict):
     buglySymbols = build_result.get("buglySymbols", None)
     if buglySymbols is None:
         return
-    if not os.path.exists(buglySymbols):
+    if not os.path.exists(input_symbol or buglySymbols):
         return
     projectPath = build_result.get("projectPath", None)
     if projectPath is None:
@@ -1000,12 +3730,459 @@ def upload_bugly_symbols(build_result:dict):
         "-jar", tool_jar,
         "-appid", buglyId,
         "-appkey", buglyKey,
-        "-inputSymbol", buglySymbols,
+        "-inputSymbol", input_symbol or buglySymbols,
         "-version", buglyVersion,
         "-bundleid", bundleId,
         "-platform", platform.title()
         ]
-    execall(" ".join(cmds))
+    run_step("java", cmds, log_name="buglyLog")
+    return tool_jar
+
+
+def build_app(platform, channel, channelIds, version_name, build_number, temp_path, debug, log, product, gitcommit
+              , iosBuildType="adHoc", buildBundle=False, apk_name_template=None, gradleFanOut=False, gradleJobs=0, export=True):
+    '''按平台导出工程并构建产物，export为假时使用已导出的工程'''
+    if platform == 'ios':
+        installer_path = os.path.join(temp_path, "installer")
+        return build_ios_installer(installer_path, channel, channelIds, version_name, build_number, temp_path, debug, log, product
+                                   , gitcommit, iosBuildType, export)
+    elif platform == "android":
+        if buildBundle:
+            aab_path = os.path.join(temp_path, "aab")
+            return build_single_aab(aab_path, apk_name_template, channel, channelIds, version_name, build_number, temp_path
+                                    , debug, log, product, gitcommit, export)
+        apks_path = os.path.join(temp_path, "apks")
+        return build_all_apks(apks_path, apk_name_template, channel, channelIds, version_name, build_number, temp_path
+                              , debug, log, product, gitcommit, gradleFanOut, gradleJobs, export)
+    elif platform == "h5":
+        return build_h5_web(channel, channelIds, version_name, build_number, temp_path, debug, log, product, gitcommit, export)
+    raise Exception("not support platform " + platform)
+
+
+def export_app(platform, channel, channelIds, version_name, build_number, temp_path, debug, log, product, gitcommit, buildBundle=False):
+    '''只导出工程，渠道ID与build_app中导出时一致'''
+    channelId = channelIds.split(',')[0] if platform == "android" and not buildBundle else channelIds
+    export_project(platform, channel, channelId, version_name, build_number, temp_path, debug, log, product, gitcommit)
+
+
+# artifact cache==============================
+# 以工程状态、工具链、签名文件、环境变量与构建参数为key缓存构建产物(build_<N>下的产物目录和buildResult.json)，
+# 相同输入的重复构建直接取出；key覆盖不到的输入(如工程外的配置)变化时会取出旧产物，所以默认关闭
+
+# 为真时使用产物缓存，可通过环境变量 PLUGINLIT_ARTIFACT_CACHE=1 或构建参数artifactCache开启
+UseArtifactCache = os.environ.get("PLUGINLIT_ARTIFACT_CACHE", "0") == "1"
+ARTIFACT_CACHE_MAX_BYTES = int(float(os.environ.get("PLUGINLIT_ARTIFACT_CACHE_MAX_GB", 20)) * 1024 ** 3)
+ARTIFACT_MANIFEST = "artifacts.json"
+# 构建目录中的产物目录，渠道克隆等中间目录和PLUGINLIT_WORKSPACE=0时导出的android/ios工程都不属于产物
+ARTIFACT_DIRS = ("apks", "aab", "installer", "library")
+# 计入key的环境变量，另外所有 PLUGINLIT_* 都计入(只控制产物缓存本身的除外)
+ARTIFACT_KEY_ENVS = ["UNITY_PATH", "UNITY_HUB", "TUANJIE_HUB", "JAVA_HOME", "ANDROID_HOME", "ANDROID_SDK_ROOT"
+    , "ANDROID_NDK_HOME", "ANDROID_NDK_ROOT", "GRADLE_USER_HOME", "DEVELOPER_DIR"]
+ARTIFACT_KEY_IGNORED_ENVS = {"PLUGINLIT_ARTIFACT_CACHE", "PLUGINLIT_ARTIFACT_CACHE_MAX_GB", "PLUGINLIT_CACHE"}
+# 签名文件，内容摘要计入key，以os.pathsep分隔，此外还有ProjectSettings中的keystore与工程根目录下的*.keystore/*.jks
+SIGNING_FILES = [path for path in os.environ.get("PLUGINLIT_SIGNING_FILES", "").split(os.pathsep) if path]
+SIGNING_FILE_PATTERNS = ["*.keystore", "*.jks"]
+PROVISIONING_PROFILES_PATH = os.path.join(os.path.expanduser("~"), "Library", "MobileDevice", "Provisioning Profiles")
+
+_command_versions = dict()
+
+
+def get_artifact_cache():
+    return DirectoryCache(get_cache_path("artifacts"), ARTIFACT_CACHE_MAX_BYTES)
+
+
+def get_command_version(cmds):
+    '''命令的版本输出(包括stderr)，进程内缓存，命令不可用时返回空字符串'''
+    import subprocess
+    key = " ".join(cmds)
+    if key not in _command_versions:
+        try:
+            _command_versions[key] = subprocess.run(cmds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                                                    , timeout=60).stdout.decode('UTF-8', errors='replace').strip()
+        except (OSError, subprocess.SubprocessError):
+            _command_versions[key] = ""
+    return _command_versions[key]
+
+
+def get_toolchain_versions(platform):
+    '''Unity、JDK(gradle由Unity版本与工程中的模板决定)、Xcode与CocoaPods的版本'''
+    toolchain = get_toolchain()
+    versions = {"unity": toolchain.version_string, "unityPath": toolchain.unity_path}
+    if platform == "ios":
+        versions["xcode"] = get_command_version([XCODEBUILD, "-version"])
+        versions["pod"] = get_pod_version()
+    elif platform == "android":
+        java_home = os.environ.get("JAVA_HOME", None)
+        versions["java"] = get_command_version([os.path.join(java_home, "bin", "java") if java_home else "java", "-version"])
+    return versions
+
+
+def get_signing_files(platform):
+    '''影响签名的文件：PLUGINLIT_SIGNING_FILES，android的keystore，ios本机的描述文件'''
+    files = list(SIGNING_FILES)
+    if platform == "ios":
+        if os.path.isdir(PROVISIONING_PROFILES_PATH):
+            files.extend(entry.path for _, entry in walk_tree(PROVISIONING_PROFILES_PATH, sort=True))
+    elif platform == "android":
+        settings_file = os.path.join(PROTJECT_PATH, "ProjectSettings", "ProjectSettings.asset")
+        if os.path.isfile(settings_file):
+            with open(settings_file, 'r', encoding='UTF-8', errors='replace') as f:
+                match = re.search(r"^\s*AndroidKeystoreName:\s*(.+?)\s*$", f.read(), re.M)
+            if match:
+                files.append(os.path.join(PROTJECT_PATH, match.group(1)))
+        with os.scandir(PROTJECT_PATH) as it:
+            files.extend(entry.path for entry in it if entry.is_file() and match_patterns(entry.name, entry.name, SIGNING_FILE_PATTERNS))
+    return sorted(set(os.path.abspath(path) for path in files))
+
+
+def get_signing_fingerprint(platform):
+    files = [path for path in get_signing_files(platform) if os.path.isfile(path)]
+    hasher = get_file_hasher()
+    digests = hasher.digest_files(files)
+    hasher.save()
+    return dict((path, digests[path]) for path in files)
+
+
+def get_artifact_envs():
+    return dict((key, value) for key, value in os.environ.items()
+                if (key in ARTIFACT_KEY_ENVS or key.startswith("PLUGINLIT_")) and key not in ARTIFACT_KEY_IGNORED_ENVS)
+
+
+def get_artifact_key(flow, platform, **args):
+    '''工程状态(git tree与未提交改动)、工具链版本、签名文件、环境变量与构建参数的摘要，不是git仓库时返回None'''
+    worktree = get_worktree_fingerprint()
+    if worktree is None:
+        return None
+    data = {
+        "flow": flow,
+        "platform": platform,
+        "worktree": worktree,
+        "toolchain": get_toolchain_versions(platform),
+        "signing": get_signing_fingerprint(platform),
+        "env": get_artifact_envs(),
+        "args": args,
+    }
+    return "%s-%s" % (flow, hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('UTF-8')).hexdigest()[:20])
+
+
+def get_app_artifact_key(platform, channel, channelIds, version_name, build_number, apk_name_template, debug, product
+                         , gitcommit, iosBuildType, buildBundle, gradleFanOut):
+    return get_artifact_key("buildAppsFlow", platform, channel=channel, channelIds=channelIds
+        , version_name=version_name, build_number=build_number, apk_name_template=apk_name_template, debug=debug
+        , product=product, gitcommit=gitcommit, iosBuildType=iosBuildType, buildBundle=buildBundle, gradleFanOut=gradleFanOut)
+
+
+def get_artifact_dirs(build_path):
+    '''构建目录中的产物目录(相对路径)：已知的输出目录，h5导出的工程本身就是产物'''
+    dirs = [name for name in ARTIFACT_DIRS if os.path.isdir(os.path.join(build_path, name))]
+    has_result = os.path.isfile(os.path.join(build_path, "buildResult.json"))
+    build_result = (get_build_result(build_path) if has_result else None) or dict()
+    project_path = build_result.get("projectPath", None)
+    if project_path and str(build_result.get("platform", "")).lower() == "webgl" and os.path.isdir(project_path):
+        rel = os.path.relpath(project_path, build_path)
+        if rel != "." and not rel.startswith(".."):
+            dirs.append(rel.replace("\\", "/"))
+    return dirs
+
+
+def get_artifact_files(build_path):
+    '''构建目录中需要缓存的文件: 产物目录中的文件和buildResult.json，日志与导出的原生工程不缓存'''
+    files = []
+    for name in get_artifact_dirs(build_path):
+        files.extend(name + "/" + rel for rel, _ in scan_files(os.path.join(build_path, name)))
+    if os.path.isfile(os.path.join(build_path, "buildResult.json")):
+        files.append("buildResult.json")
+    return sorted(files)
+
+
+def get_sha256_hasher():
+    return FileHasher("sha256", 64)
+
+
+def store_artifacts(key, build_path):
+    '''把构建产物写入缓存，同时记录每个文件的sha256'''
+    if key is None:
+        return
+    files = get_artifact_files(build_path)
+    with timed("artifact.store"), get_artifact_cache().use(key) as (cache_path, warm):
+        if warm:
+            return
+        digests = get_sha256_hasher().digest_files(os.path.join(build_path, rel) for rel in files)
+        manifest = dict()
+        for rel in files:
+            src = os.path.join(build_path, rel)
+            dst = os.path.join(cache_path, rel)
+            check_path(os.path.dirname(dst))
+            link_or_copy_file(src, dst, "reflink")
+            manifest[rel] = {"size": os.path.getsize(src), "sha256": digests[src]}
+        save_json_manifest(os.path.join(cache_path, ARTIFACT_MANIFEST), {"key": key, "files": manifest})
+    print("[artifact] stored %d files as %s" % (len(files), key))
+
+
+def verify_artifacts(cache_path):
+    '''校验缓存条目中文件的大小和sha256，返回错误列表'''
+    manifest = load_json_manifest(os.path.join(cache_path, ARTIFACT_MANIFEST)).get("files", None)
+    if not manifest:
+        return ["missing manifest"]
+    errors = []
+    paths = dict()
+    for rel, record in manifest.items():
+        path = os.path.join(cache_path, rel)
+        if not os.path.isfile(path) or os.path.getsize(path) != record["size"]:
+            errors.append("%s: missing or size changed" % rel)
+        else:
+            paths[path] = rel
+    for path, digest in get_sha256_hasher().digest_files(paths).items():
+        if digest != manifest[paths[path]]["sha256"]:
+            errors.append("%s: sha256 mismatch" % paths[path])
+    return errors
+
+
+def restore_artifacts(key, build_path):
+    '''缓存命中且校验通过时把产物复制到构建目录，返回是否命中'''
+    if key is None:
+        return False
+    # 未命中时不占用目录，不在索引中留下空条目
+    with timed("artifact.restore"), get_artifact_cache().use(key, create=False) as (cache_path, warm):
+        if not warm:
+            print("[artifact] miss %s" % key)
+            get_build_timer().meta["artifactCache"] = "miss"
+            return False
+        errors = verify_artifacts(cache_path)
+        if errors:
+            print("[artifact] discard broken entry %s:\n%s" % (key, "\n".join(errors)))
+            rm_dir(cache_path)
+            check_path(cache_path)
+            get_build_timer().meta["artifactCache"] = "broken"
+            return False
+        manifest = load_json_manifest(os.path.join(cache_path, ARTIFACT_MANIFEST))["files"]
+        for rel in manifest:
+            dst = os.path.join(build_path, rel)
+            check_path(os.path.dirname(dst))
+            rm_file(dst)
+            link_or_copy_file(os.path.join(cache_path, rel), dst, "reflink")
+    print("[artifact] hit %s, restored %d files" % (key, len(manifest)))
+    get_build_timer().meta["artifactCache"] = "hit"
+    update_build_result(build_path, artifactCache=key)
+    return True
+
+
+# post build==============================
+# 产物生成后在后台线程中并行执行符号压缩上传、校验和、输出目录的移动与打包，失败的步骤按次数重试，
+# 主流程只等待它需要的步骤，每一步的结果写入buildResult.json的postBuild字段
+
+# 为真时上传符号，默认关闭，可通过环境变量 PLUGINLIT_SYMBOL_UPLOAD=1 开启
+UploadSymbols = os.environ.get("PLUGINLIT_SYMBOL_UPLOAD", "0") == "1"
+# 为空时用工程中的bugly上传工具上传原始符号目录，http(s)地址时POST压缩后的符号，其他值视为本地目录(用于测试的替身)
+SYMBOL_UPLOAD_URL = os.environ.get("PLUGINLIT_SYMBOL_UPLOAD_URL", None)
+POST_BUILD_RETRIES = int(os.environ.get("PLUGINLIT_POSTBUILD_RETRIES", 2))
+POST_BUILD_RETRY_DELAY = 5
+POST_BUILD_WORKERS = 4
+CHECKSUM_FILE = "checksums.sha256"
+
+
+class PostBuildStep(object):
+    '''构建后阶段中的一个步骤'''
+    status = "pending"
+    attempts = 0
+    error = None
+    result = None
+    duration = 0.0
+    future = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "attempts": self.attempts,
+            "duration": round(self.duration, 3),
+            "error": self.error,
+            "result": self.result,
+        }
+
+
+class PostBuildStage(object):
+    '''在线程池中执行构建后的步骤，步骤之间用after声明先后，函数返回None时视为跳过'''
+    retry_delay = POST_BUILD_RETRY_DELAY
+    # 移动后的输出目录
+    target = None
+
+    def __init__(self, build_path, build_result=None, zip_output=False, retries=None, platform=None, channel=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.build_path = build_path
+        self.build_result = build_result
+        self.zip_output = zip_output
+        self.platform = platform or (build_result or dict()).get("platform", None)
+        self.channel = channel
+        self.retries = POST_BUILD_RETRIES if retries is None else retries
+        self.steps = dict()
+        self.local = get_build_local()
+        self.executor = ThreadPoolExecutor(max_workers=POST_BUILD_WORKERS)
+
+    def submit(self, name, func, *args, after=(), retries=0, required=True):
+        '''提交步骤，等after中的步骤结束后执行，required为真时依赖的步骤没有成功则跳过'''
+        step = PostBuildStep(name)
+        depends = [self.steps[dep] for dep in after if dep in self.steps]
+
+        def run():
+            for dep in depends:
+                dep.future.result()
+                if required and dep.status != "ok":
+                    step.status = "skipped"
+                    step.error = "%s %s" % (dep.name, dep.status)
+                    return
+            start = time.time()
+            with timed("postbuild.%s" % name):
+                while True:
+                    step.attempts += 1
+                    try:
+                        step.result = func(*args)
+                        step.status = "skipped" if step.result is None else "ok"
+                        step.error = None
+                        break
+                    except Exception as err:
+                        step.error = err.message if isinstance(err, Exit) else str(err)
+                        if step.attempts > retries:
+                            step.status = "fail"
+                            break
+                        print("[postbuild] %s attempt %d fail: %s" % (name, step.attempts, step.error))
+                        time.sleep(self.retry_delay * step.attempts)
+            step.duration = time.time() - start
+            print("[postbuild] %s %s in %.1fs" % (name, step.status, step.duration))
+
+        step.future = self.executor.submit(bind_build_local(run, self.local))
+        self.steps[name] = step
+        return step
+
+    def start(self):
+        '''产物生成后立即开始符号压缩上传、校验和与安装包大小分析'''
+        if UploadSymbols:
+            get_symbols = lambda: self.steps["symbols.compress"].result
+            build_name = "%s_%s" % (self.channel, os.path.basename(os.path.normpath(self.build_path)))
+            self.submit("symbols.compress", compress_symbols, self.build_result, build_name)
+            self.submit("symbols.upload", upload_symbols, self.build_result, get_symbols
+                        , after=("symbols.compress",), retries=self.retries)
+            self.submit("symbols.clean", clean_symbols, get_symbols, after=("symbols.upload",), required=False)
+        self.submit("checksums", write_checksums, self.build_path)
+        self.submit("size", write_size_report, self.build_path, self.platform, self.channel)
+        return self
+
+    def wait(self, *names):
+        '''等待指定的步骤(默认全部)结束，返回是否都成功或跳过'''
+        steps = [self.steps[name] for name in names if name in self.steps] if names else list(self.steps.values())
+        for step in steps:
+            step.future.result()
+        return all(step.status != "fail" for step in steps)
+
+    def results(self):
+        return dict((name, step.to_dict()) for name, step in self.steps.items())
+
+    def finish(self, out_path):
+        '''移动(及打包)输出目录，只等待输出需要的步骤，返回移动后的目录，符号上传由close等待'''
+        # 压缩、校验和与大小分析都读取构建目录，完成后才能移动
+        output = self.submit("output", move_build_output, self.build_path, out_path
+                             , after=("symbols.compress", "checksums", "size"), required=False)
+        if self.zip_output:
+            self.submit("output.zip", zip_build_output, lambda: output.result, after=("output",))
+        self.wait("output", "output.zip")
+        self.target = output.result if output.status == "ok" else self.build_path
+        if output.status != "ok":
+            self.close()
+            FAILURE("move build output fail: %s" % output.error)
+        return self.target
+
+    def close(self):
+        '''等待剩余的步骤(符号上传)结束，写入结果和耗时报告'''
+        self.wait()
+        self.executor.shutdown()
+        target = self.target or self.build_path
+        update_build_result(target, postBuild=self.results())
+        get_build_timer().write(target)
+
+
+def compress_symbols(build_result, build_name):
+    '''将buglySymbols目录压缩到缓存目录，返回压缩包路径，没有符号时返回None
+    build_name区分渠道与构建目录，同时进行的构建不会写同一个压缩包；
+    没有上传地址时bugly上传工具直接读取目录，只复制(可以时用reflink)到缓存目录，不压缩'''
+    symbols = (build_result or dict()).get("buglySymbols", None)
+    if not symbols or not os.path.exists(symbols):
+        return None
+    if os.path.isfile(symbols):
+        return symbols
+    name = "%s_%s_%s_%s" % (build_result.get("platform", None), build_result.get("bundleId", None)
+                            , build_result.get("buglyVersion", None), build_name)
+    symbols_path = get_cache_path("symbols", re.sub(r"[^\w.-]", "_", name))
+    check_path(os.path.dirname(symbols_path))
+    # 符号在工作目录或构建目录中，释放工作目录或移动输出后就会变化，上传前先移到缓存目录
+    if not SYMBOL_UPLOAD_URL:
+        copy_tree(symbols, symbols_path, link="reflink")
+        return symbols_path
+    zip_path = symbols_path + ".zip"
+    zip_file(symbols, zip_path + ".tmp", reproducible=True)
+    os.replace(zip_path + ".tmp", zip_path)
+    return zip_path
+
+
+def clean_symbols(get_symbols):
+    '''上传结束后删除缓存目录中的符号压缩包或目录，buglySymbols本身是文件时不删除'''
+    symbols = get_symbols()
+    if not symbols or os.path.dirname(os.path.abspath(symbols)) != os.path.abspath(get_cache_path("symbols")):
+        return None
+    if os.path.isdir(symbols):
+        rm_dir(symbols)
+    else:
+        rm_file(symbols)
+    return symbols
+
+
+def upload_symbols(build_result, get_symbols):
+    '''上传符号(有上传地址时为压缩包，否则为符号目录的副本)，返回上传的目标'''
+    symbols = get_symbols()
+    if not symbols:
+        return None
+    if not SYMBOL_UPLOAD_URL:
+        return upload_bugly_symbols(build_result, symbols)
+    if not SYMBOL_UPLOAD_URL.startswith(("http://", "https://")):
+        target = os.path.join(SYMBOL_UPLOAD_URL, os.path.basename(symbols))
+        check_path(SYMBOL_UPLOAD_URL)
+        shutil.copyfile(symbols, target)
+        return target
+
+    import urllib.parse
+    import urllib.request
+    query = urllib.parse.urlencode(dict((key, build_result.get(key, None) or "") for key in
+                                        ["platform", "bundleId", "buglyId", "buglyVersion"]))
+    url = SYMBOL_UPLOAD_URL + ("&" if "?" in SYMBOL_UPLOAD_URL else "?") + query
+    with open(symbols, 'rb') as f:
+        request = urllib.request.Request(url, data=f, method="POST", headers={
+            "Content-Type": "application/zip",
+            "Content-Length": str(os.path.getsize(symbols)),
+            "X-App-Key": build_result.get("buglyKey", None) or "",
+        })
+        with urllib.request.urlopen(request, timeout=get_step_timeout("symbols")) as response:
+            return {"url": SYMBOL_UPLOAD_URL, "status": response.status}
+
+
+def write_checksums(build_path):
+    '''计算构建产物的sha256，写入构建目录下的checksums.sha256，返回文件数'''
+    files = [rel for rel in get_artifact_files(build_path) if rel != "buildResult.json"]
+    if not files:
+        return None
+    digests = get_sha256_hasher().digest_files(os.path.join(build_path, rel) for rel in files)
+    with open(os.path.join(build_path, CHECKSUM_FILE), 'w', encoding='UTF-8') as f:
+        for rel in files:
+            f.write("%s  %s\n" % (digests[os.path.join(build_path, rel)], rel))
+    return {"file": CHECKSUM_FILE, "count": len(files)}
+
+
+def zip_build_output(get_target):
+    '''把移动后的输出目录打包为同名zip'''
+    target = get_target()
+    zip_path = target.rstrip("/\\") + ".zip"
+    zip_file(target, zip_path, reproducible=True)
+    return zip_path
 
 
 # -----------------
@@ -1024,37 +4201,57 @@ def upload_bugly_symbols(build_result:dict):
     'apk_name_template' : "APK目标文件名称模版",
     'gitcommit': "gitcommit号，用来标识资源版本TAG",
     'buildBundle': "是否构建bundle文件，无该选项时默认构建APK",
+    'gradleFanOut': "每个渠道ID单独执行gradle构建(通过-PchannelId传入)，而不是写入同一个APK",
+    'gradleJobs': "gradleFanOut时并行的gradle数量，默认为CPU核数的一半",
+    'forcePrebuild': "总是执行Unity PreBuild，不使用PreBuild缓存",
+    'unityWorker': "PreBuild/Build提交给常驻的Unity执行，构建结束后Unity保持打开，空闲一段时间后自动退出",
+    'gradleProfile': "gradle执行参数 plain/cache/ci/fast/offline，默认为plain",
+    'freshWorkspace': "清空 Build/<platform>/workspace/<channel> 后重新同步导出的工程",
+    'artifactCache': "工程、工具链、签名与参数和之前的构建一致时直接使用缓存的产物，默认关闭(或设置PLUGINLIT_ARTIFACT_CACHE=1)",
+    'zipOutput': "移动到输出目录后再打包为同名zip",
 })
 def buildAppsFlow(context, platform, channel, channelIds, version_name, build_number, out_path
-    , apk_name_template=None, debug=False, log=True, product=False, gitcommit=None, iosBuildType="adHoc", buildBundle=False):
+    , apk_name_template=None, debug=False, log=True, product=False, gitcommit=None, iosBuildType="adHoc", buildBundle=False
+    , gradleFanOut=False, gradleJobs=0, forcePrebuild=False, unityWorker=False
+    , gradleProfile=None, freshWorkspace=False, artifactCache=False, zipOutput=False):
+    global ProcessLogPath, ForcePrebuild, UseUnityWorker, GradleProfileName, FreshWorkspace
     temp_path = os.path.join(PROTJECT_PATH, "Build", platform, "build_%s" % build_number)
     rm_dir(temp_path)
+    ProcessLogPath = temp_path if log else None
+    ForcePrebuild = forcePrebuild
+    UseUnityWorker = UseUnityWorker or unityWorker
+    GradleProfileName = gradleProfile or GradleProfileName
+    FreshWorkspace = freshWorkspace
+    # 提前检查profile名称
+    get_gradle_profile()
+    begin_build_timer("buildAppsFlow", platform=platform, channel=channel, channelIds=channelIds
+                      , version_name=version_name, build_number=build_number)
+    artifact_key = None
+    if UseArtifactCache or artifactCache:
+        artifact_key = get_app_artifact_key(platform, channel, channelIds, version_name, build_number, apk_name_template
+            , debug, product, gitcommit, iosBuildType, buildBundle, gradleFanOut)
+        if restore_artifacts(artifact_key, temp_path):
+            finish_build(temp_path, out_path, PostBuildStage(temp_path, None, zipOutput, platform=platform, channel=channel).start())
+            return SUCESS("Build Completed (cached)")
+    post = None
     try:
-        build_result = None
-        if platform == 'ios':
-            installer_path = os.path.join(temp_path, "installer")
-            build_result = build_ios_installer(installer_path, channel, channelIds, version_name, build_number, temp_path, debug, log, product, gitcommit, iosBuildType)
-        elif platform == "android":
-            if buildBundle:
-                aab_path = os.path.join(temp_path, "aab")
-                build_result = build_single_aab(aab_path, apk_name_template, channel, channelIds, version_name, build_number, temp_path
-                                              , debug, log, product, gitcommit)
-            else:
-                apks_path = os.path.join(temp_path, "apks")
-                build_result = build_all_apks(apks_path, apk_name_template, channel, channelIds, version_name, build_number, temp_path
-                  , debug, log, product, gitcommit)
-        elif platform == "h5":
-            build_result = build_h5_web(channel, channelIds, version_name, build_number, temp_path, debug, log, product, gitcommit)
-        else:
-            raise Exception("not support platform " + platform)
-#         upload_bugly_symbols(build_result)
+        with get_workspace_lock(platform, channel):
+            build_result = build_app(platform, channel, channelIds, version_name, build_number, temp_path, debug, log, product
+                                     , gitcommit, iosBuildType, buildBundle, apk_name_template, gradleFanOut, gradleJobs)
+            # 符号在工作目录中，压缩完才能交给其他构建
+            post = PostBuildStage(temp_path, build_result, zipOutput, platform=platform, channel=channel).start()
+            post.wait("symbols.compress")
+        store_artifacts(artifact_key, temp_path)
     except Exit as exit:
-        shutil.move(temp_path, out_path)
+        finish_build(temp_path, out_path, post)
         return FAILURE(exit.message)
     except Exception as err:
+        if post is not None:
+            post.wait()
+        get_build_timer().write(temp_path)
         return FAILURE("Build Fail with error::" + str(err))
         
-    shutil.move(temp_path, out_path)
+    finish_build(temp_path, out_path, post)
     return SUCESS("Build Completed")
 
 
@@ -1068,18 +4265,316 @@ def buildAppsFlow(context, platform, channel, channelIds, version_name, build_nu
     "log": "保存log文件",
     "product": "是否为生产模式",
     'gitcommit': "gitcommit号，用来标识资源版本TAG",
+    'forcePrebuild': "总是执行Unity PreBuild，不使用PreBuild缓存",
+    'unityWorker': "PreBuild/Build提交给常驻的Unity执行，构建结束后Unity保持打开，空闲一段时间后自动退出",
+    'gradleProfile': "gradle执行参数 plain/cache/ci/fast/offline，默认为plain",
+    'freshWorkspace': "清空 Build/<platform>/workspace/<channel> 后重新同步导出的工程",
+    'artifactCache': "工程、工具链、签名与参数和之前的构建一致时直接使用缓存的产物，默认关闭(或设置PLUGINLIT_ARTIFACT_CACHE=1)",
+    'zipOutput': "移动到输出目录后再打包为同名zip",
 })
-def buildUnityLibFlow(context, channel, version_name, build_number, out_path, debug=False, log=True, product=False, gitcommit=None):
+def buildUnityLibFlow(context, channel, version_name, build_number, out_path, debug=False, log=True, product=False, gitcommit=None
+    , forcePrebuild=False, unityWorker=False
+    , gradleProfile=None, freshWorkspace=False, artifactCache=False, zipOutput=False):
+    global ProcessLogPath, ForcePrebuild, UseUnityWorker, GradleProfileName, FreshWorkspace
     temp_path = os.path.join(PROTJECT_PATH, "Build", "android", "build_%s" % build_number)
     rm_dir(temp_path)
+    ProcessLogPath = temp_path if log else None
+    ForcePrebuild = forcePrebuild
+    UseUnityWorker = UseUnityWorker or unityWorker
+    GradleProfileName = gradleProfile or GradleProfileName
+    FreshWorkspace = freshWorkspace
+    # 提前检查profile名称
+    get_gradle_profile()
+    begin_build_timer("buildUnityLibFlow", channel=channel, version_name=version_name, build_number=build_number)
+    artifact_key = None
+    if UseArtifactCache or artifactCache:
+        artifact_key = get_artifact_key("buildUnityLibFlow", "android", channel=channel, version_name=version_name
+            , build_number=build_number, debug=debug, product=product, gitcommit=gitcommit)
+        if restore_artifacts(artifact_key, temp_path):
+            finish_build(temp_path, out_path, PostBuildStage(temp_path, None, zipOutput, platform="android", channel=channel).start())
+            return SUCESS("Build Completed (cached)")
+    post = None
     try:
         target_lib_path = os.path.join(temp_path, "library")
-        build_result = build_unity_lib(target_lib_path, channel, version_name, build_number, temp_path, debug, log, product, gitcommit)
+        with get_workspace_lock("android", channel):
+            build_result = build_unity_lib(target_lib_path, channel, version_name, build_number, temp_path, debug, log, product, gitcommit)
+            post = PostBuildStage(temp_path, build_result, zipOutput, platform="android", channel=channel).start()
+            post.wait("symbols.compress")
+        store_artifacts(artifact_key, temp_path)
     except Exit as exit:
-        shutil.move(temp_path, out_path)
+        finish_build(temp_path, out_path, post)
         return FAILURE(exit.message)
     except Exception as err:
+        if post is not None:
+            post.wait()
+        get_build_timer().write(temp_path)
         return FAILURE("Build Fail with error::" + str(err))
         
-    shutil.move(temp_path, out_path)
+    finish_build(temp_path, out_path, post)
     return SUCESS("Build Completed")
+
+
+# build matrix==============================
+# 多个平台/渠道的构建按阶段(导出、原生构建、输出)执行，每个阶段受资源并发数限制，
+# 一个条目的gradle/xcodebuild可以与下一个条目的Unity导出同时进行，条目之间可以用after声明依赖
+
+# 同一工程只能打开一个Unity
+MATRIX_UNITY_LIMIT = 1
+MATRIX_NATIVE_RESOURCES = {"android": "gradle", "ios": "xcodebuild"}
+MATRIX_ENTRY_OPTIONS = ["version_name", "build_number", "debug", "product", "gitcommit", "apk_name_template"
+    , "iosBuildType", "buildBundle", "gradleFanOut", "gradleJobs"]
+
+
+class MatrixEntry(object):
+    '''buildMatrix中的一个构建'''
+    status = "pending"
+    error = None
+    output = None
+    start_time = 0.0
+    end_time = 0.0
+
+    def __init__(self, index, data, defaults):
+        options = dict(defaults)
+        options.update(data)
+        for key in ["platform", "channel", "channelIds", "version_name", "build_number"]:
+            if options.get(key, None) in (None, ""):
+                FAILURE("matrix entry %d missing %s" % (index, key))
+        self.platform = options["platform"]
+        self.channel = options["channel"]
+        self.channelIds = str(options["channelIds"])
+        self.name = options.get("name", None) or "%s_%s_%d" % (self.platform, self.channel, index)
+        self.after = list(options.get("after", []))
+        self.options = dict((key, options.get(key, None)) for key in MATRIX_ENTRY_OPTIONS)
+        self.options["build_number"] = str(self.options["build_number"])
+        self.temp_path = os.path.join(PROTJECT_PATH, "Build", self.platform, "build_%s_%s" % (self.options["build_number"], self.name))
+        self.stages = dict()
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "platform": self.platform,
+            "channel": self.channel,
+            "channelIds": self.channelIds,
+            "status": self.status,
+            "error": self.error,
+            "output": self.output,
+            "duration": round(self.end_time - self.start_time, 3) if self.start_time else 0,
+            "stages": self.stages,
+        }
+
+
+class BuildMatrix(object):
+    '''每个条目一个线程，按资源信号量进入各阶段，同一平台渠道的工作目录同时只被一个条目使用'''
+
+    def __init__(self, entries, limits, out_path, log=True, artifact_cache=False, zip_output=False):
+        self.entries = entries
+        self.by_name = dict((entry.name, entry) for entry in entries)
+        if len(self.by_name) != len(entries):
+            FAILURE("matrix entry names must be unique")
+        self.check_dependencies()
+        self.semaphores = dict((name, threading.Semaphore(max(1, int(count)))) for name, count in limits.items())
+        self.limits = limits
+        self.out_path = out_path
+        self.log = log
+        self.artifact_cache = artifact_cache
+        self.zip_output = zip_output
+        self.duration = 0.0
+
+    def check_dependencies(self):
+        visiting = set()
+        visited = set()
+
+        def visit(entry):
+            if entry.name in visited:
+                return
+            if entry.name in visiting:
+                FAILURE("matrix dependency cycle at %s" % entry.name)
+            visiting.add(entry.name)
+            for name in entry.after:
+                if name not in self.by_name:
+                    FAILURE("matrix entry %s depends on unknown %s" % (entry.name, name))
+                visit(self.by_name[name])
+            visiting.discard(entry.name)
+            visited.add(entry.name)
+
+        for entry in self.entries:
+            visit(entry)
+
+    @contextlib.contextmanager
+    def stage(self, entry, name, *resources):
+        '''占用资源执行一个阶段，记录等待时间和执行时间'''
+        begin = start = time.time()
+        acquired = []
+        try:
+            # 固定顺序获取，避免死锁
+            for resource in sorted(resources):
+                self.semaphores[resource].acquire()
+                acquired.append(resource)
+            start = time.time()
+            with timed("matrix.%s" % name, entry=entry.name, resources=",".join(acquired)):
+                yield
+        finally:
+            end = time.time()
+            for resource in reversed(acquired):
+                self.semaphores[resource].release()
+            entry.stages[name] = {"wait": round(start - begin, 3), "duration": round(end - start, 3)}
+
+    def run_entry(self, entry):
+        for name in entry.after:
+            dependency = self.by_name[name]
+            dependency.done.wait()
+            if dependency.status != "ok":
+                entry.status = "skipped"
+                entry.error = "dependency %s %s" % (name, dependency.status)
+                entry.done.set()
+                return
+        entry.status = "running"
+        entry.start_time = time.time()
+        timer = BuildTimer(entry.name)
+        timer.meta.update(platform=entry.platform, channel=entry.channel, channelIds=entry.channelIds, matrix=True)
+        _build_local.timer = timer
+        _build_local.log_path = entry.temp_path if self.log else None
+        _build_local.log_files = []
+        options = entry.options
+        args = (entry.platform, entry.channel, entry.channelIds, options["version_name"], options["build_number"]
+                , entry.temp_path, options["debug"], self.log, options["product"], options["gitcommit"])
+        post = None
+        try:
+            rm_dir(entry.temp_path)
+            artifact_key = None
+            if self.artifact_cache or UseArtifactCache:
+                artifact_key = get_app_artifact_key(entry.platform, entry.channel, entry.channelIds, options["version_name"]
+                    , options["build_number"], options["apk_name_template"], options["debug"], options["product"]
+                    , options["gitcommit"], options["iosBuildType"], options["buildBundle"], options["gradleFanOut"])
+            with self.stage(entry, "restore", "disk"):
+                cached = restore_artifacts(artifact_key, entry.temp_path)
+            if not cached:
+                native = MATRIX_NATIVE_RESOURCES.get(entry.platform, None)
+                with get_workspace_lock(entry.platform, entry.channel):
+                    with self.stage(entry, "export", "unity"):
+                        export_app(*args, buildBundle=options["buildBundle"])
+                    with self.stage(entry, "native", *([native] if native else [])):
+                        build_result = build_app(*args, iosBuildType=options["iosBuildType"], buildBundle=options["buildBundle"]
+                                                 , apk_name_template=options["apk_name_template"], gradleFanOut=options["gradleFanOut"]
+                                                 , gradleJobs=options["gradleJobs"], export=False)
+                    # 符号在工作目录中，压缩完才能交给下一个同渠道的条目
+                    post = PostBuildStage(entry.temp_path, build_result, self.zip_output
+                                          , platform=entry.platform, channel=entry.channel).start()
+                    post.wait("symbols.compress")
+                with self.stage(entry, "store", "disk"):
+                    store_artifacts(artifact_key, entry.temp_path)
+            else:
+                post = PostBuildStage(entry.temp_path, None, self.zip_output, platform=entry.platform, channel=entry.channel).start()
+            entry.status = "ok"
+        except Exit as exit:
+            entry.status = "fail"
+            entry.error = exit.message
+        except Exception as err:
+            entry.status = "fail"
+            entry.error = str(err)
+        finally:
+            try:
+                if os.path.isdir(entry.temp_path):
+                    with self.stage(entry, "output", "disk"):
+                        entry.output = finish_build(entry.temp_path, self.out_path, post, close=False)
+            except Exception as err:
+                print("move output of %s fail: %s" % (entry.name, err))
+            entry.end_time = time.time()
+            # 依赖的条目只需要输出，不等待符号上传
+            entry.done.set()
+            if post is not None:
+                # 释放disk后再等待上传
+                post.close()
+                entry.stages["post"] = post.results()
+            vars(_build_local).clear()
+            print("[matrix] %s %s in %.1fs%s" % (entry.name, entry.status, entry.end_time - entry.start_time
+                                                , ": " + str(entry.error) if entry.error else ""))
+
+    def run(self):
+        start = time.time()
+        threads = [threading.Thread(target=self.run_entry, args=(entry,), name=entry.name, daemon=True) for entry in self.entries]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.duration = time.time() - start
+        return self.summary()
+
+    def summary(self):
+        entries = [entry.to_dict() for entry in self.entries]
+        # 只累加各阶段的执行时间，不包括等待资源的时间和post中的后台步骤
+        serial = sum(stage["duration"] for entry in entries for name, stage in entry["stages"].items() if name != "post")
+        return {
+            "duration": round(self.duration, 3),
+            "serialDuration": round(serial, 3),
+            "speedup": round(serial / self.duration, 2) if self.duration else None,
+            "limits": self.limits,
+            "entries": entries,
+        }
+
+
+def print_matrix_summary(summary):
+    stage_names = ["restore", "export", "native", "store", "output"]
+    print("=" * 100)
+    print("%-28s %-8s %9s  %s" % ("entry", "status", "total", "  ".join("%-15s" % name for name in stage_names)))
+    for entry in summary["entries"]:
+        stages = []
+        for name in stage_names:
+            stage = entry["stages"].get(name, None)
+            stages.append("%-15s" % ("%.0fs(+%.0fs)" % (stage["duration"], stage["wait"]) if stage else "-"))
+        print("%-28s %-8s %8.0fs  %s" % (entry["name"], entry["status"], entry["duration"], "  ".join(stages)))
+        if entry["error"]:
+            print("    %s" % entry["error"])
+    print("-" * 100)
+    print("wall %.0fs, serial %.0fs, speedup x%s  (stage: duration(+wait))" % (summary["duration"], summary["serialDuration"], summary["speedup"]))
+
+
+@task(help={
+    "matrix": "构建列表JSON文件，每项包含platform、channel、channelIds，可覆盖version_name、build_number、debug等参数，name/after用于声明依赖",
+    "version_name": "默认版本号名称",
+    "build_number": "默认build号",
+    "out_path": "输出目录",
+
+    "debug": "DEBUG模式会打开构建时的开发模式选项，且增加DEBUG宏",
+    "log": "保存log文件",
+    "product": "是否为生产模式",
+    'gitcommit': "gitcommit号，用来标识资源版本TAG",
+    'apk_name_template' : "默认APK目标文件名称模版",
+    'gradleLimit': "同时执行gradle的条目数",
+    'xcodeLimit': "同时执行xcodebuild的条目数",
+    'diskLimit': "同时读写缓存及移动输出的条目数",
+    'forcePrebuild': "总是执行Unity PreBuild，不使用PreBuild缓存",
+    'unityWorker': "PreBuild/Build提交给常驻的Unity执行，构建结束后Unity保持打开，空闲一段时间后自动退出",
+    'gradleProfile': "gradle执行参数 plain/cache/ci/fast/offline，默认为plain",
+    'artifactCache': "工程、工具链、签名与参数和之前的构建一致时直接使用缓存的产物，默认关闭(或设置PLUGINLIT_ARTIFACT_CACHE=1)",
+    'zipOutput': "移动到输出目录后再打包为同名zip",
+})
+def buildMatrix(context, matrix, version_name=None, build_number=None, out_path=None, debug=False, log=True, product=False
+    , gitcommit=None, apk_name_template=None, gradleLimit=2, xcodeLimit=1, diskLimit=2, forcePrebuild=False, unityWorker=False
+    , gradleProfile=None, artifactCache=False, zipOutput=False):
+    '''并行调度多个buildAppsFlow构建，结束时输出汇总'''
+    global ForcePrebuild, UseUnityWorker, GradleProfileName
+    ForcePrebuild = forcePrebuild
+    UseUnityWorker = UseUnityWorker or unityWorker
+    GradleProfileName = gradleProfile or GradleProfileName
+    # 提前检查profile名称
+    get_gradle_profile()
+    data = parseJsonFile(matrix)
+    if not isinstance(data, list) or len(data) <= 0:
+        return FAILURE("matrix should be a non-empty json list: " + matrix)
+    defaults = {"version_name": version_name, "build_number": build_number, "debug": debug, "product": product
+        , "gitcommit": gitcommit, "apk_name_template": apk_name_template, "iosBuildType": "adHoc", "buildBundle": False, "gradleFanOut": False, "gradleJobs": 0}
+    entries = [MatrixEntry(index, item, defaults) for index, item in enumerate(data)]
+    out_path = out_path or os.path.join(PROTJECT_PATH, "Build", "matrix")
+    check_path(out_path)
+    limits = {"unity": MATRIX_UNITY_LIMIT, "gradle": gradleLimit, "xcodebuild": xcodeLimit, "disk": diskLimit}
+    begin_build_timer("buildMatrix", matrix=matrix, entries=len(entries))
+    summary = BuildMatrix(entries, limits, out_path, log, artifactCache, zipOutput).run()
+    print_matrix_summary(summary)
+    with open(os.path.join(out_path, "matrixResult.json"), 'w', encoding='UTF-8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    failed = [entry["name"] for entry in summary["entries"] if entry["status"] != "ok"]
+    if failed:
+        return FAILURE("matrix entries failed: " + ", ".join(failed))
+    return SUCESS("Matrix Completed")